@@ -22,7 +22,7 @@ from PyQt6.QtWidgets import QApplication, QWidget, QMainWindow, QTableWidget, \
 from PyQt6.QtCore import Qt, QItemSelectionModel, QDateTime, QLibraryInfo, QSysInfo
 from MaestroCore.GUI.MainWindow import Ui_MainWindow
 from scheduleLib import genUtils
-from scheduleLib.candidateDatabase import Candidate, CandidateDatabase
+from scheduleLib.candidateDatabase import Candidate, CandidateDatabase, LazyCandidateMap, applyChanges
 from MaestroCore.utils.processes import ProcessModel, Process  # , ProcessDialog
 from MaestroCore.utils.listModel import FlexibleListModel
 from MaestroCore.utils.fileButton import FileSelectionButton
@@ -164,7 +164,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         logger.setLevel(logging.ERROR)
 
         # initialize custom things
-        self.dbConnection = CandidateDatabase("files/candidate database.db", "Maestro")
+        self.dbConnection = CandidateDatabase("files/candidate database.db", "Maestro", readOnly=True)
         self.processModel = ProcessModel(statusBar=self.statusBar())
         self.ephemListModel = FlexibleListModel()
         self.settings = Settings("./MaestroCore/settings.txt")
@@ -183,6 +183,8 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.candidates = None
         self.candidateDf = None
         self.candidatesByID = None
+        self.changeWatermark = None  # from the database, as of the last time the candidates were loaded or updated
+        self.candidatesShowAll = None  # whether the loaded candidates are the whole table or the last 36 hours
         self.ephemProcess = None
         self.ephemProcessIDs = []
         self.databaseProcess = None
@@ -294,7 +296,7 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         if debug:
             self.databaseProcess.msg.connect(lambda message: print(message))
         self.databaseProcess.msg.connect(self.dbStatusChecker)
-        self.databaseProcess.ended.connect(self.getTargets)
+        self.databaseProcess.ended.connect(self.updateTargets)
 
         self.databaseProcess.start("python", ['./MaestroCore/database.py', json.dumps(self.settings.asDict())])
 
@@ -406,16 +408,46 @@ class MainWindow(QMainWindow, Ui_MainWindow):
         self.tabWidget.setCurrentWidget(self.tabWidget.findChild(QWidget, "ephemsTab"))
 
     def getTargets(self):
-        self.candidates = self.dbConnection.table_query("Candidates", "*",
-                                                        "DateAdded > ?" if not self.settings.query("showAllCandidates")[
-                                                            0] else "1=1",
-                                                        [datetime.utcnow() - timedelta(hours=36)] if not
-                                                        self.settings.query("showAllCandidates")[0] else [],
-                                                        returnAsCandidates=True)
+        showAll = self.settings.query("showAllCandidates")[0]
+        with self.dbConnection.snapshot():
+            watermark = self.dbConnection.changeWatermark()
+            if showAll:
+                df = self.dbConnection.query_frame()
+            else:
+                df = self.dbConnection.query_frame(timeColumn="DateAdded", after=datetime.utcnow() - timedelta(hours=36))
+        self.changeWatermark, self.candidatesShowAll = watermark, showAll
+        return self.setCandidateFrame(df)
+
+    def updateTargets(self):
+        """
+        Apply the candidates that changed in the database since they were loaded, instead of loading all of them again. Falls back to getTargets if nothing is loaded yet or the showAllCandidates setting has changed
+        """
+        showAll = self.settings.query("showAllCandidates")[0]
+        if self.candidateDf is None or self.changeWatermark is None or showAll != self.candidatesShowAll:
+            return self.getTargets()
+        changes, self.changeWatermark = self.dbConnection.candidatesChangedSince(self.changeWatermark, asFrame=True)
+        if changes.empty:
+            return self
+        df = applyChanges(self.candidateDf, changes)
+        if not showAll:  # candidates age out of the window too
+            df = df[df["DateAdded"] > pd.Timestamp(datetime.utcnow() - timedelta(hours=36))]
+        return self.setCandidateFrame(df)
+
+    def setCandidateFrame(self, df):
+        """
+        Make the frame of candidates (as from CandidateDatabase.query_frame) the loaded candidates
+        """
+        if df.empty:
+            self.candidates = self.candidateDf = None
+            return self
+        # match the layout the table has always had: name and type first, and no columns that are empty for every candidate
+        df = df.dropna(axis=1, how="all")
+        df = df[["CandidateName", "CandidateType"] + [c for c in df.columns if c not in ("CandidateName", "CandidateType")]]
+        self.candidates = LazyCandidateMap(df, "CandidateName")  # Candidates are only built for the rows that get used
         if self.candidates:
-            self.candidateDf = Candidate.candidatesToDf(self.candidates)
-            self.candidatesByID = {c.ID: c for c in self.candidates}
-            self.candidateDict = {c.CandidateName: c for c in self.candidates}
+            self.candidateDf = df
+            self.candidatesByID = LazyCandidateMap(df, "ID")
+            self.candidateDict = self.candidates
             self.indexOfIDColumn = self.candidateDf.columns.get_loc("ID")
             self.indexOfNameColumn = self.candidateDf.columns.get_loc("CandidateName")
         else:
@@ -1,15 +1,16 @@
 from datetime import datetime, timezone, timedelta
 
 import numpy as np
+import pandas as pd
 import pytz
-from astral import LocationInfo, sun, SunDirection
 from astropy.table import Table
 from matplotlib import pyplot as plt
 
 from scheduleLib import genUtils
 from scheduleLib.candidateDatabase import CandidateDatabase, Candidate
 from scheduleLib.genUtils import ScheduleError
-from scheduleLib.mpcUtils import candidatesForTimeRange
+from scheduleLib.nightContext import NightContext
+from schedulerConfigs.MPC_NEO.mpcUtils import candidatesForTimeRange
 
 # most of this is proof-of-concept stuff for the newScheduler, just packaged to be semi-useful as a tool before i implement it
 
@@ -21,11 +22,11 @@ ORANGE = [255, 191, 0]
 PURPLE = [221, 160, 221]
 
 
-def visualizeObservability(candidates: list, beginDt, endDt, schedule=None):
+def visualizeObservability(candidates, beginDt, endDt, schedule=None):
     """
     Visualize the observability windows of candidates as a stacked timeline.
 
-    :param candidates: list of Candidate objects
+    :param candidates: DataFrame of candidates, as from CandidateDatabase.query_frame, or a list of Candidate objects
     :param beginDt: time of beginning of observability window, datetime
     :param endDt: time of edning of observability windows, datetime
     :param schedule: WIP: astropy Table output by a scheduler. if passed, will be overlaid over the graphics.
@@ -33,12 +34,19 @@ def visualizeObservability(candidates: list, beginDt, endDt, schedule=None):
 
     """
     # print(beginDt, endDt)
+    if not isinstance(candidates, pd.DataFrame):
+        candidates = Candidate.candidatesToDf(candidates) if len(candidates) else pd.DataFrame()
+    if "StartObservability" not in candidates.columns or "EndObservability" not in candidates.columns:  # nobody has a window
+        candidates = pd.DataFrame(columns=["CandidateName", "ApproachColor", "StartObservability", "EndObservability"])
     # Filter candidates with observability windows
-    observabilityCandidates = [c for c in candidates if
-                               c.hasField("StartObservability") and c.hasField("EndObservability")]
+    observabilityCandidates = candidates.dropna(subset=["StartObservability", "EndObservability"]).copy()
+    observabilityCandidates["StartObservability"] = pd.to_datetime(observabilityCandidates["StartObservability"],
+                                                                   format="ISO8601")
+    observabilityCandidates["EndObservability"] = pd.to_datetime(observabilityCandidates["EndObservability"],
+                                                                 format="ISO8601")
 
     # Sort candidates by their start times (earliest to latest)
-    observabilityCandidates.sort(key=lambda c: genUtils.stringToTime(c.StartObservability))
+    observabilityCandidates = observabilityCandidates.sort_values(by="StartObservability", kind="stable")
 
     # Calculate start and end timestamps
     xMin, xMax = (beginDt + timedelta(hours=7)).timestamp(), (endDt + timedelta(hours=7)).timestamp()
@@ -64,10 +72,10 @@ def visualizeObservability(candidates: list, beginDt, endDt, schedule=None):
     #     print(df)
 
     # Iterate over observability candidates and plot their windows
-    for i, candidate in enumerate(observabilityCandidates):
+    for i, candidate in enumerate(observabilityCandidates.itertuples(index=False)):
         # TODO: take the time to actually figure out why the UTC stuff doesn't work instead of just applying this hardcoded offset:
-        startTime = genUtils.stringToTime(candidate.StartObservability)  # UTC conversion. this sucks
-        endTime = genUtils.stringToTime(candidate.EndObservability)
+        startTime = candidate.StartObservability.to_pydatetime()  # UTC conversion. this sucks
+        endTime = candidate.EndObservability.to_pydatetime()
 
         # Convert start time and end time to Unix timestamps
         startUnix = startTime.timestamp()
@@ -113,35 +121,18 @@ def visualizeObservability(candidates: list, beginDt, endDt, schedule=None):
 if __name__ == "__main__":
     utc = pytz.UTC
 
-    region = "CA, USA"
-    obsTimezone = "UTC"
-    obsLat = 34.36
-    obsLon = -117.63
-    TMO = LocationInfo(name="TMO", region="CA, USA", timezone="UTC", latitude=34.36,
-                       longitude=-117.63)
-
-    s = sun.sun(TMO.observer, date=datetime.now(timezone.utc), tzinfo=timezone.utc)
-    sunriseUTC = s["sunrise"]
-    sunsetUTC = sun.time_at_elevation(TMO.observer, -10, direction=SunDirection.SETTING)
-
-    nowDt = datetime.utcnow()
-    nowDt = utc.localize(nowDt)
-
-    if sunriseUTC < nowDt:  # if the sunrise we found is earlier than the current time, add one day to it (approximation ofc)
-        sunriseUTC = sunriseUTC + timedelta(days=1)
-    sunriseUTC -= timedelta(hours=1)
-
-    if sunsetUTC > sunriseUTC:
-        sunsetUTC = sunsetUTC - timedelta(days=1)
+    night = NightContext.get()
+    sunriseUTC = night.sunrise - timedelta(hours=1)
+    sunsetUTC = night.sunset
 
     # sunsetUTC += timedelta(hours=2) # this is temporary
 
     print("Sunset:", sunsetUTC)
     print("Sunrise:", sunriseUTC)
 
-    dbConnection = CandidateDatabase("./candidate database.db", "Night Obs Tool")
+    dbConnection = CandidateDatabase("./candidate database.db", "Night Obs Tool", readOnly=True)
 
-    candidates = candidatesForTimeRange(sunsetUTC, sunriseUTC, 1, dbConnection)
+    candidates = candidatesForTimeRange(sunsetUTC, sunriseUTC, 1, dbConnection, asFrame=True)
 
     # print(genUtils.findTransitTime(Angle("18h39m00s"), TMO).strftime("%H:%M"))
     print("Candidates:", candidates)
@@ -150,7 +141,7 @@ if __name__ == "__main__":
         raise ScheduleError()
 
     print("Candidates for tonight(%s):" % len(candidates), candidates)
-    df = Candidate.candidatesToDf(candidates)
+    df = candidates
     # df["TransitTime"] = df.apply(
     #     lambda row: genUtils.findTransitTime(genUtils.ensureAngle(str(row["RA"]) + "h"), TMO).strftime("%H:%M"), axis=1)
     df = genUtils.prettyFormat(df)
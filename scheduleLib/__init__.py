@@ -1 +1 @@
-__all__ = ["sCoreCondensed", "asyncUtils", "mpcTargetSelectorCore", "mpcUtils", "genUtils", "candidateDatabase", "processes"]
+__all__ = ["sCoreCondensed", "asyncUtils", "mpcTargetSelectorCore", "mpcUtils", "genUtils", "candidateDatabase", "processes", "timeUtils", "angleUtils", "nightContext"]
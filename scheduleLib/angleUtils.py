@@ -0,0 +1,109 @@
+# Sage Santomenna 2023
+# plain-float conversions for the coordinates that the candidate database and MPC pages are full of, so per-candidate code doesn't build (and string-parse) an astropy Angle for every value
+# degrees are the common currency: RA is stored in decimal hours, Dec in decimal degrees. use astropy only where Angle semantics are actually needed
+import functools
+import re
+
+import numpy as np
+
+DEGREES = "deg"
+HOURS = "hour"
+
+_number = r"(\d+(?:\.\d*)?|\.\d+)"
+# '12h30m15.5s', '284d0m0s', '-12d30m', '12.5h', '+5d' - the forms astropy's parser accepts that we write
+_lettered = re.compile(r"^([+-]?)" + _number + r"([hd°])(?:" + _number + r"[m'](?:" + _number + r"[s\"]?)?|" + _number + r")?$")
+# '12 30 15.5', '12:30:15.5', '-45', '5.5' - the unit has to come from the caller
+_separated = re.compile(r"^([+-]?)" + _number + r"(?:[: ]" + _number + r"(?:[: ]" + _number + r")?)?$")
+
+
+@functools.lru_cache(maxsize=8192)
+def parseAngle(angleString, unit=DEGREES):
+    """
+    Parse an angle string like '12h30m15.5s', '284d0m0s', '-00 30 00', '12:30:15.5' or '5.5' without astropy
+    :param angleString: str
+    :param unit: DEGREES or HOURS: the unit of a string that doesn't name its own, or None to refuse such strings (as astropy's Angle does)
+    :return: tuple (value, unit) where value is a float in unit, which is DEGREES or HOURS
+    :raises ValueError: if angleString isn't in one of those forms, or has no unit and none was given
+    """
+    s = angleString.strip()
+    match = _lettered.match(s.replace(" ", ""))
+    if match:
+        sign, whole, letter, minutes, seconds, fraction = match.groups()
+        unit = HOURS if letter == "h" else DEGREES
+        fields = [whole, minutes, seconds] if fraction is None else [whole, fraction]
+    else:
+        match = _separated.match(re.sub(r"\s+", " ", s))
+        if not match:
+            raise ValueError("Can't parse " + repr(angleString) + " as an angle")
+        if unit is None:
+            raise ValueError("No unit given for " + repr(angleString))
+        sign, whole, minutes, seconds = match.groups()
+        fields = [whole, minutes, seconds]
+    if len(fields) == 2:  # '12h30' is 12 hours and 30 minutes, like astropy reads it
+        fields.append(None)
+    value = float(fields[0])
+    if fields[1] is not None:
+        value += float(fields[1]) / 60
+    if fields[2] is not None:
+        value += float(fields[2]) / 3600
+    return (-value if sign == "-" else value), unit
+
+
+def toDegrees(values, unit=DEGREES):
+    """
+    Convert angles to decimal degrees with plain floats
+    :param values: float, int, or string (as parseAngle), or an array-like of them
+    :param unit: DEGREES or HOURS: the unit of numbers and of strings that don't name their own
+    :return: float, or numpy float array if values was array-like
+    """
+    if isinstance(values, str):
+        value, valueUnit = parseAngle(values, unit)
+        return value * 15 if valueUnit == HOURS else value
+    if np.ndim(values) == 0:
+        return float(values) * 15 if unit == HOURS else float(values)
+    array = np.asarray(values)
+    if array.dtype.kind in "OSU":  # some (or all) are strings
+        return np.array([toDegrees(v.item() if isinstance(v, np.generic) else v, unit) for v in array.ravel()],
+                        dtype=float).reshape(array.shape)
+    array = array.astype(float)
+    return array * 15 if unit == HOURS else array
+
+
+def toHours(values, unit=DEGREES):
+    """
+    Convert angles to decimal hours with plain floats. see toDegrees
+    """
+    return toDegrees(values, unit) / 15
+
+
+def sexagesimalString(value, sep=":"):
+    """
+    Format a decimal value as sexagesimal (degrees, arcminutes, arcseconds for degrees; hours, minutes, seconds for hours), exactly as astropy's Angle.to_string does with the default precision
+    :param value: float, in the unit to be shown
+    :param sep: separator between the fields
+    :return: str
+    """
+    sign = np.copysign(1.0, value)
+    fraction, whole = np.modf(np.fabs(value))
+    minuteFraction, minutes = np.modf(fraction * 60.0)
+    seconds = abs(minuteFraction * 60.0)
+    whole, minutes = float(np.floor(whole)), float(np.floor(minutes))
+    if round(float(seconds), 8) >= 60.0:  # carry, as astropy does, instead of showing 60 seconds
+        seconds = 0.0
+        minutes += 1.0
+    if minutes >= 60.0:
+        minutes = 0.0
+        whole += 1.0
+    secondString = f"{seconds:.8f}".rstrip("0").rstrip(".")
+    if len(secondString) == 1 or secondString[1] == ".":
+        secondString = "0" + secondString
+    return f"{np.copysign(whole, sign):.0f}" + sep + f"{int(minutes):02d}" + sep + secondString
+
+
+def sexagesimalStrings(values, sep=":"):
+    """
+    sexagesimalString for a whole column at once
+    :param values: array-like of floats, in the unit to be shown
+    :return: list of str
+    """
+    return [sexagesimalString(v, sep) for v in np.asarray(values, dtype=float)]
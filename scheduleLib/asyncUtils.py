@@ -1,20 +1,205 @@
 # Sage Santomenna, 2023
 import asyncio
+import html
 import logging
+import random
+import re
+import time
+from collections import deque, namedtuple
 
 import httpx
 from bs4 import BeautifulSoup
 
+# one entry per completed request (including any retries). status is None if no response was ever received
+RequestTiming = namedtuple("RequestTiming", ["desig", "url", "seconds", "attempts", "status"])
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+_PRE_PATTERN = re.compile(r"<pre\b[^>]*>(.*?)</pre\s*>", re.IGNORECASE | re.DOTALL)
+_ANCHOR_PATTERN = re.compile(r"<a\b([^>]*)>(.*?)</a\s*>", re.IGNORECASE | re.DOTALL)
+_HREF_PATTERN = re.compile(r"""\bhref\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s>]+))""", re.IGNORECASE)
+_OTHER_TAG_PATTERN = re.compile(r"<(?!/?a\b)[a-zA-Z!/?]", re.IGNORECASE)  # any markup other than <a> and </a>
+
+
+class Anchor:
+    """
+    A link pulled out of a <pre> block. Supports .get(attribute) like a BeautifulSoup Tag, for the attributes we keep
+    """
+    __slots__ = ("href", "text")
+
+    def __init__(self, href, text):
+        self.href = href
+        self.text = text
+
+    def get(self, attribute, default=None):
+        if attribute == "href" and self.href is not None:
+            return self.href
+        return default
+
+    def get_text(self):
+        return self.text
+
+    def __repr__(self):
+        return "Anchor(" + repr(self.href) + ", " + repr(self.text) + ")"
+
+
+class PreBlock:
+    """
+    The contents of the first <pre> block of a page: the same sequence of text and links as BeautifulSoup's pre.contents, with text as str and links as Anchors
+    """
+    __slots__ = ("contents",)
+
+    def __init__(self, contents):
+        self.contents = contents
+
+    @property
+    def hrefs(self):
+        return [c.href for c in self.contents if isinstance(c, Anchor) and c.href is not None]
+
+    def get_text(self):
+        return "".join(c if isinstance(c, str) else c.text for c in self.contents)
+
+    def textWithoutLinks(self):
+        """
+        The text of the block with all links (and their text) removed
+        """
+        return "".join(c if isinstance(c, str) else c.text for c in self.contents if
+                       not (isinstance(c, Anchor) and c.href is not None))
+
+    @classmethod
+    def fromSoup(cls, content):
+        """
+        Make a PreBlock by fully parsing the page with BeautifulSoup. Slow, but handles any markup
+        :param content: bytes or str of the page
+        :return: PreBlock, or None if the page has no <pre> block
+        """
+        pre = BeautifulSoup(content, 'html.parser').find_all('pre')
+        if not len(pre):
+            return None
+        contents = []
+        for c in pre[0].contents:
+            if isinstance(c, str):
+                contents.append(str(c))
+            elif c.name == "a":
+                contents.append(Anchor(c.get("href"), c.get_text()))
+            else:
+                contents.append(c.get_text())
+        return cls(contents)
+
+
+def extractPre(content):
+    """
+    Pull the first <pre> block (and the links in it) out of a page without building a full soup. Falls back to BeautifulSoup if the block holds markup other than links (anywhere, including inside a link) or the page isn't utf-8
+    :param content: bytes or str of the page
+    :return: PreBlock, or None if the page has no <pre> block
+    """
+    try:
+        text = content.decode("utf-8") if isinstance(content, bytes) else content
+    except UnicodeDecodeError:
+        return PreBlock.fromSoup(content)
+    match = _PRE_PATTERN.search(text)
+    if match is None:
+        return None
+    inner = match.group(1)
+    if _OTHER_TAG_PATTERN.search(inner):  # checked on the whole block, so tags inside link text count too
+        return PreBlock.fromSoup(content)
+
+    contents = []
+    position = 0
+    for anchor in _ANCHOR_PATTERN.finditer(inner):
+        if anchor.start() > position:
+            contents.append(html.unescape(inner[position:anchor.start()]))
+        href = _HREF_PATTERN.search(anchor.group(1))
+        if href is not None:
+            href = html.unescape(next(g for g in href.groups() if g is not None))
+        contents.append(Anchor(href, html.unescape(anchor.group(2))))
+        position = anchor.end()
+    if position < len(inner):
+        contents.append(html.unescape(inner[position:]))
+    return PreBlock(contents)
+
+
+async def streamTasks(tasks):
+    """
+    Yield the results of tasks as they complete. If the caller stops early (or is cancelled), the tasks still running are cancelled
+    :param tasks: list of asyncio tasks
+    :return: yields each task's result, in order of completion
+    """
+    try:
+        for nextResult in asyncio.as_completed(tasks):
+            yield await nextResult
+    finally:  # if the caller stops early, don't leave requests running
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+
+class TokenBucket:
+    """
+    A simple token bucket rate limiter for use inside a single event loop.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        :param rate: tokens (requests) added per second
+        :param capacity: maximum number of tokens that can accumulate (burst size). Defaults to max(1, rate)
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity) if capacity is not None else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.lastRefill = time.monotonic()
+
+    async def acquire(self):
+        """
+        Take one token, sleeping until it is available. Tokens are reserved before sleeping (the balance can go negative), so waiters are served in order without needing a lock
+        """
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.lastRefill) * self.rate)
+        self.lastRefill = now
+        self.tokens -= 1
+        if self.tokens < 0:
+            await asyncio.sleep(-self.tokens / self.rate)
+
 
 class AsyncHelper:
     """
     A helper class to facilitate easier asynchronous requesting.
     """
 
-    def __init__(self, followRedirects: bool,timeout=120):
+    def __init__(self, followRedirects: bool, timeout=120, maxConcurrent=10, maxConnections=20, maxKeepalive=10,
+                 keepaliveExpiry=30, retries=3, backoffBase=0.5, backoffMax=10, requestsPerSecond=None,
+                 burst=None, latencyHistory=2000, transport=None):
+        """
+        :param followRedirects: bool. follow redirects
+        :param timeout: request timeout, in seconds
+        :param maxConcurrent: maximum number of requests in flight at once
+        :param maxConnections: maximum number of pooled connections held by the client
+        :param maxKeepalive: maximum number of idle keep-alive connections held by the client
+        :param keepaliveExpiry: seconds an idle keep-alive connection is held before it is closed
+        :param retries: number of times to retry a request that failed with a connection error, timeout, or retryable status code
+        :param backoffBase: base delay, in seconds, of the exponential backoff between retries
+        :param backoffMax: maximum delay, in seconds, between retries
+        :param requestsPerSecond: if not None, limit requests to each host to this rate
+        :param burst: number of requests to each host that can be made at once before the rate limit kicks in
+        :param latencyHistory: number of RequestTimings to keep in self.latencies
+        :param transport: optional httpx transport to send requests through instead of the network (see scheduleLib.httpFixtures). Pool limits don't apply to custom transports
+        """
         self.timeout = timeout
-        self.client = httpx.AsyncClient(follow_redirects=followRedirects, timeout=self.timeout)
+        self.maxConcurrent = maxConcurrent
+        self.retries = retries
+        self.backoffBase = backoffBase
+        self.backoffMax = backoffMax
+        self.requestsPerSecond = requestsPerSecond
+        self.burst = burst
+        limits = httpx.Limits(max_connections=maxConnections, max_keepalive_connections=maxKeepalive,
+                              keepalive_expiry=keepaliveExpiry)
+        self.client = httpx.AsyncClient(follow_redirects=followRedirects, timeout=self.timeout, limits=limits,
+                                        transport=transport)
         self.logger = logging.getLogger(__name__)
+        self.latencies = deque(maxlen=latencyHistory)
+        self._buckets = {}  # {host: TokenBucket}
+        self._semaphore = None
+        self._semaphoreLoop = None
 
     def __del__(self):
         # Close connection when this object is destroyed
@@ -27,16 +212,47 @@ class AsyncHelper:
         except Exception:
             pass
 
-    async def multiGet(self, URLlist, designations=None, soup=False, postContent=None):
+    def _getSemaphore(self):
+        # Internal: asyncio primitives belong to one event loop, so make a new semaphore if we've moved to a new loop
+        loop = asyncio.get_running_loop()
+        if self._semaphore is None or self._semaphoreLoop is not loop:
+            self._semaphore = asyncio.Semaphore(self.maxConcurrent)
+            self._semaphoreLoop = loop
+        return self._semaphore
+
+    async def _throttle(self, url):
+        # Internal: wait for the per-host rate limit, if one is set
+        if self.requestsPerSecond is None:
+            return
+        host = httpx.URL(url).host
+        if host not in self._buckets:
+            self._buckets[host] = TokenBucket(self.requestsPerSecond, self.burst)
+        await self._buckets[host].acquire()
+
+    def _backoff(self, attempt):
+        # Internal: exponential backoff with jitter, in seconds
+        delay = min(self.backoffMax, self.backoffBase * 2 ** attempt)
+        return random.uniform(delay / 2, delay)
+
+    def latencyStats(self):
         """
-        Asynchronously make multiple url requests. Optionally, turn the result into soup with beautifulSoup. Requires internet connection
-        :param URLlist: A list of URLs to query
-        :param designations: An optional list of designations to be paired with request results in the return dictionary. If none, urls will be used as designations
-        :param soup: bool. If true, soup result before returning
-        :param postContent: list. if not none, will post postContent instead of using get
-        :return: dictionary of {desig/url: completed request} or {desig/url:html soup retrieved}
+        Summarize the recorded per-request latencies
+        :return: dictionary of {"count", "failed", "mean", "p50", "p95", "max", "retried"}, with latencies in seconds, or None if nothing has been recorded
         """
+        if not len(self.latencies):
+            return None
+        seconds = sorted(t.seconds for t in self.latencies)
+        n = len(seconds)
+        return {"count": n,
+                "failed": sum(1 for t in self.latencies if t.status != 200),
+                "mean": sum(seconds) / n,
+                "p50": seconds[n // 2],
+                "p95": seconds[min(n - 1, int(n * 0.95))],
+                "max": seconds[-1],
+                "retried": sum(1 for t in self.latencies if t.attempts > 1)}
 
+    def _startRequests(self, URLlist, designations, soup, postContent, pre=False):
+        # Internal: validate the arguments shared by multiGet and streamGet, then create a task for each request
         if designations is not None and len(designations) != len(URLlist):
             raise ValueError("asyncMultiRequest: provided designation length does not match url list length")
         if postContent is not None and len(postContent) != len(URLlist):
@@ -49,7 +265,21 @@ class AsyncHelper:
         tasks = []
         for i, url in enumerate(URLlist):
             tasks.append(
-                asyncio.create_task(self.makeRequest(designations[i], url, soup=soup, postContent=postContent[i])))
+                asyncio.create_task(
+                    self.makeRequest(designations[i], url, soup=soup, postContent=postContent[i], pre=pre)))
+        return tasks
+
+    async def multiGet(self, URLlist, designations=None, soup=False, postContent=None, pre=False):
+        """
+        Asynchronously make multiple url requests. Optionally, turn the result into soup with beautifulSoup. Requires internet connection
+        :param URLlist: A list of URLs to query
+        :param designations: An optional list of designations to be paired with request results in the return dictionary. If none, urls will be used as designations
+        :param soup: bool. If true, soup result before returning
+        :param postContent: list. if not none, will post postContent instead of using get
+        :param pre: bool. If true, return only the first <pre> block of each page, as a PreBlock (see extractPre). Much faster than soup
+        :return: dictionary of {desig/url: completed request} or {desig/url:html soup retrieved}
+        """
+        tasks = self._startRequests(URLlist, designations, soup, postContent, pre)
         result = await asyncio.gather(*tasks)
 
         # gather tuples returned into dictionary, return
@@ -58,29 +288,74 @@ class AsyncHelper:
             returner.setdefault(desig, []).append(item)
         return returner
 
-    async def makeRequest(self, desig, url, soup=False, postContent=None):
+    async def streamGet(self, URLlist, designations=None, soup=False, postContent=None, pre=False):
+        """
+        Like multiGet, but an async generator that yields each result as soon as its request completes, so the caller can start processing early arrivals while slow requests are still in flight. Requires internet connection
+        :param URLlist: A list of URLs to query
+        :param designations: An optional list of designations to be paired with request results. If none, urls will be used as designations
+        :param soup: bool. If true, soup result before yielding
+        :param postContent: list. if not none, will post postContent instead of using get
+        :param pre: bool. If true, yield only the first <pre> block of each page, as a PreBlock (see extractPre). Much faster than soup
+        :return: yields tuples (desig/url, completed request) or (desig/url, html soup retrieved), in order of completion. The request is None if it failed
+        """
+        stream = streamTasks(self._startRequests(URLlist, designations, soup, postContent, pre))
+        try:
+            async for result in stream:
+                yield result
+        finally:  # close it now, rather than whenever it's collected, so the requests are cancelled right away
+            await stream.aclose()
+
+    async def makeRequest(self, desig, url, soup=False, postContent=None, pre=False):
         """
         Asynchronously GET or POST to the indicated URL. Optionally, turn the result into soup with beautifulSoup. Calling this in a for loop probably won't work like you want it to, use multiGet for concurrent requests
+        At most maxConcurrent requests are in flight at once. Failed requests are retried with exponential backoff, and the time taken is recorded in self.latencies
         :param desig: An identifying designation for the html retrieved
         :param url: The URL to query
         :param soup: bool. If true, soup result before returning
         :param postContent: list. if not none, will POST postContent instead of using get
-        :return: A tuple, (desig, completedRequest) or (desig,soup(completedRequest))
+        :param pre: bool. If true, return only the first <pre> block of the page, as a PreBlock. Takes precedence over soup
+        :return: A tuple, (desig, completedRequest), (desig,soup(completedRequest)), or (desig, PreBlock)
         """
-        try:
-            if postContent is not None:
-                offsetReq = await self.client.post(url, data=postContent)
-            else:
-                offsetReq = await self.client.get(url)
-        except (httpx.ConnectError, httpx.HTTPError):
-            self.logger.exception("HTTP error. Unable to make async request to " + url)
+        offsetReq = None
+        attempt = 0
+        startTime = time.perf_counter()
+        async with self._getSemaphore():
+            while True:
+                await self._throttle(url)
+                try:
+                    if postContent is not None:
+                        offsetReq = await self.client.post(url, data=postContent)
+                    else:
+                        offsetReq = await self.client.get(url)
+                except httpx.TimeoutException:
+                    self.logger.warning("Async request to " + url + " timed out (attempt " + str(
+                        attempt + 1) + "). Timeout is set to " + str(self.timeout) + " seconds.")
+                    offsetReq = None
+                except (httpx.ConnectError, httpx.HTTPError):
+                    self.logger.warning("HTTP error on async request to " + url + " (attempt " + str(attempt + 1) + ")",
+                                        exc_info=True)
+                    offsetReq = None
+                if offsetReq is not None and offsetReq.status_code not in RETRY_STATUS_CODES:
+                    break
+                if attempt >= self.retries:
+                    break
+                await asyncio.sleep(self._backoff(attempt))
+                attempt += 1
+
+        self.latencies.append(RequestTiming(desig, url, time.perf_counter() - startTime, attempt + 1,
+                                            offsetReq.status_code if offsetReq is not None else None))
+        if offsetReq is None:
+            self.logger.error("Unable to make async request to " + url + " after " + str(attempt + 1) + " attempt(s)")
             return desig, None
-        except httpx.TimeoutException:
-            self.logger.exception("Async request timed out. Timeout is set to "+str(self.timeout)+" seconds.")
         if offsetReq.status_code != 200:
             self.logger.error("Error: HTTP status code " + str(offsetReq.status_code) + ". Unable to make async request to " +
-                        url + ". Reason given: " + offsetReq.reason_phrase)
+                              url + ". Reason given: " + offsetReq.reason_phrase)
             return desig, None
+        if pre:
+            block = extractPre(offsetReq.content)
+            if block is None:
+                self.logger.warning("No <pre> block in response from " + url)
+            return desig, block
         if soup:
             offsetReq = BeautifulSoup(offsetReq.content, 'html.parser')
         return tuple([desig, offsetReq])
@@ -1,15 +1,24 @@
+import asyncio
+import calendar
+import functools
+import hashlib
 import logging
 import os
 import pandas as pd
 import pytz
 import sqlite3
+import threading
 from collections import OrderedDict
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from string import Template
+from urllib.request import pathname2url
 
 from photometrics.sql_database import SQLDatabase
 
-from scheduleLib import genUtils
+from scheduleLib import genUtils, dbMigrations
 
 validFields = ["ID", "Author", "DateAdded", "DateLastEdited", "RemovedDt", "RemovedReason", "RejectedReason", 'Night',
                'Updated', 'StartObservability', 'EndObservability', 'TransitTime', 'RA', 'Dec', 'dRA', 'dDec',
@@ -19,35 +28,203 @@ validFields = ["ID", "Author", "DateAdded", "DateLastEdited", "RemovedDt", "Remo
                'CVal1', 'CVal2', 'CVal3', 'CVal4', 'CVal5', 'CVal6', 'CVal7', 'CVal8', 'CVal9', 'CVal10']
 
 
+epochColumns = dbMigrations.EPOCH_COLUMNS  # each has an integer twin, "<column>Epoch", that CandidateDatabase keeps in sync
+
+# when a candidate last changed. every write through CandidateDatabase sets DateLastEdited (or DateAdded, for new rows)
+changeColumn = 'COALESCE("DateLastEditedEpoch", "DateAddedEpoch")'
+# seconds that candidatesChangedSince reaches back past its watermark, to catch writes that were timestamped before they committed
+changeOverlap = 60
+# fields that upsertCandidates clears when it adds a candidate again: they describe the candidate's last stay in the database, not this one
+readdNulledFields = ["RemovedReason", "RemovedDt", "RejectedReason", "StartObservability", "StartObservabilityEpoch",
+                     "EndObservability", "EndObservabilityEpoch"]
+
+
+def toEpoch(value):
+    """
+    Convert a UTC datetime or time string to integer seconds since the unix epoch, for the *Epoch columns. Naive datetimes are taken as UTC
+    :return: int, or None if value is None or can't be parsed
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value.strip())
+        except ValueError:
+            return None
+    if not isinstance(value, datetime):
+        return None
+    if value.tzinfo is not None:
+        return int(value.timestamp() // 1)
+    return calendar.timegm(value.timetuple())
+
+
+def _withEpochs(row: dict):
+    """
+    Internal: add the *Epoch twin of each datetime column in the row, in place
+    :return: the row
+    """
+    for column in epochColumns:
+        if column in row.keys():
+            row[column + "Epoch"] = toEpoch(row[column])
+    return row
+
+
 # MPC target's Name	Processed	Submitted	approx. transit time (@TMO)	RA	Dec	RA Vel ("/min)	Dec Vel ("/min)	Vmag	~Error (arcsec)	Error Color
 # CandidateName, Processed, Submitted, TransitTime, RA, Dec, dRA, dDec, Magnitude, RMSE
 def generateID(candidateName, candidateType, author):
-    hashed = str(hash(candidateName + candidateType + author))
-    return int(hashed)
+    """
+    The ID of a candidate: a digest of its name, type, and author, so the same candidate gets the same ID in every process (unlike hash(), which is salted per process). Fits in sqlite's signed 64-bit INTEGER
+    :return: int
+    """
+    digest = hashlib.sha256("\x1f".join([candidateName, candidateType, author]).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") >> 1
+
+
+numericFields = ["ID", "RA", "Dec", "dRA", "dDec", "Magnitude", "RMSE_RA", "RMSE_Dec", "Score", "nObs", "NumExposures",
+                 "ExposureTime", "Scheduled", "Observed", "Processed", "Submitted"]
+integerFields = ["ID", "Score", "nObs", "NumExposures", "Scheduled", "Observed", "Submitted"]
+timeFields = ["DateAdded", "DateLastEdited", "RemovedDt", "StartObservability", "EndObservability", "TransitTime",
+              "Updated"]
+
+
+def _parseField(field, value):
+    """
+    Internal: convert a stored field value to its native type - float (int for ID) for numeric fields, naive UTC datetime for time fields. Values that don't parse are returned unchanged
+    """
+    if value is None or not isinstance(value, str):
+        return value
+    if field in numericFields:
+        try:
+            return int(value) if field == "ID" else float(value)
+        except ValueError:
+            return value
+    if field in timeFields:
+        try:
+            return datetime.fromisoformat(value.strip())
+        except ValueError:
+            return value
+    return value
+
+
+candidateFields = ["CandidateName", "CandidateType"] + validFields
+_fieldBits = {field: 1 << i for i, field in enumerate(candidateFields)}
+
+
+_masks = {}  # candidates with the same set of fields share one mask int, instead of each holding their own
+
+
+def _sharedMask(mask):
+    return _masks.setdefault(mask, mask)
+
+
+def _countBits(n):
+    return bin(n).count("1")
+
+
+class _Parsed:
+    # Internal: a field's value as it was given, with its native value, once Candidate.typed has parsed it
+    __slots__ = ("raw", "value")
+
+    def __init__(self, raw, value):
+        self.raw = raw
+        self.value = value
 
 
 # noinspection PyUnresolvedReferences
 class Candidate:
+    # fields live in one list, in candidateFields order, with a bitmask of which ones the candidate has - far smaller than an instance __dict__. typed swaps a field's entry for a _Parsed, so each field is parsed at most once
+    __slots__ = ("_present", "_values")
+
     def __init__(self, CandidateName: str, CandidateType: str, **kwargs):
-        self.CandidateName = CandidateName
-        self.CandidateType = CandidateType
+        fields = {"CandidateName": CandidateName, "CandidateType": CandidateType}
         for key, value in kwargs.items():
             if key in validFields:
-                self.__dict__[key] = str(value)
+                fields[key] = str(value)
             else:
                 raise ValueError(
                     "Bad argument: " + key + " is not a valid argument for candidate construction. Valid arguments are " + str(
                         validFields))
+        self._setFields(fields)
+
+    def _setFields(self, fields):
+        # Internal: replace every field with those in the dict fields
+        present = 0
+        for key in fields.keys():
+            present |= _fieldBits[key]
+        keys = sorted(fields.keys(), key=_fieldBits.__getitem__)
+        values = [None] * len(keys)  # sized exactly, unlike a list that's appended to
+        for i, key in enumerate(keys):
+            values[i] = fields[key]
+        object.__setattr__(self, "_present", _sharedMask(present))
+        object.__setattr__(self, "_values", values)
+
+    def _index(self, field):
+        # Internal: position of field in _values, or None if the candidate doesn't have it
+        bit = _fieldBits.get(field)
+        if bit is None or not self._present & bit:
+            return None
+        return _countBits(self._present & (bit - 1))
+
+    def __getattr__(self, name):
+        # only called when normal lookup fails, so this is just for fields
+        i = self._index(name) if not name.startswith("_") else None
+        if i is None:
+            raise AttributeError("Candidate has no field " + name)
+        value = self._values[i]
+        return value.raw if type(value) is _Parsed else value
+
+    def __setattr__(self, name, value):
+        bit = _fieldBits.get(name)
+        if bit is None:
+            raise AttributeError("Can't set " + name + ": not a valid candidate field. Valid fields are " + str(candidateFields))
+        i = _countBits(self._present & (bit - 1))
+        if self._present & bit:
+            self._values[i] = value
+        else:
+            self._values.insert(i, value)
+            object.__setattr__(self, "_present", _sharedMask(self._present | bit))
+
+    def __delattr__(self, name):
+        i = self._index(name)
+        if i is None:
+            raise AttributeError("Candidate has no field " + name)
+        del self._values[i]
+        object.__setattr__(self, "_present", _sharedMask(self._present & ~_fieldBits[name]))
+
+    def __getstate__(self):
+        return self.asDict()
+
+    def __setstate__(self, state):
+        self._setFields(dict(state))
 
     def __str__(self):
-        return str(dict(self.__dict__))
+        return str(self.asDict())
 
     def __repr__(self):
-        return "Candidate " + self.asDict()[
-            "CandidateName"] + " (" + self.CandidateType + ")"  # can't print self.CandidateName directly for whatever reason
+        return "Candidate " + self.CandidateName + " (" + self.CandidateType + ")"
 
     def asDict(self):
-        return self.__dict__.copy()
+        present = self._present
+        fields = [field for field in candidateFields if present & _fieldBits[field]]
+        return {field: value.raw if type(value) is _Parsed else value for field, value in zip(fields, self._values)}
+
+    def typed(self, field, default=None):
+        """
+        The value of a field converted to its native type (float, int for ID, or datetime for times), parsed once and kept
+        :param default: returned if the candidate doesn't have the field
+        """
+        i = self._index(field)
+        if i is None:
+            return default
+        value = self._values[i]
+        if type(value) is _Parsed:
+            return value.value
+        parsed = _parseField(field, value)
+        if parsed is not value:
+            self._values[i] = _Parsed(value, parsed)
+        return parsed
 
     @classmethod
     def fromDatabaseEntry(cls, entry: dict):
@@ -62,7 +239,7 @@ class Candidate:
             if key in validFields:
                 d[key] = value
 
-        return cls(CandidateName, CandidateType, **entry)  # splat
+        return cls(CandidateName, CandidateType, **d)  # splat
 
     @staticmethod
     def candidatesToDf(candidateList: list):
@@ -74,8 +251,26 @@ class Candidate:
         df = pd.DataFrame(seriesList, columns=keys)
         return df
 
+    @classmethod
+    def fromFrameRow(cls, row):
+        """
+        Build a Candidate from one row of a frame from CandidateDatabase.query_frame. Null columns are left out, as with fromDatabaseEntry
+        :param row: pandas Series
+        """
+        entry = {}
+        for key, value in row.items():
+            if value is None or (not isinstance(value, str) and pd.isna(value)):
+                continue
+            if isinstance(value, pd.Timestamp):
+                value = genUtils.timeToString(value.to_pydatetime())
+            elif isinstance(value, float) and value.is_integer() and key in integerFields:
+                value = int(value)
+            entry[key] = value
+        return cls.fromDatabaseEntry(entry)
+
     def hasField(self, field):
-        return field in self.__dict__.keys()
+        bit = _fieldBits.get(field)
+        return bit is not None and bool(self._present & bit)
 
     def isAfterStart(self, dt: datetime):
         """
@@ -84,7 +279,7 @@ class Candidate:
         """
         dt = genUtils.stringToTime(dt)  # ensure that we have a datetime object
         if self.hasField("startObservability"):
-            if dt > genUtils.stringToTime(self.startObservability):
+            if dt > genUtils.stringToTime(self.typed("startObservability")):
                 return True
         return False
 
@@ -94,7 +289,7 @@ class Candidate:
         :return: bool
         """
         if self.hasField("endObservability"):
-            if dt > genUtils.stringToTime(self.endObservability):
+            if dt > genUtils.stringToTime(self.typed("endObservability")):
                 return True
         return False
 
@@ -110,8 +305,8 @@ class Candidate:
             end).replace(tzinfo=pytz.UTC)  # ensure we have datetime object
 
         if self.hasField("StartObservability") and self.hasField("EndObservability"):
-            startObs = genUtils.stringToTime(self.StartObservability).replace(tzinfo=pytz.UTC)
-            endObs = genUtils.stringToTime(self.EndObservability).replace(tzinfo=pytz.UTC)
+            startObs = genUtils.stringToTime(self.typed("StartObservability")).replace(tzinfo=pytz.UTC)
+            endObs = genUtils.stringToTime(self.typed("EndObservability")).replace(tzinfo=pytz.UTC)
             # print(start, end)
             # print(startObs, endObs)
             if start < endObs <= end or start < startObs <= end:  # the windows do overlap
@@ -130,6 +325,34 @@ class Candidate:
             return False
 
 
+class LazyCandidateMap(Mapping):
+    """
+    Read-only {key: Candidate} over the rows of a frame from CandidateDatabase.query_frame. Each Candidate is built the first time it's looked up, so loading a big table doesn't construct thousands of objects nobody asks for
+    """
+
+    def __init__(self, df, keyColumn="CandidateName"):
+        """
+        :param keyColumn: column to key by. if it has duplicates, the last row wins
+        """
+        self._df = df
+        self._rows = {key: i for i, key in enumerate(df[keyColumn])}
+        self._built = {}
+
+    def __getitem__(self, key):
+        if key not in self._built:
+            self._built[key] = Candidate.fromFrameRow(self._df.iloc[self._rows[key]])
+        return self._built[key]
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+
 def _queryToDict(queryResults):
     """
     Convert SQLite query results to a list of dictionaries.
@@ -140,12 +363,96 @@ def _queryToDict(queryResults):
     return [{k: v for k, v in a.items() if v is not None} for a in dictionary if a]
 
 
+def _timeCondition(column, after, before, condition="", values=()):
+    """
+    Internal: AND bounds on the epoch twin of a datetime column onto a sql condition
+    :return: tuple (condition, values)
+    """
+    if column not in epochColumns:
+        raise ValueError(str(column) + " has no epoch column. Options are " + str(epochColumns))
+    clauses, params = [], []
+    if condition:
+        clauses.append("(" + condition + ")")
+        params.extend(values)
+    for bound, operator in ((after, " > ?"), (before, " < ?")):
+        if bound is not None:
+            epoch = toEpoch(bound)
+            if epoch is None:
+                raise ValueError("Can't interpret " + str(bound) + " as a time")
+            clauses.append('"' + column + 'Epoch"' + operator)
+            params.append(epoch)
+    return " AND ".join(clauses), params
+
+
+def _windowCondition(start, end, duration):
+    """
+    Internal: sql condition for a candidate being observable between start and end for at least duration hours, comparing on the epoch columns. Mirrors Candidate.isObservableBetween: either the window starts or ends inside (start, end] and the overlap is long enough, or it spans the whole range and the range is long enough
+    :return: tuple (condition, values)
+    """
+    start, end = toEpoch(start), toEpoch(end)
+    if start is None or end is None:
+        raise ValueError("Can't interpret observability range as times")
+    duration = duration * 3600
+    condition = ('("StartObservabilityEpoch" IS NOT NULL AND "EndObservabilityEpoch" IS NOT NULL AND ('
+                 '(((? < "EndObservabilityEpoch" AND "EndObservabilityEpoch" <= ?) OR (? < "StartObservabilityEpoch" AND "StartObservabilityEpoch" <= ?))'
+                 ' AND MIN(?, "EndObservabilityEpoch") - MAX(?, "StartObservabilityEpoch") >= ?)'
+                 ' OR ("StartObservabilityEpoch" < ? AND "EndObservabilityEpoch" >= ? AND ? - ? >= ?)))')
+    return condition, [start, end, start, end, end, start, duration, start, end, end, start, duration]
+
+
+def _coerceColumn(df, column, convert):
+    """
+    Internal: replace a frame column with convert(column), but only if that doesn't turn any values into nulls
+    """
+    converted = convert(df[column])
+    if converted.notna().sum() == df[column].notna().sum():
+        df[column] = converted
+
+
+def _coerceFrame(df):
+    """
+    Internal: type the numeric and time columns of a frame of candidate rows, in place
+    :return: the frame
+    """
+    for column in df.columns:
+        if column in numericFields and not pd.api.types.is_numeric_dtype(df[column]):
+            _coerceColumn(df, column, lambda col: pd.to_numeric(col, errors="coerce"))
+        elif column in timeFields:
+            _coerceColumn(df, column, lambda col: pd.to_datetime(col, format="ISO8601", errors="coerce"))
+    return df
+
+
+def applyChanges(df, changes, keyColumn="ID"):
+    """
+    Fold the rows from CandidateDatabase.candidatesChangedSince into a frame of candidates from query_frame. Changed rows replace the old ones in place and new rows are added at the end. Applying the same changes more than once gives the same frame
+    :param df: frame to update. not modified
+    :param changes: frame of changed rows
+    :return: new frame
+    """
+    if changes is None or changes.empty:
+        return df
+    if df is None or df.empty:
+        return changes.drop_duplicates(keyColumn, keep="last").reset_index(drop=True)
+    merged = pd.concat([df, changes], ignore_index=True)
+    firstSeen = pd.Series(merged.index, index=merged[keyColumn]).groupby(level=0).min()
+    merged = merged.drop_duplicates(keyColumn, keep="last")
+    merged = merged.iloc[merged[keyColumn].map(firstSeen).argsort()].reset_index(drop=True)
+    return _coerceFrame(merged)
+
+
 class CandidateDatabase(SQLDatabase):
-    def __init__(self, dbPath, author):
+    def __init__(self, dbPath, author, readOnly=False):
+        """
+        :param dbPath: path to the candidate database file
+        :param author: name recorded on candidates this connection adds or removes
+        :param readOnly: open a read-only connection. Readers never take the write lock, and (in WAL mode) never wait on writers
+        """
         super().__init__()
         self.logger = logging.getLogger(__name__)
         self.__author = author
-        self.open(dbPath)
+        self.dbPath = dbPath
+        self.readOnly = readOnly
+        self.open(dbPath, readOnly=readOnly)
         if self.isConnected:
             self.logger.info("Connection confirmed")
         else:
@@ -157,26 +464,33 @@ class CandidateDatabase(SQLDatabase):
             self._releaseDatabase()  # commit anything that might be left if we crash
         except:
             pass
-        self.close()
+        try:
+            self.close()
+        except:
+            pass
 
     @staticmethod
     def timestamp():
         # UTC time in YYYY-MM-DD HH:MM:SS format
         return genUtils.timeToString(datetime.utcnow())
 
-    def open(self, db_file, timeout=5, check_same_thread=False):
+    def open(self, db_file, timeout=5, check_same_thread=False, readOnly=False):
         """
         Establish connection to the candidate database
         :param db_file: Path to the candidate database SHOULD MAKE THIS INTERNAL
         :param check_same_thread: Check if the database should be read by only one thread
+        :param readOnly: open the file read-only. The database is still migrated first, over a short-lived writable connection, if it needs it
         """
         if not os.path.isfile(db_file):
             self.logger.error('Database file %s not found.' % db_file)
             raise ValueError("Database file not found")
+        if readOnly:
+            self._migrateFile(db_file, timeout)
         try:
-            self.db_connection = sqlite3.connect(database=db_file, timeout=timeout, check_same_thread=check_same_thread,
+            database = "file:" + pathname2url(os.path.abspath(db_file)) + "?mode=ro" if readOnly else db_file
+            self.db_connection = sqlite3.connect(database=database, timeout=timeout, check_same_thread=check_same_thread,
                                                  detect_types=sqlite3.PARSE_DECLTYPES |
-                                                              sqlite3.PARSE_COLNAMES)
+                                                              sqlite3.PARSE_COLNAMES, uri=readOnly)
             self.db_connection.row_factory = sqlite3.Row
         except sqlite3.DatabaseError as err:
             self.logger.error('Unable to open sqlite database %s' % db_file)
@@ -187,9 +501,80 @@ class CandidateDatabase(SQLDatabase):
             self.db_cursor = self.db_connection.cursor()
             self.db_cursor.execute('pragma busy_timeout=2000')  # try write commands with a 2-second busy timeout
             self._connected = True
-            self.logger.info("Connected to candidate database")
+            self.logger.info("Connected to candidate database" + (" (read-only)" if readOnly else ""))
+            if not readOnly:
+                self._prepareConnection(self.db_connection)
         return
 
+    def _prepareConnection(self, connection):
+        """
+        Internal: put a writable connection into WAL mode and bring the schema up to date
+        """
+        try:
+            # WAL lets readers keep reading the last committed state while a writer works, instead of waiting on it. the mode is stored in the file, so this only does work the first time
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")  # safe in WAL mode, and skips an fsync per transaction
+        except sqlite3.Error as err:
+            self.logger.warning("Couldn't switch candidate database to WAL mode: " + str(err))
+        try:
+            dbMigrations.migrate(connection, logger=self.logger)  # bring older database files up to date
+        except sqlite3.Error as err:
+            self.logger.error("Couldn't migrate candidate database: " + str(err) + ". Continuing with schema version " + str(dbMigrations.schemaVersion(connection)))
+
+    def _migrateFile(self, db_file, timeout):
+        """
+        Internal: prepare the database file over a temporary writable connection, if its schema is out of date
+        """
+        connection = sqlite3.connect(database=db_file, timeout=timeout)
+        try:
+            if dbMigrations.pendingMigrations(connection):
+                self._prepareConnection(connection)
+        except sqlite3.Error as err:
+            self.logger.error("Couldn't check candidate database schema: " + str(err))
+        finally:
+            connection.close()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Run the block in one explicit write transaction, holding the write lock from the start. Commits at the end, or rolls back if the block raises. Nested uses join the outer transaction
+        """
+        if self.readOnly:
+            raise sqlite3.OperationalError("Can't write through a read-only candidate database connection")
+        if getattr(self, "_transactionDepth", 0):
+            self._transactionDepth += 1
+            try:
+                yield self
+            finally:
+                self._transactionDepth -= 1
+            return
+        if self.db_connection.in_transaction:
+            self.db_connection.commit()  # don't fold earlier, unrelated writes into our rollback
+        self.db_cursor.execute("BEGIN IMMEDIATE")
+        self._transactionDepth = 1
+        try:
+            yield self
+        except:
+            self.db_connection.rollback()
+            raise
+        else:
+            self.db_connection.commit()
+        finally:
+            self._transactionDepth = 0
+
+    @contextmanager
+    def snapshot(self):
+        """
+        Run the block's queries against one consistent snapshot of the database: writes committed by other processes during the block aren't seen. Never takes the write lock
+        """
+        if self.db_connection.in_transaction:
+            self.db_connection.commit()
+        self.db_cursor.execute("BEGIN DEFERRED")
+        try:
+            yield self
+        finally:
+            self.db_connection.rollback()  # nothing to keep - just ends the read transaction
+
     def table_query(self, table_name, columns, condition, values, returnAsCandidates=False):
         """Query table based on condition. If no condition given, will return the whole table - if this isn't what you want, be careful!
         Parameters
@@ -224,6 +609,7 @@ class CandidateDatabase(SQLDatabase):
         candidate["DateAdded"] = CandidateDatabase.timestamp()
         id = generateID(candidate["CandidateName"], candidate["CandidateType"], self.__author)
         candidate["ID"] = id
+        _withEpochs(candidate)
         try:
             self.insert_records("Candidates", candidate)
         except:
@@ -234,6 +620,189 @@ class CandidateDatabase(SQLDatabase):
             candidate["Author"])
         return id
 
+    def _executeGroups(self, groups):
+        """
+        Internal: run each (sql, [(key, params), ...]) group with executemany, all inside one transaction. If a group fails, it is rolled back and retried one row at a time so that one bad row doesn't sink the rest
+        :return: tuple (list of keys of rows that succeeded, {key: error message} for rows that failed)
+        """
+        succeeded, failures = [], {}
+        with self.transaction():
+            for sql, rows in groups:
+                self.db_cursor.execute("SAVEPOINT bulkWrite")
+                try:
+                    self.db_cursor.executemany(sql, [params for key, params in rows])
+                    self.db_cursor.execute("RELEASE SAVEPOINT bulkWrite")
+                    succeeded.extend(key for key, params in rows)
+                    continue
+                except sqlite3.Error as err:
+                    self.logger.warning("Bulk write failed (" + str(err) + "). Retrying " + str(len(rows)) + " row(s) one at a time")
+                    self.db_cursor.execute("ROLLBACK TO SAVEPOINT bulkWrite")
+                    self.db_cursor.execute("RELEASE SAVEPOINT bulkWrite")
+                for key, params in rows:
+                    try:
+                        self.db_cursor.execute(sql, params)
+                        succeeded.append(key)
+                    except sqlite3.Error as err:
+                        failures[key] = str(err)
+        return succeeded, failures
+
+    def insertCandidates(self, candidates: list):
+        """
+        Insert many candidates in one transaction. Candidates with the same set of fields share one prepared statement
+        :param candidates: list of Candidate objects
+        :return: tuple (list of new IDs, in the same order as candidates, with None for each that couldn't be inserted, {index in candidates: error message} for each failure)
+        """
+        ids = [None] * len(candidates)
+        groups = {}  # {columns: [(index, params)]}
+        timestamp = CandidateDatabase.timestamp()
+        for i, candidate in enumerate(candidates):
+            row = candidate.asDict()
+            row["Author"] = self.__author
+            row["DateAdded"] = timestamp
+            row["ID"] = generateID(row["CandidateName"], row["CandidateType"], self.__author)
+            ids[i] = row["ID"]
+            _withEpochs(row)
+            columns = tuple(sorted(row.keys()))
+            groups.setdefault(columns, []).append((i, [row[c] for c in columns]))
+        statements = [("INSERT INTO Candidates (" + ", ".join('"' + c + '"' for c in columns) + ") VALUES (" + ", ".join(
+            "?" * len(columns)) + ")", rows) for columns, rows in groups.items()]
+
+        succeeded, failures = self._executeGroups(statements)
+        for i in failures.keys():
+            self.logger.error("Can't insert " + str(candidates[i]) + ": " + failures[i])
+            ids[i] = None
+        self.logger.info("Inserted " + str(len(succeeded)) + " candidate(s) from " + self.__author)
+        return ids, failures
+
+    def upsertCandidates(self, candidates: list, readdBefore=None):
+        """
+        Insert many candidates, or update the ones that already exist, in one transaction and without reading them first. A candidate's ID is its ID field if it has one (as for rows from the database), otherwise generateID. Existing rows get only the fields the candidate has, plus DateLastEdited
+        :param candidates: list of Candidate objects
+        :param readdBefore: optional datetime or time string (UTC). existing rows added before this are treated as added again: their DateAdded is reset, and their removal, rejection, and observability window are cleared unless the candidate sets them
+        :return: tuple (list of IDs, in the same order as candidates, with None for each that couldn't be written, {index in candidates: error message} for each failure)
+        """
+        ids = [None] * len(candidates)
+        groups = {}  # {columns: [(index, params)]}
+        timestamp = CandidateDatabase.timestamp()
+        cutoff = None
+        if readdBefore is not None:
+            cutoff = toEpoch(readdBefore)
+            if cutoff is None:
+                raise ValueError("Can't interpret " + str(readdBefore) + " as a time")
+        for i, candidate in enumerate(candidates):
+            row = self.removeInvalidFields(candidate.asDict())
+            row["CandidateName"], row["CandidateType"] = candidate.CandidateName, candidate.CandidateType
+            row.pop("DateLastEdited", None)
+            row["Author"] = self.__author
+            row["DateAdded"] = timestamp
+            row["ID"] = candidate.ID if candidate.hasField("ID") else generateID(candidate.CandidateName,
+                                                                                 candidate.CandidateType, self.__author)
+            ids[i] = row["ID"]
+            _withEpochs(row)
+            columns = tuple(sorted(row.keys()))
+            groups.setdefault(columns, []).append((i, [row[c] for c in columns]))
+        statements = []
+        for columns, rows in groups.items():
+            updated = [c for c in columns if not self.isFieldProtected(c) and c != "DateAddedEpoch"]
+            tail = [timestamp, toEpoch(timestamp)]
+            readd = ""
+            if cutoff is not None:
+                # a re-added row starts over: its removal and last night's observability and rejection are cleared, unless the candidate brings new values for them
+                # every expression in SET sees the row as it was before the update, so these all test the old DateAddedEpoch
+                reset = [("DateAdded", 'excluded."DateAdded"'), ("DateAddedEpoch", 'excluded."DateAddedEpoch"')] + [
+                    (c, "NULL") for c in readdNulledFields if c not in updated]
+                readd = "".join(', "' + c + '" = CASE WHEN "DateAddedEpoch" < ? THEN ' + v + ' ELSE "' + c + '" END' for c, v in reset)
+                tail += [cutoff] * len(reset)
+            statements.append((
+                "INSERT INTO Candidates (" + ", ".join('"' + c + '"' for c in columns) + ") VALUES (" + ", ".join(
+                    "?" * len(columns)) + ') ON CONFLICT("ID") DO UPDATE SET ' + "".join(
+                    '"' + c + '" = excluded."' + c + '", ' for c in updated) +
+                '"DateLastEdited" = ?, "DateLastEditedEpoch" = ?' + readd, [(i, params + tail) for i, params in rows]))
+
+        succeeded, failures = self._executeGroups(statements)
+        for i in failures.keys():
+            self.logger.error("Can't upsert " + str(candidates[i]) + ": " + failures[i])
+            ids[i] = None
+        self.logger.info("Upserted " + str(len(succeeded)) + " candidate(s) from " + self.__author)
+        return ids, failures
+
+    def removeCandidatesNotIn(self, names, reason, condition="", values=(), timeColumn=None, after=None, before=None):
+        """
+        Mark as removed, in one statement, every candidate that matches the condition but whose name isn't in names. Candidates that are already removed are left alone
+        :param names: CandidateNames to keep, like those in the current list from a source
+        :param reason: removal reason. the author is prepended, as in removeCandidateByID
+        :param condition: sql condition picking the candidates to consider, like 'CandidateType IS "MPC NEO"'
+        :param values: values for the placeholders in condition
+        :param timeColumn: optional; one of epochColumns to bound by after/before, as in queryByTime
+        :return: list of names of the candidates that were removed
+        """
+        if timeColumn is not None:
+            condition, values = _timeCondition(timeColumn, after, before, condition, values)
+        names = list(names)
+        where = '"RemovedReason" IS NULL AND "CandidateName" NOT IN (' + ", ".join("?" * len(names)) + ")" + (
+            " AND (" + condition + ")" if condition else "")
+        values = names + list(values)
+        timestamp = CandidateDatabase.timestamp()
+        with self.transaction():
+            removed = [row[0] for row in self.db_cursor.execute('SELECT "CandidateName" FROM Candidates WHERE ' + where,
+                                                                values).fetchall()]
+            if removed:
+                self.db_cursor.execute(
+                    'UPDATE Candidates SET "RemovedReason" = ?, "RemovedDt" = ?, "DateLastEdited" = ?, "DateLastEditedEpoch" = ? WHERE ' + where,
+                    [self.__author + ": " + reason, timestamp, timestamp, toEpoch(timestamp)] + values)
+        self.logger.info("Removed " + str(len(removed)) + " candidate(s) for reason " + reason)
+        return removed
+
+    def updateCandidates(self, updates):
+        """
+        Edit many candidates in one transaction. Updates touching the same set of fields share one prepared statement
+        :param updates: dict {ID: updateDict} or list of (ID, updateDict) tuples. invalid and protected fields are dropped, as in editCandidateByID
+        :return: tuple (list of IDs that were updated, {ID: error message} for each failure)
+        """
+        if isinstance(updates, dict):
+            updates = updates.items()
+        groups = {}  # {columns: [(ID, params)]}
+        timestamp = CandidateDatabase.timestamp()
+        for ID, updateDict in updates:
+            updateDict = self.removeInvalidFields(dict(updateDict))
+            if not len(updateDict):
+                continue
+            updateDict["DateLastEdited"] = timestamp
+            _withEpochs(updateDict)
+            columns = tuple(sorted(updateDict.keys()))
+            groups.setdefault(columns, []).append((ID, [updateDict[c] for c in columns] + [ID]))
+        statements = [("UPDATE Candidates SET " + ", ".join('"' + c + '" = ?' for c in columns) + " WHERE \"ID\" = ?",
+                       rows) for columns, rows in groups.items()]
+
+        succeeded, failures = self._executeGroups(statements)
+        for ID in failures.keys():
+            self.logger.error("Can't update candidate " + str(ID) + ": " + failures[ID])
+        return succeeded, failures
+
+    def nullFields(self, fields):
+        """
+        Set fields to NULL for many candidates in one transaction
+        :param fields: dict {ID: [column names]} or list of (ID, column name) tuples
+        :return: tuple (list of (ID, column) pairs that were set, {(ID, column): error message} for each failure)
+        """
+        if isinstance(fields, dict):
+            fields = [(ID, column) for ID, columns in fields.items() for column in columns]
+        groups = {}  # {column: [((ID, column), params)]}
+        timestamp = CandidateDatabase.timestamp()
+        for ID, column in fields:
+            if column not in validFields or self.isFieldProtected(column) or column == "DateLastEdited":
+                raise ValueError("Can't set " + str(column) + " to null: not a valid, unprotected field")
+            groups.setdefault(column, []).append(((ID, column), [timestamp, toEpoch(timestamp), ID]))
+        statements = [('UPDATE Candidates SET ' + ", ".join(
+            '"' + c + '" = NULL' for c in ([column, column + "Epoch"] if column in epochColumns else [column])) +
+                       ', "DateLastEdited" = ?, "DateLastEditedEpoch" = ? WHERE "ID" = ?', rows) for column, rows in
+                      groups.items()]
+
+        succeeded, failures = self._executeGroups(statements)
+        for key in failures.keys():
+            self.logger.error("Can't set " + key[1] + " to null for candidate " + str(key[0]) + ": " + failures[key])
+        return succeeded, failures
+
     def fetchIDs(self):
         self.__existingIDs = [row["ID"] for row in self.table_query("Candidates", "ID", '', []) if row]
 
@@ -249,20 +818,116 @@ class CandidateDatabase(SQLDatabase):
             dictionary.pop(key)
         return dictionary
 
+    def queryByTime(self, column, after=None, before=None, condition="", values=(), columns="*",
+                    returnAsCandidates=True):
+        """
+        Query candidates whose datetime column is strictly after `after` and/or strictly before `before`, comparing on the integer epoch twin of the column
+        :param column: one of epochColumns, like "DateAdded"
+        :param after: datetime or time string (UTC), or None for no lower bound
+        :param before: datetime or time string (UTC), or None for no upper bound
+        :param condition: optional extra sql condition, ANDed with the time bounds
+        :param values: values for the placeholders in condition
+        :return: as table_query: list of dicts or Candidates, or None
+        """
+        condition, values = _timeCondition(column, after, before, condition, values)
+        return self.table_query("Candidates", columns, condition, values, returnAsCandidates=returnAsCandidates)
+
+    def query_frame(self, columns="*", condition="", values=(), timeColumn=None, after=None, before=None,
+                    table_name="Candidates"):
+        """
+        Query straight into a DataFrame, without building a dict or Candidate per row. Numeric and time columns come back typed (float/int and datetime) wherever every value in them converts cleanly, and the *Epoch columns are left out
+        :param columns: sql column list, like "*" or "CandidateName, RA"
+        :param condition: sql conditional statement, or "" for the whole table
+        :param values: values for the placeholders in condition
+        :param timeColumn: optional; one of epochColumns to bound by after/before, as in queryByTime
+        :return: pandas DataFrame (empty if nothing matched)
+        """
+        if timeColumn is not None:
+            condition, values = _timeCondition(timeColumn, after, before, condition, values)
+        sql = "SELECT " + columns + " FROM " + table_name + (" WHERE " + condition if condition else "")
+        return self._frameFromSql(sql, values)
+
+    def _frameFromSql(self, sql, values):
+        """
+        Internal: run a select into a typed DataFrame, as query_frame does, leaving out the *Epoch and internal (leading underscore) columns
+        """
+        df = pd.read_sql(sql, self.db_connection, params=list(values))
+        df = df.drop(columns=[c for c in df.columns if
+                              c.startswith("_") or (c[:-len("Epoch")] in epochColumns and c.endswith("Epoch"))])
+        _coerceFrame(df)
+        self.logger.info("Query: Retrieved " + str(len(df.index)) + " record(s) for candidates into a frame")
+        return df
+
+    def queryObservable(self, start, end, duration, condition="", values=(), timeColumn=None, after=None, before=None,
+                        latestPerName=True, asFrame=False):
+        """
+        Query candidates observable between start and end for at least duration hours, as decided by Candidate.isObservableBetween, in one query on the epoch columns
+        :param start: datetime or time string (UTC)
+        :param end: datetime or time string (UTC)
+        :param duration: hours
+        :param condition: optional extra sql condition, applied before picking the latest rows
+        :param values: values for the placeholders in condition
+        :param timeColumn: optional; one of epochColumns to bound by after/before, as in queryByTime
+        :param latestPerName: keep only the most recently Updated observable row of each CandidateName (the earliest inserted, on ties)
+        :param asFrame: return a DataFrame, as from query_frame, instead of a list of Candidates
+        :return: list of Candidates or DataFrame. empty if nothing matched
+        """
+        if timeColumn is not None:
+            condition, values = _timeCondition(timeColumn, after, before, condition, values)
+        window, windowValues = _windowCondition(start, end, duration)
+        where = window + (" AND (" + condition + ")" if condition else "")
+        values = windowValues + list(values)
+        if latestPerName:
+            sql = ('SELECT * FROM (SELECT *, ROW_NUMBER() OVER (PARTITION BY "CandidateName" ORDER BY "UpdatedEpoch" DESC, rowid ASC) AS "_rank"'
+                   ' FROM Candidates WHERE ' + where + ') WHERE "_rank" = 1')
+        else:
+            sql = "SELECT * FROM Candidates WHERE " + where
+        if asFrame:
+            return self._frameFromSql(sql, values)
+        rows = _queryToDict(self.db_cursor.execute(sql, values).fetchall())
+        self.logger.info("Query: Retrieved " + str(len(rows)) + " observable candidate(s)")
+        return [Candidate.fromDatabaseEntry(row) for row in rows]
+
+    def changeWatermark(self):
+        """
+        Mark the current state of the table, to later ask candidatesChangedSince what has changed since
+        :return: int watermark (the UTC epoch second of the latest change), 0 if the table is empty
+        """
+        row = self.db_cursor.execute("SELECT MAX(" + changeColumn + ") FROM Candidates").fetchone()
+        return row[0] or 0
+
+    def candidatesChangedSince(self, watermark, columns="*", asFrame=False):
+        """
+        Get the candidates that were added, edited, or removed since the watermark was taken. Removed candidates are included, with their RemovedReason set, so callers can drop them. Rows changed around the time of the watermark may be returned again on the next call, so apply the results idempotently (by ID) - see applyChanges
+        :param watermark: from changeWatermark or a previous call to this, or None for every candidate
+        :param columns: sql column list. must include ID for the results to be applied
+        :param asFrame: return a DataFrame, as from query_frame, instead of a list of Candidates
+        :return: tuple (list of Candidates or DataFrame of changed candidates, new watermark to pass next time)
+        """
+        condition, values = "", []
+        if watermark is not None:
+            condition, values = changeColumn + " >= ?", [max(int(watermark) - changeOverlap, 0)]
+        with self.snapshot():  # so nothing can change between finding the new watermark and reading the rows
+            newWatermark = self.changeWatermark()
+            if asFrame:
+                changes = self.query_frame(columns, condition, values)
+            else:
+                changes = self.table_query("Candidates", columns, condition, values, returnAsCandidates=True) or []
+        return changes, max(newWatermark, watermark or 0)
+
     def candidatesAddedSince(self, when):
         """
         Query the database for candidates added since 'when'
-        :param when: datetime or string, PST
+        :param when: datetime or string, UTC
         :return: A list of Candidates, each constructed from a row in the dataframe, or None
         """
-        when = genUtils.timeToString(when)
-        if when is None:
+        if toEpoch(when) is None:
             return None
-        queryResult = self.table_query("Candidates", "*", "DateAdded > ?", [when], returnAsCandidates=True)
+        queryResult = self.queryByTime("DateAdded", after=when)
         if queryResult:
             return queryResult
         else:
-            self.logger.warning("Received empty query result for candidates added since " + when)
+            self.logger.warning("Received empty query result for candidates added since " + str(when))
             return None
 
     def getCandidateByID(self, ID):
@@ -272,24 +937,29 @@ class CandidateDatabase(SQLDatabase):
         updateDict = self.removeInvalidFields(updateDict)
         if len(updateDict):
             updateDict["DateLastEdited"] = CandidateDatabase.timestamp()
-
+            _withEpochs(updateDict)
             self.table_update("Candidates", updateDict, "ID = " + str(ID))
 
     def _releaseDatabase(self):
-        self.db_cursor.execute("COMMIT", [])
+        if self.db_connection.in_transaction:  # a bare COMMIT with nothing to commit is an error
+            self.db_connection.commit()
 
     def setFieldNullByID(self, ID, colName):
         value = None
-        sql_template = Template('UPDATE Candidates SET $column_name = ? WHERE \"ID\" = $id')
+        timestamp = CandidateDatabase.timestamp()
+        sql_template = Template(
+            'UPDATE Candidates SET $column_name = ?, \"DateLastEdited\" = ?, \"DateLastEditedEpoch\" = ? WHERE \"ID\" = $id')
         sql_statement = sql_template.substitute({'column_name': colName, 'id': str(ID)})
-        self.db_cursor.execute(sql_statement, [value])
+        self.db_cursor.execute(sql_statement, [value, timestamp, toEpoch(timestamp)])
+        if colName in epochColumns:
+            self.setFieldNullByID(ID, colName + "Epoch")
 
     def removeCandidateByID(self, ID: str, reason: str):
         candidate = self.getCandidateByID(ID)[0]
         if candidate:
             reason = self.__author + ": " + reason
-            updateDict = {"RemovedDt": CandidateDatabase.timestamp(), "RemovedReason": reason,
-                          "DateLastEdited": CandidateDatabase.timestamp()}
+            updateDict = _withEpochs({"RemovedDt": CandidateDatabase.timestamp(), "RemovedReason": reason,
+                                      "DateLastEdited": CandidateDatabase.timestamp()})
             self.table_update("Candidates", updateDict, "ID = " + str(ID))
             self.logger.info("Removed candidate " + candidate.CandidateName + " for reason " + reason)
         else:
@@ -298,6 +968,147 @@ class CandidateDatabase(SQLDatabase):
         return ID
 
 
+class AsyncCandidateDatabase:
+    """
+    Lets coroutines use a CandidateDatabase without blocking the event loop. Every call runs on one worker thread, in the order it was made, so network requests keep moving while sqlite works and writes never race each other
+        candidates = await asyncDb.queryByTime("DateAdded", after=cutoff)
+    """
+
+    def __init__(self, db: CandidateDatabase):
+        """
+        :param db: open CandidateDatabase. from here on, only use it through this object
+        """
+        self.db = db
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="candidateDatabase")
+        self._deferred = []
+
+    @classmethod
+    def wrap(cls, db):
+        """
+        :param db: CandidateDatabase or AsyncCandidateDatabase
+        :return: tuple (AsyncCandidateDatabase, bool: whether a new one was made, so the caller should close it)
+        """
+        if isinstance(db, cls):
+            return db, False
+        return cls(db), True
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queue function(db, *args, **kwargs) on the database thread
+        :return: asyncio future for its result
+        """
+        return asyncio.get_running_loop().run_in_executor(self._executor,
+                                                          functools.partial(function, self.db, *args, **kwargs))
+
+    async def run(self, function, *args, **kwargs):
+        """
+        Run function(db, *args, **kwargs) on the database thread, for anything that needs several calls together, like a transaction
+        """
+        return await self.submit(function, *args, **kwargs)
+
+    def __getattr__(self, name):
+        # methods of the database become coroutine functions. anything else is read straight through
+        attribute = getattr(self.db, name)
+        if not callable(attribute):
+            return attribute
+
+        async def call(*args, **kwargs):
+            return await self.submit(lambda db: getattr(db, name)(*args, **kwargs))
+
+        return call
+
+    def defer(self, name, *args, **kwargs):
+        """
+        Queue a call to the database method `name` without waiting for it. Calls made after this still run after it. Collect the results with flush
+        """
+        self._deferred.append(self.submit(lambda db: getattr(db, name)(*args, **kwargs)))
+
+    async def flush(self):
+        """
+        Wait for every deferred call to finish
+        :return: list of their results, in the order they were deferred
+        :raises: the first exception raised by any of them
+        """
+        deferred, self._deferred = self._deferred, []
+        results = await asyncio.gather(*deferred, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+        return results
+
+    def close(self):
+        """
+        Stop the database thread, after it finishes what's queued. Doesn't close the database connection
+        """
+        self._executor.shutdown(wait=True)
+
+
+class ConnectionPool:
+    """
+    Keeps idle CandidateDatabase connections for reuse within one process, so callers that open the database often don't pay for connecting (and checking the schema) each time
+    """
+
+    def __init__(self, maxIdle=4):
+        """
+        :param maxIdle: most idle connections to keep for each (path, author, readOnly) combination
+        """
+        self.maxIdle = maxIdle
+        self._idle = {}  # {(path, author, readOnly): [CandidateDatabase]}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    @staticmethod
+    def _key(dbPath, author, readOnly):
+        return os.path.abspath(dbPath), author, readOnly
+
+    def acquire(self, dbPath, author, readOnly=False):
+        """
+        Get a connection from the pool, or open a new one
+        :return: CandidateDatabase
+        """
+        with self._lock:
+            if os.getpid() != self._pid:  # we've been forked - the parent's connections aren't ours to use
+                self._idle = {}
+                self._pid = os.getpid()
+            idle = self._idle.get(self._key(dbPath, author, readOnly))
+            if idle:
+                return idle.pop()
+        return CandidateDatabase(dbPath, author, readOnly=readOnly)
+
+    def release(self, db: CandidateDatabase):
+        """
+        Return a connection to the pool. Anything it left uncommitted is committed first
+        """
+        db._releaseDatabase()
+        with self._lock:
+            idle = self._idle.setdefault(self._key(db.dbPath, db._CandidateDatabase__author, db.readOnly), [])
+            if os.getpid() == self._pid and len(idle) < self.maxIdle:
+                idle.append(db)
+                return
+        db.close()
+
+    @contextmanager
+    def connection(self, dbPath, author, readOnly=False):
+        """
+        Borrow a connection for the duration of the block
+        """
+        db = self.acquire(dbPath, author, readOnly)
+        try:
+            yield db
+        finally:
+            self.release(db)
+
+    def closeAll(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for db in connections:
+                db.close()
+
+
+connectionPool = ConnectionPool()  # shared by everything in this process
+
+
 if __name__ == '__main__':
     logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', filename='libFiles/candidateDb.log',
                         encoding='utf-8', datefmt='%m/%d/%Y %H:%M:%S', level=logging.DEBUG)
@@ -0,0 +1,126 @@
+# Sage Santomenna 2023
+# versioned schema changes for the candidate database. the version a database file is at is kept in sqlite's user_version pragma
+#   python scheduleLib/dbMigrations.py "files/candidate database.db" --status
+#   python scheduleLib/dbMigrations.py "files/candidate database.db"
+import argparse
+import logging
+import sqlite3
+
+# each migration is (version, description, steps). a step is a SQL string or a function that takes the connection
+# migrations are applied in order, each in its own transaction, and must never be edited once released - add a new one instead
+MIGRATIONS = [
+    (1, "Index the columns that the coordinator, scheduler, and GUI filter candidates on", [
+        # selector: CandidateType IS ? AND RemovedReason IS NULL AND DateAdded > ?
+        'CREATE INDEX IF NOT EXISTS "idxCandidatesTypeRemovedAdded" ON "Candidates" ("CandidateType", "RemovedReason", "DateAdded")',
+        # scheduler: RemovedReason IS NULL AND RejectedReason IS NULL AND CandidateType IS ? AND DateLastEdited > ?
+        'CREATE INDEX IF NOT EXISTS "idxCandidatesTypeRemovedRejectedEdited" ON "Candidates" ("CandidateType", "RemovedReason", "RejectedReason", "DateLastEdited")',
+        # logger and GUI: DateAdded > ?
+        'CREATE INDEX IF NOT EXISTS "idxCandidatesAdded" ON "Candidates" ("DateAdded")',
+        'CREATE INDEX IF NOT EXISTS "idxCandidatesEdited" ON "Candidates" ("DateLastEdited")',
+    ]),
+]
+
+# TEXT datetime columns that get an integer "<column>Epoch" twin (UTC seconds since the unix epoch), kept in sync by CandidateDatabase
+EPOCH_COLUMNS = ["DateAdded", "DateLastEdited", "StartObservability", "EndObservability", "Updated", "TransitTime"]
+
+
+def _addEpochColumns(connection):
+    existing = [row[1] for row in connection.execute('PRAGMA table_info("Candidates")')]
+    for column in EPOCH_COLUMNS:
+        if column + "Epoch" not in existing:
+            connection.execute('ALTER TABLE "Candidates" ADD COLUMN "' + column + 'Epoch" INTEGER')
+        connection.execute(
+            'UPDATE "Candidates" SET "' + column + 'Epoch" = CAST(strftime(\'%s\', "' + column + '") AS INTEGER)')
+
+
+MIGRATIONS.append(
+    (2, "Add integer epoch twins of the datetime columns and move the time indexes onto them", [
+        _addEpochColumns,
+        'DROP INDEX IF EXISTS "idxCandidatesTypeRemovedAdded"',
+        'DROP INDEX IF EXISTS "idxCandidatesTypeRemovedRejectedEdited"',
+        'DROP INDEX IF EXISTS "idxCandidatesAdded"',
+        'DROP INDEX IF EXISTS "idxCandidatesEdited"',
+        'CREATE INDEX IF NOT EXISTS "idxCandidatesTypeRemovedAddedEpoch" ON "Candidates" ("CandidateType", "RemovedReason", "DateAddedEpoch")',
+        'CREATE INDEX IF NOT EXISTS "idxCandidatesTypeRemovedRejectedEditedEpoch" ON "Candidates" ("CandidateType", "RemovedReason", "RejectedReason", "DateLastEditedEpoch")',
+        'CREATE INDEX IF NOT EXISTS "idxCandidatesAddedEpoch" ON "Candidates" ("DateAddedEpoch")',
+        'CREATE INDEX IF NOT EXISTS "idxCandidatesEditedEpoch" ON "Candidates" ("DateLastEditedEpoch")',
+    ]))
+
+MIGRATIONS.append(
+    (3, "Index the last time each candidate changed, for CandidateDatabase.candidatesChangedSince", [
+        # the expression has to match CandidateDatabase's changeColumn exactly for sqlite to use it
+        'CREATE INDEX IF NOT EXISTS "idxCandidatesChangedEpoch" ON "Candidates" (COALESCE("DateLastEditedEpoch", "DateAddedEpoch"))',
+    ]))
+
+LATEST_VERSION = MIGRATIONS[-1][0] if MIGRATIONS else 0
+
+
+def schemaVersion(connection):
+    """
+    :param connection: sqlite3 connection to a candidate database
+    :return: int, the schema version the database is at (0 if it has never been migrated)
+    """
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def pendingMigrations(connection, targetVersion=None):
+    """
+    :return: list of (version, description, steps) that migrate would apply
+    """
+    targetVersion = LATEST_VERSION if targetVersion is None else targetVersion
+    version = schemaVersion(connection)
+    return [m for m in MIGRATIONS if version < m[0] <= targetVersion]
+
+
+def migrate(connection, targetVersion=None, logger=None):
+    """
+    Bring the database up to targetVersion in place, applying each pending migration in its own transaction. Safe to call every time a database is opened, from any number of processes: the version is rechecked after taking the write lock
+    :param connection: sqlite3 connection to a candidate database
+    :param targetVersion: version to migrate to. defaults to the latest
+    :return: int, the schema version the database is now at
+    """
+    logger = logger or logging.getLogger(__name__)
+    targetVersion = LATEST_VERSION if targetVersion is None else targetVersion
+    if not pendingMigrations(connection, targetVersion):
+        return schemaVersion(connection)
+
+    if connection.in_transaction:
+        connection.commit()
+    for version, description, steps in MIGRATIONS:
+        if version > targetVersion:
+            break
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            if schemaVersion(connection) >= version:  # someone else got here first
+                connection.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(connection)
+                else:
+                    connection.execute(step)
+            connection.execute("PRAGMA user_version = " + str(int(version)))
+        except:
+            connection.rollback()
+            logger.exception("Candidate database migration to version " + str(version) + " failed")
+            raise
+        connection.commit()
+        logger.info("Migrated candidate database to version " + str(version) + ": " + description)
+    return schemaVersion(connection)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Upgrade a candidate database file in place to the current schema")
+    parser.add_argument("dbPath", type=str, help="Path to the candidate database")
+    parser.add_argument("--target", type=int, default=None, help="Version to migrate to. Defaults to the latest")
+    parser.add_argument("--status", action="store_true", help="Print the current version and pending migrations without applying them")
+    args = parser.parse_args()
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.INFO)
+
+    db = sqlite3.connect(args.dbPath, timeout=30)
+    print("Database is at version " + str(schemaVersion(db)) + " (latest is " + str(LATEST_VERSION) + ")")
+    for version, description, steps in pendingMigrations(db, args.target):
+        print("    pending: " + str(version) + " - " + description)
+    if not args.status:
+        print("Now at version " + str(migrate(db, args.target)))
+    db.close()
@@ -5,6 +5,7 @@ from datetime import timedelta, datetime, timezone
 
 import astroplan
 import astropy.time
+import numpy as np
 import pytz
 from astral import LocationInfo
 from astral import sun
@@ -13,6 +14,9 @@ from astropy.coordinates import Angle
 from astropy.time import Time
 from abc import ABCMeta, abstractmethod
 
+from scheduleLib import angleUtils, timeUtils
+from scheduleLib.nightContext import NightContext
+
 
 class ScheduleError(Exception):
     """Exception raised for user-facing errors in scheduling
@@ -112,14 +116,10 @@ def stringToTime(timeString, logger=None, scheduler=False):
     if isinstance(timeString, datetime):  # they gave us a datetime, return it back to them
         return timeString
     try:
-        return datetime.strptime(timeString, "%Y-%m-%d %H:%M:%S")
-    except:
-        try:
-            return datetime.strptime(timeString, "%Y-%m-%d %H:%M:%S.%f")
-        except Exception as e:
-            print(repr(e))
-            if logger:
-                logger.error("Unable to coerce time from", timeString)
+        return timeUtils.parseTime(timeString)  # "%Y-%m-%d %H:%M:%S", with or without ".%f"
+    except Exception:
+        if logger:
+            logger.error("Unable to coerce time from %s", timeString)
     return None
 
 
@@ -139,10 +139,15 @@ def logAndPrint(msg, loggerMethod):
 
 def toDecimal(angle: Angle):
     """
-    Return the decimal degree representation of an astropy Angle, as a float
-    :return: Decimal degree representation, float
+    Return the decimal degree representation of an astropy Angle, as a float. Numbers, angle strings, and arrays of them are converted without astropy (see angleUtils.toDegrees)
+    :return: Decimal degree representation, float (or numpy float array, for an array)
     """
-    return round(float(angle.degree), 6)  # ew
+    if isinstance(angle, Angle):
+        if not angle.isscalar:
+            return np.round(angle.degree, 6)
+        return round(float(angle.degree), 6)  # ew
+    degrees = angleUtils.toDegrees(angle)
+    return np.round(degrees, 6) if isinstance(degrees, np.ndarray) else round(degrees, 6)
 
 
 def toSexagesimal(angle: Angle):
@@ -161,6 +166,12 @@ def ensureAngle(angle):
     :return: angle, as an astropy Angle
     """
     if not isinstance(angle, Angle):
+        if isinstance(angle, str):
+            try:  # the common forms are parsed without astropy's (much slower) parser
+                value, unit = angleUtils.parseAngle(angle, None)
+                return Angle(value, unit=u.hourangle if unit == angleUtils.HOURS else u.deg)
+            except ValueError:
+                pass  # let astropy have a go, and complain if it can't either
         try:
             if isinstance(angle, str) or isinstance(angle, tuple):
                 angle = Angle(angle)
@@ -174,10 +185,23 @@ def ensureAngle(angle):
 
 def ensureFloat(angle):
     """
-    Return angle as an astropy Angle, converting if necessary
-    :param angle: float or astropy Angle
+    Return angle as a float in decimal degrees, converting if necessary
+    :param angle: float, int, numeric string, angle string with units (like '12h30m' or '284d'), or astropy Angle
     :return: decimal angle, as a float
     """
+    if isinstance(angle, float):
+        return angle
+    if isinstance(angle, (int, np.integer, np.floating)):
+        return float(angle)
+    if isinstance(angle, str):
+        try:
+            return float(angle)
+        except ValueError:
+            pass
+        try:
+            return round(angleUtils.toDegrees(angle, unit=None), 6)  # as toDecimal would have of the parsed Angle
+        except ValueError:
+            pass
     try:
         if isinstance(angle, str) or isinstance(angle, tuple):
             angle = Angle(angle)
@@ -198,49 +222,59 @@ def roundToTenMinutes(dt):
     return dt - timedelta(minutes=dt.minute % 10, seconds=dt.second, microseconds=dt.microsecond)
 
 
+def hoursUntilTransit(ras, lst):
+    """
+    Hours from the moment the local sidereal time is lst until targets at right ascensions ras transit. Not wrapped to a day: targets "behind" lst get negative values
+    :param ras: float or array-like of right ascensions, in degrees
+    :param lst: local sidereal time, in degrees
+    :return: float or numpy float array of hours
+    """
+    return (np.asarray(ras, dtype=float) - float(lst)) / 15
+
+
+def findTransitTimes(rightAscensions, observatory, unit=angleUtils.DEGREES, currentTime=None):
+    """
+    Calculate the transit times of many objects at the given observatory, computing the sidereal time only once
+    :param rightAscensions: array-like of right ascensions (floats or angle strings, as angleUtils.toDegrees)
+    :param observatory: The observatory location, as an astral LocationInfo
+    :param unit: angleUtils.DEGREES or angleUtils.HOURS: the unit of rightAscensions
+    :param currentTime: naive utc datetime to find transits after (to the minute). defaults to now
+    :return: list of datetimes, the transit times rounded to the nearest ten minutes
+    """
+    if currentTime is None:
+        currentTime = datetime.utcnow()
+    currentTime = currentTime.replace(second=0, microsecond=0)
+    lst = Time(currentTime).sidereal_time('mean', longitude=observatory.longitude).degree
+    hours = hoursUntilTransit(angleUtils.toDegrees(np.asarray(rightAscensions).ravel(), unit), lst)
+    # whole hours and minutes toward zero, dropping the seconds, as the hms of an astropy Angle would give them
+    wholeHours = np.trunc(hours)
+    minutes = (wholeHours * 60 + np.trunc((hours - wholeHours) * 60)).astype(np.int64)
+    transitTimes = np.datetime64(currentTime, "m") + minutes
+    rounded = (transitTimes + np.timedelta64(5, "m")).astype(np.int64) // 10 * 10  # as roundToTenMinutes
+    return rounded.astype("datetime64[m]").astype(datetime).tolist()
+
+
 def findTransitTime(rightAscension: Angle, observatory):
-    """Calculate the transit time of an object at the given observatory.
+    """Calculate the transit time of an object at the given observatory. See findTransitTimes to do many at once
 
-    :param rightAscension: The right ascension of the object as an astropy Angle
+    :param rightAscension: The right ascension of the object as an astropy Angle (or a float in degrees)
     :type rightAscension: Angle
     :param observatory: The observatory location.
     :type observatory: astropy.coordinates.LocationInfo
     :return: The rounded transit time of the object as a datetime object.
     :rtype: datetime.datetime
     """
-
-    currentTime = datetime.utcnow().replace(second=0, microsecond=0)
-    lst = Time(currentTime).sidereal_time('mean', longitude=observatory.longitude)
-    ha = rightAscension - lst
-    haTime = ha.to(u.hourangle)
-    haHours, haMinutes, haSeconds = haTime.hms
-    transitTime = currentTime + timedelta(hours=haHours, minutes=haMinutes, seconds=0)
-    return roundToTenMinutes(transitTime)
+    degrees = rightAscension.degree if isinstance(rightAscension, Angle) else ensureFloat(rightAscension)
+    return findTransitTimes([degrees], observatory)[0]
 
 
 def getSunriseSunset():
     """
     get sunrise and sunset for tmo, as datetimes
-    :return:
+    :return: tuple (sunriseUTC, sunsetUTC): the next sunrise, and the sunset (sun 10 degrees below the horizon) before it
     """
-    TMO = LocationInfo(name="TMO", region="CA, USA", timezone="UTC", latitude=34.36,
-                       longitude=-117.63)
-
-    s = sun.sun(TMO.observer, date=datetime.now(timezone.utc), tzinfo=timezone.utc)
-    sunriseUTC = s["sunrise"]
-    sunsetUTC = sun.time_at_elevation(TMO.observer, -10, direction=sun.SunDirection.SETTING)
-
-    nowDt = datetime.utcnow()
-    nowDt = pytz.UTC.localize(nowDt)
-
-    # TODO: make this less questionable - it probably doesn't do exactly what i want it to when run at certain times of the day:
-    if sunriseUTC < nowDt:  # if the sunrise we found is earlier than the current time, add one day to it (approximation ofc)
-        sunriseUTC = sunriseUTC + timedelta(days=1)
-
-    if sunsetUTC > sunriseUTC:
-        sunsetUTC = sunsetUTC - timedelta(days=1)
-
-    return sunriseUTC, sunsetUTC
+    night = NightContext.get()
+    return night.sunrise, night.sunset
 
 
 def f(x):
@@ -269,42 +303,57 @@ def prettyFormat(candidateDf):
 
     formattedDf = candidateDf.copy()
 
-    formattedDf["RA"] = formattedDf["RA"].apply(
-        lambda x: (Angle(x, unit=u.degree) * 15).to_string(unit=u.hourangle, sep=" "))
-    formattedDf["Dec"] = formattedDf["Dec"].apply(lambda x: Angle(x, unit=u.degree).to_string(unit=u.deg, sep=" "))
+    formattedDf["RA"] = angleUtils.sexagesimalStrings(formattedDf["RA"], sep=" ")  # RA is already in hours
+    formattedDf["Dec"] = angleUtils.sexagesimalStrings(formattedDf["Dec"], sep=" ")
 
     formattedDf["RMSE"] = tuple(zip(formattedDf["RMSE_RA"].apply(f), formattedDf["RMSE_Dec"].apply(f)))
-    formattedDf["Observability"] = formattedDf["StartObservability"].apply(tS) + formattedDf["EndObservability"].apply(
-        tE)
+    formattedDf["Observability"] = timeUtils.parseTimeColumn(formattedDf["StartObservability"]).dt.strftime(
+        "%H:%M") + " - " + timeUtils.parseTimeColumn(formattedDf["EndObservability"]).dt.strftime("%H:%M")
 
     formattedDf = formattedDf[columns].sort_values(by="RA")
 
     return formattedDf
 
 
+horizonBox = {  # TMO's horizon. {(decMin, decMax]: (minHourAngle, maxHourAngle)}, all in degrees. the dec windows must be sorted and touch
+    (-35, -34): (-35, 42.6104),
+    (-34, -32): (-35, 45.9539),
+    (-32, -30): (-35, 48.9586),
+    (-30, -28): (-35, 51.6945),
+    (-28, -26): (-35, 54.2121),
+    (-26, -24): (-35, 56.5487),
+    (-24, -22): (-35, 58.7332),
+    (-22, 0): (-35, 60),
+    (0, 46): (-52.5, 60),
+    (46, 56): (-37.5, 60),
+    (56, 65): (-30, 60)
+}
+# the horizon box as sorted arrays: the dec windows are (decEdges[i], decEdges[i+1]], with hour angle limits minHourAngles[i] to maxHourAngles[i]
+decEdges = np.array([decRange[0] for decRange in horizonBox] + [list(horizonBox)[-1][1]], dtype=float)
+minHourAngles = np.array([limits[0] for limits in horizonBox.values()], dtype=float)
+maxHourAngles = np.array([limits[1] for limits in horizonBox.values()], dtype=float)
+
+
+def hourAngleLimits(decs):
+    """
+    Get the hour angle limits of the observability windows of targets at many declinations at once
+    :param decs: float or array-like of declinations, in degrees
+    :return: tuple of float arrays (minHourAngle, maxHourAngle) in degrees, NaN for each dec outside the horizon box
+    """
+    decs = np.asarray(decs, dtype=float)
+    index = np.searchsorted(decEdges, decs, side="left") - 1  # decEdges[index] < dec <= decEdges[index + 1]
+    inBox = (index >= 0) & (index < len(minHourAngles))
+    index = np.clip(index, 0, len(minHourAngles) - 1)
+    return np.where(inBox, minHourAngles[index], np.nan), np.where(inBox, maxHourAngles[index], np.nan)
+
+
 def getHourAngleLimits(dec):
     """
     Get the hour angle limits of the target's observability window based on its dec.
     :param dec: float, int, or astropy Angle
-    :return: A tuple of Angle objects representing the upper and lower hour angle limits
+    :return: A tuple of Angle objects representing the upper and lower hour angle limits, or None if dec is outside the horizon box
     """
-    dec = ensureFloat(dec)
-
-    horizonBox = {  # {tuple(decWindow):tuple(minAlt,maxAlt)}
-        (-35, -34): (-35, 42.6104),
-        (-34, -32): (-35, 45.9539),
-        (-32, -30): (-35, 48.9586),
-        (-30, -28): (-35, 51.6945),
-        (-28, -26): (-35, 54.2121),
-        (-26, -24): (-35, 56.5487),
-        (-24, -22): (-35, 58.7332),
-        (-22, 0): (-35, 60),
-        (0, 46): (-52.5, 60),
-        (46, 56): (-37.5, 60),
-        (56, 65): (-30, 60)
-    }
-    for decRange in horizonBox:
-        if decRange[0] < dec <= decRange[1]:  # man this is miserable
-            finalDecRange = horizonBox[decRange]
-            return tuple([Angle(finalDecRange[0], unit=u.deg), Angle(finalDecRange[1], unit=u.deg)])
-    return None
+    minHourAngle, maxHourAngle = hourAngleLimits(ensureFloat(dec))
+    if np.isnan(minHourAngle):
+        return None
+    return Angle(float(minHourAngle), unit=u.deg), Angle(float(maxHourAngle), unit=u.deg)
@@ -0,0 +1,192 @@
+# Sage Santomenna 2023
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+from urllib.parse import parse_qsl
+
+import httpx
+
+# form fields whose values change from run to run (like the MPC's hours-from-now "start") and so shouldn't be used to match recordings
+DEFAULT_IGNORED_FIELDS = ("start",)
+
+
+class FixtureTransport(httpx.BaseTransport, httpx.AsyncBaseTransport):
+    """
+    Base class for the recording and replaying transports. Each distinct request is stored as one JSON file in the fixture directory, holding every response recorded for it in order.
+    Can be passed as the transport of either an httpx.Client or an httpx.AsyncClient.
+    """
+
+    def __init__(self, fixtureDir, ignoredFields=DEFAULT_IGNORED_FIELDS):
+        """
+        :param fixtureDir: directory that fixtures are read from/written to
+        :param ignoredFields: names of form fields to leave out when matching POST requests to recordings
+        """
+        self.fixtureDir = fixtureDir
+        self.ignoredFields = set(ignoredFields)
+        self.logger = logging.getLogger(__name__)
+
+    def requestKey(self, request: httpx.Request):
+        """
+        Make a stable identifier for a request from its method, url, and (form) body
+        :return: tuple (key, description), where key is a hex digest and description is a dict describing the request
+        """
+        body = request.content.decode("utf-8", errors="replace")
+        if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+            form = sorted((k, v) for k, v in parse_qsl(body, keep_blank_values=True) if k not in self.ignoredFields)
+            description = {"method": request.method, "url": str(request.url), "form": form}
+        else:
+            description = {"method": request.method, "url": str(request.url), "body": body}
+        key = hashlib.sha1(json.dumps(description, sort_keys=True).encode("utf-8")).hexdigest()
+        return key, description
+
+    def fixturePath(self, key):
+        return os.path.join(self.fixtureDir, key + ".json")
+
+    def loadFixture(self, key):
+        path = self.fixturePath(key)
+        if not os.path.isfile(path):
+            return None
+        with open(path, "r") as f:
+            return json.load(f)
+
+    @staticmethod
+    def _encodeResponse(response: httpx.Response, elapsed):
+        return {"status": response.status_code, "headers": dict(response.headers), "elapsed": elapsed,
+                "body": base64.b64encode(response.content).decode("ascii")}
+
+    @staticmethod
+    def _decodeResponse(recorded, request):
+        headers = {k: v for k, v in recorded["headers"].items() if
+                   k.lower() not in ("content-encoding", "transfer-encoding", "content-length")}  # body is stored decoded
+        return httpx.Response(recorded["status"], headers=headers, content=base64.b64decode(recorded["body"]),
+                              request=request)
+
+
+def recordedBodies(fixtureDir):
+    """
+    Iterate over the bodies of every response recorded in a fixture directory
+    :return: yields tuples (url, body bytes)
+    """
+    for name in sorted(os.listdir(fixtureDir)):
+        if not name.endswith(".json"):
+            continue
+        with open(os.path.join(fixtureDir, name), "r") as f:
+            fixture = json.load(f)
+        for recorded in fixture.get("responses", []):
+            yield fixture.get("url"), base64.b64decode(recorded["body"])
+
+
+class RecordingTransport(FixtureTransport):
+    """
+    Forwards requests to the network and saves every response into the fixture directory
+    """
+
+    def __init__(self, fixtureDir, ignoredFields=DEFAULT_IGNORED_FIELDS, **transportKwargs):
+        """
+        :param fixtureDir: directory to write fixtures to. Will be created if it doesn't exist
+        :param ignoredFields: names of form fields to leave out when matching POST requests to recordings
+        :param transportKwargs: passed through to the underlying httpx.HTTPTransport/AsyncHTTPTransport
+        """
+        super().__init__(fixtureDir, ignoredFields)
+        os.makedirs(fixtureDir, exist_ok=True)
+        self._syncTransport = httpx.HTTPTransport(**transportKwargs)
+        self._asyncTransport = httpx.AsyncHTTPTransport(**transportKwargs)
+
+    def _save(self, request, response, elapsed):
+        key, description = self.requestKey(request)
+        fixture = self.loadFixture(key) or dict(description, responses=[])
+        fixture["responses"].append(self._encodeResponse(response, elapsed))
+        with open(self.fixturePath(key), "w") as f:
+            json.dump(fixture, f)
+
+    def handle_request(self, request):
+        request.read()
+        startTime = time.perf_counter()
+        response = self._syncTransport.handle_request(request)
+        response.read()
+        self._save(request, response, time.perf_counter() - startTime)
+        return response
+
+    async def handle_async_request(self, request):
+        await request.aread()
+        startTime = time.perf_counter()
+        response = await self._asyncTransport.handle_async_request(request)
+        await response.aread()
+        self._save(request, response, time.perf_counter() - startTime)
+        return response
+
+    def close(self):
+        self._syncTransport.close()
+
+    async def aclose(self):
+        await self._asyncTransport.aclose()
+
+
+class ReplayTransport(FixtureTransport):
+    """
+    Serves responses from a fixture directory instead of the network, with configurable latency. Repeated requests get the recorded responses in order, repeating the last one once they run out
+    """
+
+    def __init__(self, fixtureDir, latency=None, latencyScale=1.0, jitter=0.0, strict=True,
+                 ignoredFields=DEFAULT_IGNORED_FIELDS):
+        """
+        :param fixtureDir: directory to read fixtures from
+        :param latency: seconds to wait before each response. If None, use the latency recorded with the response
+        :param latencyScale: multiply every latency by this factor
+        :param jitter: randomly vary each latency by up to this fraction of itself
+        :param strict: if True, requests with no recording raise httpx.ConnectError. If False, they get a 404
+        :param ignoredFields: names of form fields to leave out when matching POST requests to recordings
+        """
+        super().__init__(fixtureDir, ignoredFields)
+        if not os.path.isdir(fixtureDir):
+            raise ValueError("Fixture directory " + str(fixtureDir) + " not found")
+        self.latency = latency
+        self.latencyScale = latencyScale
+        self.jitter = jitter
+        self.strict = strict
+        self._fixtures = {}  # {key: fixture}, loaded lazily
+        self._served = {}  # {key: number of responses served}
+
+    def _delay(self, recorded):
+        delay = self.latency if self.latency is not None else recorded.get("elapsed", 0)
+        delay *= self.latencyScale
+        if self.jitter:
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return max(delay, 0)
+
+    def _lookup(self, request):
+        # Internal: find the recorded response for this request. Returns (recorded, None) or (None, errorResponse)
+        key, description = self.requestKey(request)
+        if key not in self._fixtures:
+            self._fixtures[key] = self.loadFixture(key)
+        fixture = self._fixtures[key]
+        if fixture is None or not fixture["responses"]:
+            self.logger.warning("No recorded response for " + request.method + " " + str(request.url))
+            if self.strict:
+                raise httpx.ConnectError("No recorded response for " + request.method + " " + str(request.url),
+                                         request=request)
+            return None, httpx.Response(404, request=request)
+        i = self._served.get(key, 0)
+        self._served[key] = i + 1
+        return fixture["responses"][min(i, len(fixture["responses"]) - 1)], None
+
+    def handle_request(self, request):
+        request.read()
+        recorded, missing = self._lookup(request)
+        if missing is not None:
+            return missing
+        time.sleep(self._delay(recorded))
+        return self._decodeResponse(recorded, request)
+
+    async def handle_async_request(self, request):
+        await request.aread()
+        recorded, missing = self._lookup(request)
+        if missing is not None:
+            return missing
+        await asyncio.sleep(self._delay(recorded))
+        return self._decodeResponse(recorded, request)
@@ -0,0 +1,216 @@
+# Sage Santomenna 2023
+# sun events and sidereal times for one observing night at one site, computed once and shared (through a file in the temp directory) by the coordinator, scheduler, and GUI
+#   python scheduleLib/nightContext.py
+#   python scheduleLib/nightContext.py --date 2023-06-28 --refresh
+import argparse
+import json
+import logging
+import os
+import re
+import tempfile
+from datetime import datetime, timedelta, timezone, date
+
+import numpy as np
+from astral import LocationInfo
+from astral import sun
+from astropy import units as u
+from astropy.time import Time
+
+TMO = LocationInfo(name="TMO", region="CA, USA", timezone="UTC", latitude=34.36, longitude=-117.63)
+
+CACHE_VERSION = 1  # bump when the file layout or the way anything is computed changes, so stale files get recomputed
+SUNSET_ELEVATION = -10  # what we call sunset: when the sun sets below this many degrees of elevation
+TWILIGHT_ELEVATION = -18  # astronomical twilight
+SIDEREAL_RATE = 1.00273790935  # sidereal days per solar day
+GRID_MINUTES = 10
+
+_contexts = {}  # {(siteKey, night): NightContext}, for this process
+
+
+def defaultCacheDir():
+    return os.path.join(tempfile.gettempdir(), "nightContext")
+
+
+def siteKey(observatory):
+    """
+    :param observatory: astral LocationInfo
+    :return: str identifying the site, safe to use in a file name
+    """
+    name = re.sub(r"[^A-Za-z0-9]+", "-", observatory.name)
+    return name + "_" + str(round(observatory.latitude, 4)) + "_" + str(round(observatory.longitude, 4))
+
+
+class NightContext:
+    """
+    Sunrise, sunset, twilight, and a sidereal time lookup table for the night that ends with the sunrise on a given (UTC) date, at one site. Get one with NightContext.get, which reuses what this process or any other has already computed
+    """
+
+    def __init__(self, observatory, night: date, gridMinutes=GRID_MINUTES):
+        """
+        Compute the context for a night. Slow-ish (astropy) - prefer NightContext.get
+        :param observatory: astral LocationInfo
+        :param night: the UTC date of the sunrise that ends the night
+        :param gridMinutes: spacing, in minutes, of the time grid the sidereal times are tabulated on
+        """
+        self.observatory = observatory
+        self.night = night
+        self.gridMinutes = gridMinutes
+        self.sunrise = sun.sunrise(observatory.observer, date=night, tzinfo=timezone.utc)
+        self.dawn = sun.time_at_elevation(observatory.observer, TWILIGHT_ELEVATION, date=night,
+                                          direction=sun.SunDirection.RISING, tzinfo=timezone.utc)
+        self.sunset = self._settingBefore(SUNSET_ELEVATION, self.sunrise)
+        self.dusk = self._settingBefore(TWILIGHT_ELEVATION, self.sunrise)
+        self.gridStart = self.sunset.replace(second=0, microsecond=0)
+        gridTimes = self.timeGrid()
+        self.lst = np.asarray(
+            Time(gridTimes, scale="utc").sidereal_time("apparent", longitude=observatory.longitude * u.deg).degree,
+            dtype=float)
+
+    def _settingBefore(self, elevation, sunrise):
+        # Internal: the time the sun last set below elevation before sunrise
+        setting = sun.time_at_elevation(self.observatory.observer, elevation, date=sunrise.date(),
+                                        direction=sun.SunDirection.SETTING, tzinfo=timezone.utc)
+        if setting > sunrise:
+            setting = sun.time_at_elevation(self.observatory.observer, elevation,
+                                            date=sunrise.date() - timedelta(days=1),
+                                            direction=sun.SunDirection.SETTING, tzinfo=timezone.utc)
+        return setting
+
+    @classmethod
+    def get(cls, observatory=None, when=None, cacheDir=None, refresh=False):
+        """
+        Get the context for the night that ends with the first sunrise after when, loading it from this process's cache or the cache directory if it's there and computing (and saving) it if not
+        :param observatory: astral LocationInfo. defaults to TMO
+        :param when: datetime (naive ones are taken to be utc). defaults to now
+        :param cacheDir: directory to keep the contexts in. defaults to a folder in the system temp directory
+        :param refresh: recompute even if the context is cached
+        :return: NightContext
+        """
+        observatory = observatory if observatory is not None else TMO
+        when = when if when is not None else datetime.now(timezone.utc)
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        night = when.astimezone(timezone.utc).date()
+        context = cls.forNight(observatory, night, cacheDir, refresh)
+        if context.sunrise < when:  # that night's over. we want the next one
+            context = cls.forNight(observatory, night + timedelta(days=1), cacheDir, refresh)
+        return context
+
+    @classmethod
+    def forNight(cls, observatory, night: date, cacheDir=None, refresh=False):
+        """
+        Get the context for the night that ends with the sunrise on the UTC date night. see get
+        :return: NightContext
+        """
+        key = (siteKey(observatory), night)
+        if not refresh and key in _contexts:
+            return _contexts[key]
+        cacheDir = cacheDir if cacheDir is not None else defaultCacheDir()
+        path = os.path.join(cacheDir, key[0] + "_" + night.isoformat() + ".json")
+        context = None if refresh else cls.load(path, observatory)
+        if context is None:
+            context = cls(observatory, night)
+            try:
+                context.save(path)
+            except OSError:
+                logging.getLogger(__name__).warning("Couldn't save night context to " + path)
+        _contexts[key] = context
+        return context
+
+    def siderealTime(self, when):
+        """
+        Local apparent sidereal time, interpolated from the table. Times far outside the night are computed with astropy instead
+        :param when: datetime (naive ones are taken to be utc), or a list of them
+        :return: sidereal time in degrees [0, 360), float (or numpy float array, for a list)
+        """
+        single = isinstance(when, datetime)
+        times = [when] if single else list(when)
+        hours = np.array([(_aware(t) - self.gridStart).total_seconds() / 3600 for t in times], dtype=float)
+        gridHours = np.arange(len(self.lst)) * self.gridMinutes / 60
+        if len(hours) and (hours.min() < -12 or hours.max() > gridHours[-1] + 12):
+            result = Time([_aware(t) for t in times], scale="utc").sidereal_time(
+                "apparent", longitude=self.observatory.longitude * u.deg).degree
+            result = np.asarray(result, dtype=float)
+        else:
+            unwrapped = np.unwrap(self.lst, period=360)
+            result = np.interp(hours, gridHours, unwrapped)
+            # past the ends of the table, go at the sidereal rate
+            result = np.where(hours < 0, unwrapped[0] + hours * 15 * SIDEREAL_RATE, result)
+            result = np.where(hours > gridHours[-1], unwrapped[-1] + (hours - gridHours[-1]) * 15 * SIDEREAL_RATE,
+                              result)
+            result = np.mod(result, 360)
+        return float(result[0]) if single else result
+
+    def timeGrid(self):
+        """
+        :return: list of utc datetimes, every gridMinutes minutes from (the minute of) sunset up to sunrise
+        """
+        steps = int((self.sunrise - self.gridStart).total_seconds() // (60 * self.gridMinutes)) + 1
+        return [self.gridStart + timedelta(minutes=self.gridMinutes * i) for i in range(steps)]
+
+    def toDict(self):
+        return {"version": CACHE_VERSION, "site": siteKey(self.observatory), "night": self.night.isoformat(),
+                "sunrise": self.sunrise.isoformat(), "sunset": self.sunset.isoformat(), "dawn": self.dawn.isoformat(),
+                "dusk": self.dusk.isoformat(), "gridStart": self.gridStart.isoformat(),
+                "gridMinutes": self.gridMinutes, "lst": self.lst.tolist()}
+
+    @classmethod
+    def fromDict(cls, d, observatory):
+        context = cls.__new__(cls)
+        context.observatory = observatory
+        context.night = date.fromisoformat(d["night"])
+        for name in ("sunrise", "sunset", "dawn", "dusk", "gridStart"):
+            setattr(context, name, datetime.fromisoformat(d[name]))
+        context.gridMinutes = d["gridMinutes"]
+        context.lst = np.asarray(d["lst"], dtype=float)
+        return context
+
+    def save(self, path):
+        """
+        Write the context to path as json, atomically, so other processes never read half a file
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tempPath = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.toDict(), f)
+            os.replace(tempPath, path)
+        except:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+            raise
+
+    @classmethod
+    def load(cls, path, observatory):
+        """
+        Read a context saved by save
+        :return: NightContext, or None if there isn't a (current, readable) one at path
+        """
+        try:
+            with open(path, "r") as f:
+                d = json.load(f)
+            if d.get("version") != CACHE_VERSION or d.get("site") != siteKey(observatory):
+                return None
+            return cls.fromDict(d, observatory)
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+
+def _aware(t):
+    # Internal: naive datetimes are utc
+    return t.replace(tzinfo=timezone.utc) if t.tzinfo is None else t
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compute (or show the cached) sun and sidereal times for a night at TMO")
+    parser.add_argument("--date", type=date.fromisoformat, default=None,
+                        help="UTC date (YYYY-MM-DD) of the sunrise that ends the night. Defaults to the coming night")
+    parser.add_argument("--refresh", action="store_true", help="Recompute and overwrite the cached context")
+    args = parser.parse_args()
+    if args.date is None:
+        context = NightContext.get(refresh=args.refresh)
+    else:
+        context = NightContext.forNight(TMO, args.date, refresh=args.refresh)
+    for name in ("sunset", "dusk", "dawn", "sunrise"):
+        print(name + ": " + getattr(context, name).isoformat())
+    print("sidereal time at sunset: " + str(round(context.lst[0] / 15, 4)) + " h, " + str(len(context.lst)) + " grid points")
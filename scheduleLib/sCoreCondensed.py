@@ -17,6 +17,9 @@ from astropy import time, units as u
 from astropy import time, units as u
 from astropy.coordinates import AltAz, EarthLocation, SkyCoord
 
+from scheduleLib import timeUtils
+from scheduleLib.nightContext import NightContext
+
 
 class Observation:
     # hell on earth, preferred method is fromLine
@@ -192,8 +195,9 @@ def angleToHMS(angle):
 
 # take time as string from scheduler, return time object
 def stringToTime(tstring):  # example input: 2022-12-26T05:25:00.000
-    time = datetime.strptime(tstring, '%Y-%m-%dT%H:%M:%S.000')
-    return time.replace(tzinfo=pytz.UTC)
+    if not tstring.endswith(".000"):
+        raise ValueError("time data " + repr(tstring) + " does not match format '%Y-%m-%dT%H:%M:%S.000'")
+    return timeUtils.parseTime(tstring[:-4], separator="T").replace(tzinfo=pytz.UTC)
 
 
 def timeToString(time):
@@ -334,10 +338,7 @@ def checkSunrise(schedule):
     if debug:
         sunriseUTC = stringToTime("2022-12-26T10:00:00.000")
     else:
-        loc = LocationInfo(name='TMO', region='CA, USA', timezone='UTC',
-                           latitude=34.36, longitude=-117.63)
-        s = sun(loc.observer, date=datetime.now(timezone.utc), tzinfo=timezone.utc)
-        sunriseUTC = s["sunrise"]
+        sunriseUTC = NightContext.get(when=schedule.tasks[0].startTime).sunrise  # the night the schedule starts in
     end = len(schedule.tasks) - 1
     lastLine = schedule.tasks[end]
     sunriseDiff = sunriseUTC - lastLine.endTime
@@ -0,0 +1,96 @@
+# Sage Santomenna 2023
+# parsing for the fixed-format time strings that the candidate database and schedules are full of, without a strptime call per string
+#   python scheduleLib/timeUtils.py --count 100000
+import argparse
+import functools
+import time
+from datetime import datetime
+
+import pandas as pd
+
+timeFormat = "%Y-%m-%d %H:%M:%S"  # what the candidate database stores, optionally with a fraction of a second
+
+
+@functools.lru_cache(maxsize=8192)
+def parseTime(timeString, separator=" "):
+    """
+    Parse 'YYYY-MM-DD HH:MM:SS', optionally followed by a fraction of a second (.f through .ffffff), into a naive datetime. Fixed-width strings are sliced apart instead of going through strptime, and strings seen recently come from a cache
+    :param timeString: str
+    :param separator: the character between the date and the time
+    :return: datetime
+    :raises ValueError: if timeString isn't in that format
+    """
+    if len(timeString) >= 19 and timeString[4] == "-" and timeString[7] == "-" and timeString[10] == separator and \
+            timeString[13] == ":" and timeString[16] == ":":
+        fraction = timeString[20:]
+        digits = timeString[0:4] + timeString[5:7] + timeString[8:10] + timeString[11:13] + timeString[14:16] + \
+                 timeString[17:19] + fraction
+        if (len(timeString) == 19 or (timeString[19] == "." and 0 < len(fraction) <= 6)) and digits.isascii() and \
+                digits.isdigit():
+            try:
+                return datetime(int(timeString[0:4]), int(timeString[5:7]), int(timeString[8:10]),
+                                int(timeString[11:13]), int(timeString[14:16]), int(timeString[17:19]),
+                                int(fraction.ljust(6, "0")) if fraction else 0)
+            except ValueError:
+                pass  # out of range, like month 13. let strptime say so
+    # anything else (like the unpadded fields strptime allows) goes the slow way
+    format = "%Y-%m-%d" + separator + "%H:%M:%S"
+    try:
+        return datetime.strptime(timeString, format)
+    except ValueError:
+        return datetime.strptime(timeString, format + ".%f")
+
+
+def parseTimeColumn(values, separator=" "):
+    """
+    parseTime for a whole column at once
+    :param values: pandas Series or sequence of time strings. datetimes pass through
+    :param separator: the character between the date and the time
+    :return: pandas Series of datetime64, with NaT wherever a value didn't parse
+    """
+    series = values if isinstance(values, pd.Series) else pd.Series(values)
+    format = "%Y-%m-%d" + separator + "%H:%M:%S"
+    parsed = pd.to_datetime(series, format=format, errors="coerce")  # the common case, in one pass
+    missing = parsed.isna() & series.notna()
+    if missing.any():
+        parsed[missing] = pd.to_datetime(series[missing], format=format + ".%f", errors="coerce")
+    return parsed
+
+
+def _strptimeParse(timeString):
+    # Internal: the way genUtils.stringToTime used to parse, to benchmark against
+    try:
+        return datetime.strptime(timeString, timeFormat)
+    except ValueError:
+        return datetime.strptime(timeString, timeFormat + ".%f")
+
+
+def benchmark(count=100000, distinct=500):
+    """
+    Time parsing count time strings, distinct of them different (as in a night's worth of candidates and schedule lines), each way
+    :return: dict {method: seconds}
+    """
+    strings = [(datetime(2023, 6, 27) + pd.Timedelta(minutes=i)).strftime(timeFormat) for i in range(distinct)]
+    strings = [strings[i % distinct] for i in range(count)]
+    methods = {"strptime": _strptimeParse, "parseTime (uncached)": parseTime.__wrapped__, "parseTime": parseTime,
+               "parseTimeColumn": None}
+    timings = {}
+    for name, method in methods.items():
+        parseTime.cache_clear()
+        startTime = time.perf_counter()
+        if method is None:
+            parseTimeColumn(strings)
+        else:
+            for s in strings:
+                method(s)
+        timings[name] = time.perf_counter() - startTime
+    return timings
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the speed of the time parsers")
+    parser.add_argument("--count", type=int, default=100000, help="Number of strings to parse")
+    parser.add_argument("--distinct", type=int, default=500, help="Number of different strings among them")
+    args = parser.parse_args()
+    for name, seconds in benchmark(args.count, args.distinct).items():
+        print(name + ": " + str(round(seconds, 4)) + " s (" + str(round(1e6 * seconds / args.count, 3)) + " us/string)")
@@ -488,20 +488,20 @@ def createSchedule(startTime, endTime, savepath):
         exit()
     for c in candidates:
         c.RA = genUtils.ensureAngle(str(c.RA) + "h")
-        c.Dec = genUtils.ensureAngle(float(c.Dec))
+        c.Dec = genUtils.ensureAngle(c.typed("Dec"))
 
     designations = [candidate.CandidateName for candidate in candidates]
     print("Candidates to schedule:", designations)
     candidateDict = dict(zip(designations, candidates))
 
     # constraint on when the observation can *start*
-    timeConstraintDict = {c.CandidateName: TimeConstraint(Time(stringToTime(c.StartObservability)),
-                                                          Time(stringToTime(c.EndObservability) - timedelta(
-                                                              seconds=float(c.NumExposures) * float(c.ExposureTime))))
+    timeConstraintDict = {c.CandidateName: TimeConstraint(Time(c.typed("StartObservability")),
+                                                          Time(c.typed("EndObservability") - timedelta(
+                                                              seconds=c.typed("NumExposures") * c.typed("ExposureTime"))))
                           for c in candidates}
-    timeDict = {c.CandidateName: (Time(stringToTime(c.StartObservability)),
-                                  Time(stringToTime(c.EndObservability) - timedelta(
-                                      seconds=float(c.NumExposures) * float(c.ExposureTime))))
+    timeDict = {c.CandidateName: (Time(c.typed("StartObservability")),
+                                  Time(c.typed("EndObservability") - timedelta(
+                                      seconds=c.typed("NumExposures") * c.typed("ExposureTime"))))
                 for c in candidates}
     print(timeDict)
     typeSpecificConstraints = {}  # make a dict of constraints to put on all targets of a given type (specified by specs (config) py file)
@@ -512,7 +512,7 @@ def createSchedule(startTime, endTime, savepath):
     # print("Candidates:", candidates)
     blocks = []
     for c in candidates:
-        exposureDuration = float(c.NumExposures) * float(c.ExposureTime)
+        exposureDuration = c.typed("NumExposures") * c.typed("ExposureTime")
         name = c.CandidateName
         specConstraints = typeSpecificConstraints[c.CandidateType]
         aggConstraints = [timeConstraintDict[name]]
@@ -6,8 +6,7 @@ from datetime import datetime as dt, timedelta
 
 from colorlog import ColoredFormatter
 
-from mpcCandidateLogger import runLogging
-from mpcCandidateSelector import selectTargets
+from mpcCycle import runCycle
 
 try:
     grandparentDir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir))
@@ -48,17 +47,11 @@ interval = 15  # minutes between runs
 lookback = 48  # edit targets that were added within [lookback] hours ago, add a duplicate for older
 
 logger.info("---Starting cycle at "+ dt.now().strftime(dateFormat) + " PST")
+# logging and selection share one event loop, http pool, and database connection. each stage catches its own failures
 try:
-    asyncio.run(runLogging(logger,lookback, dbPath))
-    logger.info("---Finished MPC logging without error at " + dt.now().strftime(dateFormat) + " PST")
+    asyncio.run(runCycle(logger, lookback, dbPath))
 except Exception:
-    logger.exception("---Logging targets failed! Skipping.")
-
-try:
-    asyncio.run(selectTargets(logger,lookback, dbPath))
-    logger.info("---Finished MPC selection without error at " + dt.now().strftime(dateFormat) + " PST")
-except Exception:
-    logger.exception("Selecting targets failed! Skipping.")
+    logger.exception("---Cycle failed!")
 
 # logger.info("---Done. will run again at " + (dt.now() + timedelta(minutes=interval)).strftime(dateFormat) + " PST.")
 logger.info("---Done---")
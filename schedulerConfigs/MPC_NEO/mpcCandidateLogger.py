@@ -3,20 +3,19 @@ import logging
 from datetime import datetime as dt, timedelta
 
 from colorlog import ColoredFormatter
-from photometrics.mpc_neo_confirm import MPCNeoConfirm as mpcObj
 
 try:
     grandparentDir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir))
     sys.path.append(
         grandparentDir)
-    from scheduleLib import genUtils
-    from scheduleLib.candidateDatabase import CandidateDatabase, Candidate
+    from scheduleLib import angleUtils, genUtils
+    from scheduleLib.candidateDatabase import CandidateDatabase, Candidate, AsyncCandidateDatabase
     from schedulerConfigs.MPC_NEO.mpcTargetSelectorCore import TargetSelector
     from schedulerConfigs.MPC_NEO import mpcUtils
     sys.path.remove(grandparentDir)
 except:
-    from scheduleLib import genUtils
-    from scheduleLib.candidateDatabase import CandidateDatabase, Candidate
+    from scheduleLib import angleUtils, genUtils
+    from scheduleLib.candidateDatabase import CandidateDatabase, Candidate, AsyncCandidateDatabase
     from schedulerConfigs.MPC_NEO.mpcTargetSelectorCore import TargetSelector
     from schedulerConfigs.MPC_NEO import mpcUtils
 
@@ -33,21 +32,40 @@ async def testGetVelocities(desig, mpc, logger, targetSelector):  # get dRA and
 
 
 async def getVelocities(desig, mpc, logger, targetSelector):  # get dRA and dDec
+    return (await getVelocitiesBatch([desig], mpc, logger, targetSelector))[desig]
+
+
+async def getVelocitiesBatch(desigs, mpc, logger, targetSelector, results=None):
+    """
+    Get dRA and dDec for many targets with one batch of concurrent ephemeris requests
+    :param results: optional mpcCycle.CycleResults to keep the ephemerides that were retrieved in, for the selection stage
+    :return: dict of {desig: (dRA, dDec)} in "/min, with (None, None) for targets whose ephemeris couldn't be retrieved
+    """
+    desigs = list(desigs)
     try:
-        ephems = await mpcUtils.asyncMultiEphem([desig], dt.utcnow(), 0, mpc, targetSelector.asyncHelper, logger,
+        ephems = await mpcUtils.asyncMultiEphem(desigs, dt.utcnow(), 0, mpc, targetSelector.asyncHelper, logger,
                                                 obsCode=500)
     except:
-        logger.exception("Encountered exception while trying to get ephems for " + desig)
-        return None, None
-    if desig in ephems.keys():
-        first = ephems[desig][0]
-        return round(float(first[3]) * 60, 2), round(float(first[4]) * 60, 2)  # we want "/minute
-    else:
-        logger.info("Can't get velocity for " + desig + ": couldn't get ephemeris.")
-    return None, None
+        logger.exception("Encountered exception while trying to get ephems for " + str(desigs))
+        ephems = {}
+    velocities = {}
+    for desig in desigs:
+        if ephems.get(desig):
+            if results is not None:  # failed lookups are left out, so the selector asks again
+                results.ephems[desig] = ephems[desig]
+            first = ephems[desig][0]
+            velocities[desig] = round(float(first[3]) * 60, 2), round(float(first[4]) * 60, 2)  # we want "/minute
+        else:
+            logger.info("Can't get velocity for " + desig + ": couldn't get ephemeris.")
+            velocities[desig] = None, None
+    return velocities
 
 
-async def listEntryToCandidate(entry, mpc, logger, targetSelector):
+def listEntryToCandidate(entry, observatory, transitTime=None):
+    """
+    Build a Candidate from an entry in the MPC's NEO confirmation list. Doesn't touch the network - velocities are filled in afterward by addVelocities
+    :param transitTime: the entry's transit time, if already found (as by genUtils.findTransitTimes for the whole list). computed if not given
+    """
     constructDict = {}
     CandidateName = entry.designation
     CandidateType = "MPC NEO"
@@ -57,16 +75,22 @@ async def listEntryToCandidate(entry, mpc, logger, targetSelector):
     constructDict["NumExposures"] = float(expPair[0])
     constructDict["ExposureTime"] = float(expPair[1])  # duration of observation, in seconds
     constructDict["Updated"] = genUtils.timeToString(mpcUtils.updatedStringToDatetime(entry.updated))
-    dRA, dDec = await getVelocities(CandidateName, mpc, logger, targetSelector)
     # currently, can't get nObs and Score from mpc_neo_confirm. not going to implement it myself - we'll go without
+    if transitTime is None:
+        transitTime = genUtils.findTransitTimes([entry.ra], observatory, unit=angleUtils.HOURS)[0]
+    constructDict["TransitTime"] = genUtils.timeToString(transitTime)
+    return Candidate(CandidateName, CandidateType, **constructDict)
+
+
+def addVelocities(candidate: Candidate, velocities, logger):
+    """
+    Set dRA and dDec of candidate from the output of getVelocitiesBatch
+    """
+    dRA, dDec = velocities.get(candidate.CandidateName, (None, None))
     if dRA is not None and dDec is not None:
-        constructDict["dRA"], constructDict["dDec"] = dRA, dDec
+        candidate.dRA, candidate.dDec = str(dRA), str(dDec)
     else:
-        logger.warning("Couldn't find velocities for " + CandidateName)
-
-    constructDict["TransitTime"] = genUtils.timeToString(
-        genUtils.findTransitTime(genUtils.ensureAngle(str(constructDict["RA"]) + "h"), targetSelector.observatory))
-    return Candidate(CandidateName, CandidateType, **constructDict)
+        logger.warning("Couldn't find velocities for " + candidate.CandidateName)
 
 
 def candidateIsRemoved(candidate):
@@ -77,85 +101,149 @@ def needsUpdate(listEntry, dbEntry):
     return genUtils.stringToTime(listEntry.Updated) > genUtils.stringToTime(dbEntry.Updated)
 
 
+fingerprintFields = ["Updated", "RA", "Dec", "Magnitude"]  # what changes in the MPC's list entry when the target's orbit is updated
+fetchedFields = ["dRA", "dDec", "RMSE_RA", "RMSE_Dec"]  # what we have to ask the MPC for separately
+
+
+def fingerprint(candidate: Candidate):
+    """
+    A compact, comparable summary of the list-entry fields of a candidate. Numbers are rounded so values that went through the database compare equal to fresh ones
+    :return: tuple
+    """
+    values = []
+    for field in fingerprintFields:
+        value = getattr(candidate, field, None) if candidate.hasField(field) else None
+        try:
+            value = round(float(value), 5)
+        except (TypeError, ValueError):
+            value = None if value is None else str(value).strip()
+        values.append(value)
+    return tuple(values)
+
+
+def isUnchanged(listCandidate: Candidate, dbCandidate: Candidate):
+    """
+    Is the candidate built from the MPC's list the same as the one we already have, with nothing left to fetch?
+    :return: bool
+    """
+    if not all(dbCandidate.hasField(field) for field in fetchedFields):
+        return False  # we never got (or lost) its velocities or uncertainties, so treat it as changed and try again
+    return fingerprint(listCandidate) == fingerprint(dbCandidate)
+
+
 def updateCandidate(dbCandidate: Candidate, listCandidate: Candidate, dbConnection: CandidateDatabase):
     id = dbCandidate.ID
     dbConnection.editCandidateByID(id, listCandidate.asDict())
 
 
 # this is where everything happens
-async def runLogging(logger, lookback, candidateDbPath):
-    mpc = mpcObj()
-    targetSelector = TargetSelector()
-    dbConnection = CandidateDatabase(candidateDbPath, "MPCLogger")
+async def runLogging(logger, lookback, candidateDbPath, mpc=None, targetSelector=None, dbConnection=None,
+                     results=None, resources=None):
+    """
+    Pull the MPC's NEO confirmation list and sync it into the candidate database
+    :param lookback: candidates added within [lookback] hours are updated in place. older ones are added again
+    :param mpc: optional MPCNeoConfirm (or stand-in, like a replaying one from mpcFixtures) to fetch the list with
+    :param targetSelector: optional TargetSelector to make requests with. pass one built with a replay transport to run offline
+    :param dbConnection: optional open CandidateDatabase or AsyncCandidateDatabase to use instead of connecting to candidateDbPath. left open
+    :param results: optional mpcCycle.CycleResults to keep the fetched ephemerides and uncertainties in
+    :param resources: optional SelectorResources to build the TargetSelector on, if one isn't given
+    """
+    ownSelector = targetSelector is None
+    if ownSelector:
+        targetSelector = TargetSelector(mpc=mpc, resources=resources)
+    if mpc is None:
+        mpc = targetSelector.mpc
+    if dbConnection is None:
+        dbConnection = CandidateDatabase(candidateDbPath, "MPCLogger")
+    db, ownDb = AsyncCandidateDatabase.wrap(dbConnection)
 
     logger.info("--- Acquiring Candidates ---")
     currentCandidates = {}  # store desig:candidate for each candidate in the MPC's list of current candidates
-    mpc.get_neo_list()  # prompt the mpc object to fetch the list
+    # prompt the mpc object to fetch the list, reading the candidates added to the db in the last [lookback] hours while we wait
+    dbCandidates, _ = await asyncio.gather(db.candidatesAddedSince(dt.utcnow() - timedelta(hours=lookback)),
+                                           asyncio.get_running_loop().run_in_executor(None, mpc.get_neo_list))
     logger.info("Constructing Candidates from MPC List")
     if mpc.neo_confirm_list is None:
         raise ConnectionError("Can't get list of candidates from MPC. Check internet connection")
-    for entry in mpc.neo_confirm_list:  # access the list and create dict
-        ent = await listEntryToCandidate(entry, mpc, logger, targetSelector)  # transform list entries to candidates
+    # one sidereal time for the whole list
+    transitTimes = genUtils.findTransitTimes([entry.ra for entry in mpc.neo_confirm_list], targetSelector.observatory,
+                                             unit=angleUtils.HOURS)
+    for entry, transitTime in zip(mpc.neo_confirm_list, transitTimes):  # access the list and create dict
+        ent = listEntryToCandidate(entry, targetSelector.observatory, transitTime)  # transform list entries to candidates
         currentCandidates[ent.CandidateName] = ent
-    logger.info("Construction complete.")
-    logger.info("Querying the MPC for uncertainties...")
-    desigs = currentCandidates.keys()
-    offsetDict = await targetSelector.fetchUncertainties(desigs)
-    for desig in desigs:  # loop over the candidates and find their uncertainties, adding them to the candidate object
-        uncertainties = list(TargetSelector.extractUncertainty(desig, offsetDict, logger, graph=False,
-                                                               savePath="testingOutputs/plots"))  # why did i protect this? who knows
-        if uncertainties is not None:
-            currentCandidates[desig].RMSE_RA, currentCandidates[desig].RMSE_Dec = uncertainties[0:2]
-            currentCandidates[desig].ApproachColor = uncertainties[-1]
-        else:
-            logger.warning("Uncertainty query for " + desig + " came back empty.")
-    logger.info("Queried.")
-    static = []
+    static = []  # candidates that appear in both the list and the database and haven't changed
     updated = []  # candidates that appear in both the list and the database and may need to be updated
     new = []  # candidates that appear in the list but not in the database
     removed = []  # candidates that appear in the database but not in the list
-    dbCandidates = dbConnection.candidatesAddedSince(
-        dt.utcnow() - timedelta(hours=lookback))  # candidates added to the db in the last [lookback] hours
-
-    if dbCandidates:
-        dbCandidates = {a.CandidateName: a for a in dbCandidates if a.CandidateType == "MPC NEO"}
-        for desig, candidate in currentCandidates.items():
-            if desig in dbCandidates.keys():
-                if candidateIsRemoved(dbCandidates[desig]):
-                    logger.warning(
-                        "That's odd. Candidate " + desig + " found in MPC table but marked as removed in database. Skipping and moving on.")
-                    static.append(candidate)
-                    continue
-                # logger.debug("Checking for updates to" + desig)
-                # if needsUpdate(candidate, dbCandidates[desig]):
-                logger.info("Updating " + desig)
-                updateCandidate(dbCandidates[desig], candidate, dbConnection)
-                updated.append(candidate)
-                # else:
-                #     static.append(candidate)
-                #     logger.debug("None found")
-                #     continue
+    dbCandidates = {a.CandidateName: a for a in dbCandidates if a.CandidateType == "MPC NEO"} if dbCandidates else {}
+
+    # only ask the MPC about the candidates that are new or have changed since we last saw them
+    toQuery = []
+    for desig, candidate in currentCandidates.items():
+        if desig not in dbCandidates.keys():
+            toQuery.append(desig)
+        elif candidateIsRemoved(dbCandidates[desig]):
+            logger.warning(
+                "That's odd. Candidate " + desig + " found in MPC table but marked as removed in database. Skipping and moving on.")
+            static.append(candidate)
+        elif isUnchanged(candidate, dbCandidates[desig]):
+            static.append(candidate)
+        else:
+            toQuery.append(desig)
+    logger.info(str(len(currentCandidates) - len(toQuery)) + " candidate(s) unchanged since the last cycle.")
+
+    if toQuery:
+        logger.info("Querying the MPC for velocities and uncertainties of " + str(len(toQuery)) + " candidate(s)...")
+        # all the requests for both go out at once, so this takes about as long as the slowest one
+        velocities, offsetDict = await asyncio.gather(
+            getVelocitiesBatch(toQuery, mpc, logger, targetSelector, results),
+            targetSelector.fetchUncertainties(toQuery))
+        if results is not None:
+            results.offsets.update(offsetDict)
+        for desig in toQuery:  # loop over the candidates and find their uncertainties, adding them to the candidate object
+            addVelocities(currentCandidates[desig], velocities, logger)
+            uncertainties = list(TargetSelector.extractUncertainty(desig, offsetDict, logger, graph=False,
+                                                                   savePath="testingOutputs/plots"))  # why did i protect this? who knows
+            if uncertainties is not None:
+                currentCandidates[desig].RMSE_RA, currentCandidates[desig].RMSE_Dec = uncertainties[0:2]
+                currentCandidates[desig].ApproachColor = uncertainties[-1]
             else:
-                new.append(candidate)
-                continue
-
-        for candidate in dbCandidates.values():
-            if candidate.CandidateName not in currentCandidates.keys() and not candidateIsRemoved(
-                    candidate):  # remove these candidates
-                logger.info(
-                    "Candidate " + candidate.CandidateName + " is in the database but not in the MPC table. Marking as removed.")
-                ID = candidate.ID
-                dbConnection.removeCandidateByID(ID, "Target removed from MPC list")
-                removed.append(candidate)
-    else:
+                logger.warning("Uncertainty query for " + desig + " came back empty.")
+        logger.info("Queried.")
+    logger.info("Construction complete.")
+
+    if not dbCandidates:
         logger.info(
             "No candidates added in the last " + str(lookback) + " hours. Adding all targets in list.")
-        new = list(currentCandidates.values())
+    toWrite = []  # the whole snapshot goes into the database as one batch of upserts
+    for desig in toQuery:
+        candidate = currentCandidates[desig]
+        if desig in dbCandidates.keys():
+            logger.info("Updating " + desig)
+            candidate.ID = dbCandidates[desig].ID  # rows from before IDs were stable keep the ID they have
+            updated.append(candidate)
+        else:
+            new.append(candidate)
+        toWrite.append(candidate)
+    for candidate in static:  # the transit time moves with the date even when the MPC's entry doesn't
+        dbCandidate = dbCandidates[candidate.CandidateName]
+        if not candidateIsRemoved(dbCandidate) and getattr(dbCandidate, "TransitTime", None) != candidate.TransitTime:
+            toWrite.append(Candidate(candidate.CandidateName, candidate.CandidateType, ID=dbCandidate.ID,
+                                     TransitTime=candidate.TransitTime))
+    # a candidate added before the lookback window shares its ID with the new one, so it is added again in place rather than duplicated
+    ids, failures = await db.upsertCandidates(toWrite, readdBefore=dt.utcnow() - timedelta(hours=lookback))
+    if failures:
+        logger.error("Failed to write " + str(len(failures)) + " candidate(s)")
+    for candidate, ID in zip(toWrite, ids):
+        if candidate.CandidateName not in dbCandidates.keys():
+            logger.debug("Created " + candidate.CandidateName + " with ID " + str(ID) + ".")
 
-    for candidate in new:  # add these
-        newID = dbConnection.insertCandidate(candidate)
-        logger.debug(
-            "Created " + candidate.CandidateName + " with ID " + str(newID) + ".")
+    removedNames = await db.removeCandidatesNotIn(list(currentCandidates.keys()), "Target removed from MPC list",
+                                                  condition="CandidateType IS \"MPC NEO\"", timeColumn="DateAdded",
+                                                  after=dt.utcnow() - timedelta(hours=lookback))
+    for name in removedNames:
+        logger.info("Candidate " + name + " is in the database but not in the MPC table. Marked as removed.")
+        removed.append(dbCandidates.get(name, name))
 
     logger.info("-Assessed Candidates")
     logger.info("New (" + str(len(new)) + ")")
@@ -169,7 +257,11 @@ async def runLogging(logger, lookback, candidateDbPath):
 
     # generalUtils.logAndPrint("Done. will run again at "+dbConnection.timeToString(dt.now()+timedelta(minutes=interval))+" PST.",logger.info)
     # print("\n")
-    del dbConnection  # close the connection to unlock db
+    if ownDb:
+        db.close()
+    del dbConnection  # close the connection to unlock db (if it's ours)
+    if ownSelector:
+        await targetSelector.aclose()
 
 
 if __name__ == "__main__":
@@ -7,13 +7,13 @@ try:
     sys.path.append(
         grandparentDir)
     from scheduleLib import genUtils
-    from scheduleLib.candidateDatabase import CandidateDatabase
+    from scheduleLib.candidateDatabase import CandidateDatabase, AsyncCandidateDatabase
     from schedulerConfigs.MPC_NEO.mpcTargetSelectorCore import TargetSelector
     sys.path.remove(grandparentDir)
 
 except:
     from scheduleLib import genUtils
-    from scheduleLib.candidateDatabase import CandidateDatabase
+    from scheduleLib.candidateDatabase import CandidateDatabase, AsyncCandidateDatabase
     from schedulerConfigs.MPC_NEO.mpcTargetSelectorCore import TargetSelector
 
 
@@ -21,26 +21,42 @@ except:
 # check if they have a removal reason. if they do, ignore them
 # if they don't, do the selection process, marking rejected reason if they're not observable by TMO
 
-async def selectTargets(logger, lookback, dbPath):
+async def selectTargets(logger, lookback, dbPath, targetSelector=None, dbConnection=None, results=None,
+                        resources=None):
+    """
+    Find observability windows for the MPC NEO candidates in the database, and reject the ones we can't or shouldn't observe
+    :param lookback: evaluate candidates added within [lookback] hours
+    :param targetSelector: optional TargetSelector to make requests with. pass one built with a replay transport to run offline
+    :param dbConnection: optional open CandidateDatabase or AsyncCandidateDatabase to use instead of connecting to dbPath. left open
+    :param results: optional mpcCycle.CycleResults from the logging stage, to reuse instead of asking the MPC again
+    :param resources: optional SelectorResources to build the TargetSelector on, if one isn't given
+    """
     logger.info("--- Selecting ---")
 
-    dbConnection = CandidateDatabase(dbPath, "MPC Selector")
-    targetSelector = TargetSelector()
+    if dbConnection is None:
+        dbConnection = CandidateDatabase(dbPath, "MPC Selector")
+    ownSelector = targetSelector is None
+    if ownSelector:
+        targetSelector = TargetSelector(resources=resources)
+    db, ownDb = AsyncCandidateDatabase.wrap(dbConnection)
 
-    candidates = dbConnection.table_query("Candidates", "*",
-                                          "RemovedReason IS NULL AND CandidateType IS \"MPC NEO\" AND DateAdded > ?",
-                                          [dt.utcnow() - timedelta(hours=lookback)], returnAsCandidates=True)
+    candidates = await db.queryByTime("DateAdded", after=dt.utcnow() - timedelta(hours=lookback),
+                                      condition="RemovedReason IS NULL AND CandidateType IS \"MPC NEO\"")
     if candidates is None:
         logger.info("Candidate Selector: Didn't find any targets in need of updating. All set!")
-        del dbConnection  # explicitly deleting these to make sure they close nicely
-        del targetSelector
-        exit()
+        if ownDb:
+            db.close()
+        del dbConnection  # explicitly deleting this to make sure it closes nicely
+        if ownSelector:
+            await targetSelector.aclose()
+        return
     else:
         logger.info("Finding observability and evaluating " + str(len(candidates)) + " objects.")
 
     designations = [candidate.CandidateName for candidate in candidates]
     candidateDict = dict(zip(designations, candidates))
-    windows = await targetSelector.calculateObservability(designations)
+    firstEphems = results.ephemsFor(targetSelector.altitudeLimit) if results is not None else None
+    windows = await targetSelector.calculateObservability(designations, firstEphems=firstEphems)
     candidatesWithWindows = []
     rejected = []  # we're going to later wipe the rejected status of all candidates that are not marked rejected (in case they had been rejected in the past)
     for desig, window in windows.items():
@@ -60,8 +76,11 @@ async def selectTargets(logger, lookback, dbPath):
     logger.info("Rejecting targets")
     for desig, candidate in candidateDict.items():
         if not candidate.hasField("RMSE_RA") or not candidate.hasField("RMSE_Dec"):
-            logger.info("Retrying uncertainty on " + desig)
-            offsetDict = await targetSelector.fetchUncertainties([desig])
+            if results is not None and desig in results.offsets:
+                offsetDict = {desig: results.offsets[desig]}
+            else:
+                logger.info("Retrying uncertainty on " + desig)
+                offsetDict = await targetSelector.fetchUncertainties([desig])
             uncertainties = list(TargetSelector.extractUncertainty(desig, offsetDict, logger, graph=False,
                                                                    savePath="testingOutputs/plots"))
             if None not in uncertainties:
@@ -73,27 +92,36 @@ async def selectTargets(logger, lookback, dbPath):
                 logger.debug("Rejected " + desig + " for incomplete information.")
                 candidateDict[desig].RejectedReason = "Incomplete"
                 continue
-        if float(candidate.Magnitude) > targetSelector.vMagMax:
+        if float(candidate.typed("Magnitude")) > targetSelector.vMagMax:
             candidateDict[desig].RejectedReason = "vMag"
             rejected.append(desig)
             logger.debug("Rejected " + desig + " for magnitude limit.")
             continue
-        if float(candidate.RMSE_RA) > targetSelector.raMaxRMSE or float(candidate.RMSE_Dec) > targetSelector.decMaxRMSE:
+        if float(candidate.typed("RMSE_RA")) > targetSelector.raMaxRMSE or float(candidate.typed("RMSE_Dec")) > targetSelector.decMaxRMSE:
             rejected.append(desig)
             candidateDict[desig].RejectedReason = "RMSE"
             logger.debug("Rejected " + desig + " for error limit.")
             continue
 
+    toNull = []
     for desig in candidatesWithWindows:  # if the candidates were rejected before but aren't rejected this time through, we assume something has changed and they are now viable, so we remove their rejected reason
         candidate = candidateDict[desig]
         if desig not in rejected and candidate.hasField("RejectedReason"):
             delattr(candidate, "RejectedReason")
-            dbConnection.setFieldNullByID(candidate.ID, "RejectedReason")
+            toNull.append((candidate.ID, "RejectedReason"))
     logger.info("Updating database")
-    for desig, candidate in candidateDict.items():
-        dbConnection.editCandidateByID(candidate.ID, candidate.asDict())
-        logger.debug("Updated " + desig + ".")
+    db.defer("nullFields", toNull)
+    updatedIDs, failures = await db.updateCandidates(
+        [(candidate.ID, candidate.asDict()) for candidate in candidateDict.values()])
+    logger.debug("Updated " + str(len(updatedIDs)) + " candidate(s).")
+    for ID in failures.keys():
+        logger.warning("Failed to update candidate with ID " + str(ID) + ".")
+    await db.flush()
+    if ownDb:
+        db.close()
     del dbConnection
+    if ownSelector:
+        await targetSelector.aclose()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,103 @@
+# Sage Santomenna 2023
+# one logging + selection cycle, with both stages sharing an event loop, http pool, and the results they fetch
+import asyncio
+import logging
+import os
+import sys
+import time
+from datetime import datetime as dt
+
+try:
+    grandparentDir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir))
+    sys.path.append(
+        grandparentDir)
+    from scheduleLib.candidateDatabase import CandidateDatabase, AsyncCandidateDatabase
+    from schedulerConfigs.MPC_NEO.mpcTargetSelectorCore import TargetSelector, SelectorResources
+    from schedulerConfigs.MPC_NEO.mpcCandidateLogger import runLogging
+    from schedulerConfigs.MPC_NEO.mpcCandidateSelector import selectTargets
+    sys.path.remove(grandparentDir)
+except:
+    from scheduleLib.candidateDatabase import CandidateDatabase, AsyncCandidateDatabase
+    from schedulerConfigs.MPC_NEO.mpcTargetSelectorCore import TargetSelector, SelectorResources
+    from schedulerConfigs.MPC_NEO.mpcCandidateLogger import runLogging
+    from schedulerConfigs.MPC_NEO.mpcCandidateSelector import selectTargets
+
+dateFormat = '%m/%d/%Y %H:%M:%S'
+
+
+class CycleResults:
+    """
+    Per-designation results fetched by one stage of a cycle, kept so the next stage doesn't have to ask the MPC again
+    """
+
+    def __init__(self):
+        self.ephems = {}  # {desig: list of ephem lines} starting now, at the geocenter (500) with no altitude limit
+        self.offsets = {}  # {desig: [PreBlock of offsets page]}, as from TargetSelector.fetchUncertainties, for each target whose uncertainty was retrieved
+
+    def ephemsFor(self, altitudeLimit):
+        """
+        The stored ephemerides, if they're what a request with this altitude limit would have returned
+        :return: dict {desig: ephem lines}, or None
+        """
+        if float(altitudeLimit) != 0 or not self.ephems:
+            return None
+        return self.ephems
+
+
+async def runCycle(logger, lookback, dbPath, targetSelector=None, mpc=None, resources=None):
+    """
+    Log the MPC's NEO confirmation list into the candidate database, then select targets from it. A failure in one stage is logged and doesn't stop the other
+    :param lookback: hours; passed to both stages
+    :param targetSelector: optional TargetSelector to make requests with. pass one built with a replay transport to run offline
+    :param mpc: optional MPCNeoConfirm (or stand-in) to fetch the list with
+    :param resources: optional SelectorResources (http clients, mpc retriever, night context) to build the selector on, so repeated cycles can share them. left open
+    :return: dict {stage: seconds}
+    """
+    ownResources = resources is None and targetSelector is None
+    if ownResources:
+        resources = SelectorResources(mpc=mpc)
+    if targetSelector is None:
+        targetSelector = TargetSelector(resources=resources)  # both stages share its clients
+    if mpc is None:
+        mpc = targetSelector.mpc
+    # each stage writes as its own author, as when they ran separately. the stages run one after the other, so the two connections never contend
+    connections = {"logging": CandidateDatabase(dbPath, "MPCLogger"), "selection": CandidateDatabase(dbPath, "MPC Selector")}
+    results = CycleResults()
+    timings = {}
+
+    startTime = time.perf_counter()
+    dbConnection = AsyncCandidateDatabase(connections["logging"])  # queues the stage's reads and writes on its own thread
+    try:
+        await runLogging(logger, lookback, dbPath, mpc=mpc, targetSelector=targetSelector, dbConnection=dbConnection,
+                         results=results)
+        logger.info("---Finished MPC logging without error at " + dt.now().strftime(dateFormat) + " PST")
+    except Exception:
+        logger.exception("---Logging targets failed! Skipping.")
+    finally:
+        dbConnection.close()
+    timings["logging"] = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    dbConnection = AsyncCandidateDatabase(connections["selection"])
+    try:
+        await selectTargets(logger, lookback, dbPath, targetSelector=targetSelector, dbConnection=dbConnection,
+                            results=results)
+        logger.info("---Finished MPC selection without error at " + dt.now().strftime(dateFormat) + " PST")
+    except Exception:
+        logger.exception("Selecting targets failed! Skipping.")
+    finally:
+        dbConnection.close()
+    timings["selection"] = time.perf_counter() - startTime
+    timings["total"] = timings["logging"] + timings["selection"]
+
+    if ownResources:
+        await resources.aclose()
+    for connection in connections.values():
+        connection.close()  # to unlock the db
+    return timings
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', datefmt=dateFormat, level=logging.INFO)
+    dbPath = sys.argv[1] if len(sys.argv) > 1 else "./candidate database.db"
+    print(asyncio.run(runCycle(logging.getLogger(__name__), 48, dbPath)))
@@ -0,0 +1,181 @@
+# Sage Santomenna 2023
+# record the MPC responses seen during one logging + selection cycle, then replay them offline to time the pipeline
+#   python schedulerConfigs/MPC_NEO/mpcFixtures.py record fixtures/mpc "files/candidate database.db"
+#   python schedulerConfigs/MPC_NEO/mpcFixtures.py replay fixtures/mpc --latency 0.5 --repeat 3
+#   python schedulerConfigs/MPC_NEO/mpcFixtures.py pre fixtures/mpc --repeat 20
+import argparse
+import asyncio
+import logging
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import time
+
+from bs4 import BeautifulSoup
+from photometrics.mpc_neo_confirm import MPCNeoConfirm as mpcObj
+
+try:
+    grandparentDir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir))
+    sys.path.append(
+        grandparentDir)
+    from scheduleLib.asyncUtils import extractPre
+    from scheduleLib.httpFixtures import RecordingTransport, ReplayTransport, recordedBodies
+    from schedulerConfigs.MPC_NEO.mpcTargetSelectorCore import SelectorResources
+    from schedulerConfigs.MPC_NEO.mpcCycle import runCycle
+    sys.path.remove(grandparentDir)
+except:
+    from scheduleLib.asyncUtils import extractPre
+    from scheduleLib.httpFixtures import RecordingTransport, ReplayTransport, recordedBodies
+    from schedulerConfigs.MPC_NEO.mpcTargetSelectorCore import SelectorResources
+    from schedulerConfigs.MPC_NEO.mpcCycle import runCycle
+
+NEO_LIST_FILE = "neoConfirmList.pkl"
+DB_SNAPSHOT_FILE = "candidates.db"  # the state of the database before the recorded cycle, so replays start from the same place
+
+
+class RecordingNeoConfirm(mpcObj):
+    """
+    An MPCNeoConfirm that saves the NEO confirmation list it fetches into a fixture directory
+    """
+
+    def __init__(self, fixtureDir, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fixtureDir = fixtureDir
+        os.makedirs(fixtureDir, exist_ok=True)
+
+    def get_neo_list(self, *args, **kwargs):
+        result = super().get_neo_list(*args, **kwargs)
+        with open(os.path.join(self.fixtureDir, NEO_LIST_FILE), "wb") as f:
+            pickle.dump(self.neo_confirm_list, f)
+        return result
+
+
+class ReplayNeoConfirm(mpcObj):
+    """
+    An MPCNeoConfirm that serves the NEO confirmation list from a fixture directory instead of the MPC
+    """
+
+    def __init__(self, fixtureDir, latency=0, *args, **kwargs):
+        """
+        :param fixtureDir: directory the list was recorded into
+        :param latency: seconds to wait before "receiving" the list
+        """
+        super().__init__(*args, **kwargs)
+        self.fixtureDir = fixtureDir
+        self.latency = latency
+
+    def get_neo_list(self, *args, **kwargs):
+        time.sleep(self.latency)
+        path = os.path.join(self.fixtureDir, NEO_LIST_FILE)
+        if not os.path.isfile(path):
+            logging.getLogger(__name__).error("No recorded NEO confirmation list in " + self.fixtureDir)
+            self.neo_confirm_list = None
+            return None
+        with open(path, "rb") as f:
+            self.neo_confirm_list = pickle.load(f)
+        return None
+
+
+async def timedCycle(logger, lookback, dbPath, transport=None, mpc=None):
+    """
+    Run one logging + selection cycle against dbPath, timing each stage
+    :param transport: optional httpx transport for all web requests (recording or replaying)
+    :param mpc: optional MPCNeoConfirm (or stand-in) to fetch the NEO list with
+    :return: tuple ({stage: seconds}, AsyncHelper.latencyStats())
+    """
+    resources = SelectorResources(transport=transport, mpc=mpc)
+    timings = await runCycle(logger, lookback, dbPath, resources=resources)
+    stats = resources.asyncHelper.latencyStats()
+    await resources.aclose()
+    return timings, stats
+
+
+def benchmarkPreExtraction(fixtureDir, repeat=10):
+    """
+    Time pulling the <pre> block out of every recorded page with extractPre against a full BeautifulSoup parse, checking that both give the same text
+    :return: dict {"pages", "mismatches", "soup", "extractPre"}, where the last two are total seconds over all repeats
+    """
+    pages = [body for url, body in recordedBodies(fixtureDir) if b"<pre" in body.lower()]
+    mismatches = 0
+    for body in pages:
+        pre = BeautifulSoup(body, 'html.parser').find_all('pre')
+        block = extractPre(body)
+        if block is None or not pre or block.get_text() != pre[0].get_text():
+            mismatches += 1
+
+    startTime = time.perf_counter()
+    for i in range(repeat):
+        for body in pages:
+            BeautifulSoup(body, 'html.parser').find_all('pre')
+    soupTime = time.perf_counter() - startTime
+
+    startTime = time.perf_counter()
+    for i in range(repeat):
+        for body in pages:
+            extractPre(body)
+    preTime = time.perf_counter() - startTime
+    return {"pages": len(pages), "mismatches": mismatches, "soup": soupTime, "extractPre": preTime}
+
+
+def _copyDatabase(source, directory):
+    # Internal: copy a database file into directory so the cycle doesn't touch the original
+    destination = os.path.join(directory, DB_SNAPSHOT_FILE)
+    shutil.copyfile(source, destination)
+    return destination
+
+
+def _report(label, timings, stats):
+    print(label + ": " + ", ".join(k + " " + str(round(v, 3)) + " s" for k, v in timings.items()))
+    if stats is not None:
+        print("    " + str(stats["count"]) + " requests, mean " + str(round(stats["mean"], 3)) + " s, p95 " + str(
+            round(stats["p95"], 3)) + " s, " + str(stats["retried"]) + " retried, " + str(stats["failed"]) + " failed")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record MPC responses for one logging/selection cycle, or replay them offline to time the pipeline")
+    parser.add_argument("mode", choices=["record", "replay", "pre"],
+                        help="pre: benchmark <pre> extraction on the recorded pages")
+    parser.add_argument("fixtureDir", type=str, help="Directory to record fixtures into or replay them from")
+    parser.add_argument("dbPath", nargs="?", default=None,
+                        help="record: candidate database to start from (it is copied, not modified). replay: optional database to start from instead of the recorded snapshot")
+    parser.add_argument("--lookback", type=float, default=48, help="Lookback, in hours, passed to the logger and selector")
+    parser.add_argument("--latency", type=float, default=None, help="replay: fixed latency per request, in seconds. Defaults to the recorded latency")
+    parser.add_argument("--scale", type=float, default=1.0, help="replay: multiply all latencies by this")
+    parser.add_argument("--jitter", type=float, default=0.0, help="replay: vary each latency by up to this fraction")
+    parser.add_argument("--repeat", type=int, default=1, help="replay: number of cycles to time. pre: passes over the pages")
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s', level=logging.WARNING)
+    logger = logging.getLogger(__name__)
+
+    if args.mode == "record":
+        if args.dbPath is None:
+            parser.error("record needs a database to start from")
+        os.makedirs(args.fixtureDir, exist_ok=True)
+        shutil.copyfile(args.dbPath, os.path.join(args.fixtureDir, DB_SNAPSHOT_FILE))
+        with tempfile.TemporaryDirectory() as workDir:
+            workingDb = _copyDatabase(args.dbPath, workDir)
+            timings, stats = asyncio.run(timedCycle(logger, args.lookback, workingDb,
+                                                    transport=RecordingTransport(args.fixtureDir),
+                                                    mpc=RecordingNeoConfirm(args.fixtureDir)))
+        _report("Recorded (live)", timings, stats)
+    elif args.mode == "pre":
+        result = benchmarkPreExtraction(args.fixtureDir, args.repeat)
+        print(str(result["pages"]) + " pages, " + str(result["mismatches"]) + " mismatches")
+        if result["pages"]:
+            for method in ("soup", "extractPre"):
+                print("    " + method + ": " + str(round(1000 * result[method] / (result["pages"] * args.repeat), 3)) + " ms/page")
+    else:
+        startDb = args.dbPath if args.dbPath is not None else os.path.join(args.fixtureDir, DB_SNAPSHOT_FILE)
+        for i in range(args.repeat):
+            with tempfile.TemporaryDirectory() as workDir:
+                workingDb = _copyDatabase(startDb, workDir)
+                transport = ReplayTransport(args.fixtureDir, latency=args.latency, latencyScale=args.scale,
+                                            jitter=args.jitter)
+                mpc = ReplayNeoConfirm(args.fixtureDir,
+                                       latency=(args.latency if args.latency is not None else 0) * args.scale)
+                timings, stats = asyncio.run(timedCycle(logger, args.lookback, workingDb, transport=transport,
+                                                        mpc=mpc))
+            _report("Replay " + str(i + 1), timings, stats)
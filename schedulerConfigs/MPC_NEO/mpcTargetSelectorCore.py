@@ -1,6 +1,7 @@
 # Sage Santomenna 2023
 
 from datetime import datetime, timezone, timedelta
+import asyncio
 import sys, os
 # ---webtools
 import httpx
@@ -11,7 +12,7 @@ import numpy as np
 import pandas as pd
 import pytz
 from astral import LocationInfo
-from astral import sun
+from astropy import units as u
 from astropy.coordinates import Angle
 # --- astronomy stuff
 from astropy.time import Time
@@ -25,10 +26,12 @@ try:
     grandparentDir = os.path.abspath(os.path.join(os.path.dirname(__file__), os.path.pardir, os.path.pardir))
     sys.path.append(
         grandparentDir)
-    from scheduleLib import genUtils, asyncUtils
+    from scheduleLib import angleUtils, genUtils, asyncUtils
+    from scheduleLib.nightContext import NightContext
     sys.path.remove(grandparentDir)
 except:
-    from scheduleLib import genUtils, asyncUtils
+    from scheduleLib import angleUtils, genUtils, asyncUtils
+    from scheduleLib.nightContext import NightContext
 
 utc = pytz.UTC
 
@@ -55,11 +58,77 @@ def rootMeanSquared(vals):
     return sqrt(1 / len(vals) * sum([i ** 2 for i in vals]))
 
 
+class SelectorResources:
+    """
+    The expensive, shareable parts of a TargetSelector: the web clients, the MPC list retriever, and the night's sun and sidereal times. Each is made the first time it's used. Build one per cycle (or per process) and pass it to every TargetSelector
+    """
+
+    def __init__(self, transport=None, mpc=None, night=None, asyncHelper=None, webClient=None):
+        """
+        :param transport: Optional httpx transport for the web clients to use instead of the network, like a ``scheduleLib.httpFixtures.ReplayTransport``
+        :param mpc: Optional MPCNeoConfirm (or stand-in) to use instead of making a new one
+        :param night: Optional scheduleLib.nightContext.NightContext to use instead of the one for the coming night at the selector's observatory
+        :param asyncHelper: Optional asyncUtils.AsyncHelper to make requests with. not closed by close
+        :param webClient: Optional httpx.Client to fetch offsets with. not closed by close
+        """
+        self.transport = transport
+        self.night = night
+        self._mpc = mpc
+        self._asyncHelper = asyncHelper
+        self._webClient = webClient
+        self._ownClients = set()  # names of the clients we made, and so have to close
+
+    @property
+    def mpc(self):
+        if self._mpc is None:
+            self._mpc = mpcObj()  # navtej's mpc retriever
+        return self._mpc
+
+    @property
+    def asyncHelper(self):
+        if self._asyncHelper is None:
+            self._asyncHelper = asyncUtils.AsyncHelper(followRedirects=True, transport=self.transport)
+            self._ownClients.add("asyncHelper")
+        return self._asyncHelper
+
+    @property
+    def webClient(self):
+        if self._webClient is None:
+            self._webClient = httpx.Client(follow_redirects=True, timeout=60.0, transport=self.transport)
+            self._ownClients.add("webClient")
+        return self._webClient
+
+    def nightFor(self, observatory, when):
+        """
+        :return: the NightContext to use for observatory at when: the one given at construction, if any, or the (cached) one for the night that ends with the next sunrise after when
+        """
+        return self.night if self.night is not None else NightContext.get(observatory, when)
+
+    async def aclose(self):
+        """
+        Close the clients that we made, from inside the event loop that used them. They'd be made again if used afterward
+        """
+        if "asyncHelper" in self._ownClients:
+            await self._asyncHelper.client.aclose()
+            self._asyncHelper = None
+        if "webClient" in self._ownClients:
+            self._webClient.close()
+            self._webClient = None
+        self._ownClients.clear()
+
+    def close(self):
+        """
+        Close the clients that we made, from outside any running event loop. Inside one, await aclose instead
+        """
+        if self._ownClients:
+            asyncio.run(self.aclose())
+
+
 class TargetSelector:
     def __init__(self, startTimeUTC="now", endTimeUTC="sunrise", raMaxRMSE=360, decMaxRMSE=360, nObsMax=1000,
                  vMagMax=21.5,
                  scoreMin=0, decMax=65, decMin=-25, altitudeLimit=0, obsCode=654, obsName="TMO", region="CA, USA",
-                 obsTimezone="UTC", obsLat=34.36, obsLon=-117.63):
+                 obsTimezone="UTC", obsLat=34.36, obsLon=-117.63, transport=None, mpc=None, resources=None):
         """
         The TargetSelector object, around which the MPC target selector is built
         :param startTimeUTC: The earliest start time for an observing window. Can be ``"now"``, ``"sunset"``, or of the form ``"%Y%m%d %H%M"``
@@ -76,6 +145,9 @@ class TargetSelector:
         :param obsTimezone: The timezone of the observatory. Must be a valid initializer for ``astral.LocationInfo.timezone``
         :param obsLat: The latitude of the observatory. Must be a valid initializer for ``astral.LocationInfo.latitude``
         :param obsLon: The longitude of the observatory. Must be a valid intializer for ``astral.LocationInfo.longitude``
+        :param transport: Optional httpx transport for the web clients to use instead of the network, like a ``scheduleLib.httpFixtures.ReplayTransport``
+        :param mpc: Optional MPCNeoConfirm (or stand-in) to use instead of making a new one
+        :param resources: Optional SelectorResources to share with other selectors. If given, transport and mpc are ignored, and the clients are left open when this selector is done
         """
 
         # set up the logger
@@ -85,15 +157,14 @@ class TargetSelector:
         self.observatory = LocationInfo(name=obsName, region=region, timezone=obsTimezone, latitude=obsLat,
                                         longitude=obsLon)
         # find sunrise and sunset
-        s = sun.sun(self.observatory.observer, date=datetime.now(timezone.utc), tzinfo=timezone.utc)
-        self.sunriseUTC = s["sunrise"]
-
         now_dt = datetime.utcnow()
         now_dt = utc.localize(now_dt)
-
-        if self.sunriseUTC < now_dt:  # if the sunrise we found is earlier than the current time, add one day to it (approximation ofc)
-            self.sunriseUTC = self.sunriseUTC + timedelta(days=1)
-        self.sunsetUTC = sun.time_at_elevation(self.observatory.observer, -10)
+        # clients and the like are made when first used, and can be shared between selectors
+        self.ownResources = resources is None
+        self.resources = resources if resources is not None else SelectorResources(transport=transport, mpc=mpc)
+        self.night = self.resources.nightFor(self.observatory, now_dt)  # shared with the other tools through a file
+        self.sunriseUTC = self.night.sunrise
+        self.sunsetUTC = self.night.sunset
 
         # parse start time
         if startTimeUTC == "sunset":
@@ -119,8 +190,7 @@ class TargetSelector:
             startTimeUTC = utc.localize(startTimeUTC)
         self.startTime = startTimeUTC
         self.endTime = endTimeUTC
-        self.siderealStart = Time(self.startTime, scale='utc').sidereal_time(kind="apparent",
-                                                                             longitude=self.observatory.longitude)
+        self.siderealStart = Angle(self.night.siderealTime(self.startTime) / 15, unit=u.hourangle)
 
         self.minHoursBeforeTransit = min(max(self.sunsetUTC - self.startTime, timedelta(hours=-2)),
                                          timedelta(hours=0)).total_seconds() / 3600
@@ -137,29 +207,52 @@ class TargetSelector:
         self.altitudeLimit = altitudeLimit
         self.obsCode = obsCode
 
-        # init navtej's mpc retriever
-        self.mpc = mpcObj()
-
-        # init here, will use later
-        self.objDf = pd.DataFrame(
-            columns=["Temp_Desig", "Score", "Discovery_datetime", "R.A.", "Decl.", "V", "Updated", "Note", "NObs",
-                     "Arc", "H",
-                     "Not_Seen_dys"
-                     ])
+        # made when first used - most selectors never touch them
+        self._objDf = None
+        self._filtDf = None
         self.mpcObjDict = {}
-        self.filtDf = pd.DataFrame()
         self.uncertaintyStorage = {}  # this will be {desig : (RAlist,Declist,list[color])}
 
-        # init web client for retrieving offsets
-        self.webClient = httpx.Client(follow_redirects=True, timeout=60.0)
-
-        # init AsyncHelper
-        self.asyncHelper = asyncUtils.AsyncHelper(followRedirects=True)
-
     def __del__(self):
-        del self.asyncHelper
         self.killClients()
 
+    @property
+    def mpc(self):
+        return self.resources.mpc
+
+    @property
+    def webClient(self):
+        # for retrieving offsets
+        return self.resources.webClient
+
+    @property
+    def asyncHelper(self):
+        return self.resources.asyncHelper
+
+    @property
+    def objDf(self):
+        if self._objDf is None:
+            self._objDf = pd.DataFrame(
+                columns=["Temp_Desig", "Score", "Discovery_datetime", "R.A.", "Decl.", "V", "Updated", "Note", "NObs",
+                         "Arc", "H",
+                         "Not_Seen_dys"
+                         ])
+        return self._objDf
+
+    @objDf.setter
+    def objDf(self, df):
+        self._objDf = df
+
+    @property
+    def filtDf(self):
+        if self._filtDf is None:
+            self._filtDf = pd.DataFrame()
+        return self._filtDf
+
+    @filtDf.setter
+    def filtDf(self, df):
+        self._filtDf = df
+
     def printSetupInfo(self):
         durationMinutes = round((self.endTime - self.startTime).total_seconds() / 60)
         formattedDuration = "{:02d}:{:02d}".format(durationMinutes // 60, durationMinutes % 60)
@@ -175,7 +268,7 @@ class TargetSelector:
         :param dt: A datetime object
         :return: Sidereal time, as an astropy Angle
         """
-        return Time(dt, scale='utc').sidereal_time(kind="apparent", longitude=self.observatory.longitude)
+        return Angle(self.night.siderealTime(dt) / 15, unit=u.hourangle)
 
     @staticmethod
     def _convertMPC(obj):
@@ -196,12 +289,15 @@ class TargetSelector:
         if name not in offsetDict.keys():
             logger.debug("Couldn't find " + name + " in offsetDict")
             return None, None
-        soup = offsetDict[name][0]  # for whatever reason, the value is a list and i don't feel like fixing it
-        if soup is None:
+        page = offsetDict[name][0]  # for whatever reason, the value is a list and i don't feel like fixing it
+        if page is None:
             return None, None
-        for a in soup.findAll('a', href=True):
-            a.extract()
-        text = soup.findAll('pre')[0].get_text()
+        if isinstance(page, asyncUtils.PreBlock):
+            text = page.textWithoutLinks()
+        else:  # full soup of the page
+            for a in page.findAll('a', href=True):
+                a.extract()
+            text = page.findAll('pre')[0].get_text()
 
         colorPriorityDict = {1: "BLACK", 2: "RED", 3: "ORANGE", 4: "GREEN"}
         colorPriorityList = []
@@ -259,13 +355,13 @@ class TargetSelector:
 
         return round(rmsRA, 2), round(rmsDec, 2), highestColor
 
-    def timeUntilTransit(self, ra: float):
+    def timeUntilTransit(self, ra):
         """
         Time until a target with an RA of ra transits (at the observatory)
-        :return: Time until transit in hours, float
+        :param ra: RA in decimal hours, as a float or string, or an array-like of them
+        :return: Time until transit in hours, float (or numpy float array)
         """
-        ra = Angle(str(ra) + "h")
-        return (ra - self.siderealStart).hour
+        return genUtils.hoursUntilTransit(angleUtils.toDegrees(ra, unit=angleUtils.HOURS), self.siderealStart.degree)
 
     def makeMpcDataframe(self):
         """
@@ -286,7 +382,7 @@ class TargetSelector:
         """
 
         # calculate time until transit for each object
-        self.objDf['TransitDiff'] = self.objDf.apply(lambda row: self.timeUntilTransit(row['R.A.']), axis=1)
+        self.objDf['TransitDiff'] = self.timeUntilTransit(self.objDf['R.A.'].to_numpy())
         # original length of the dataframe
         original = len(self.objDf.index)
         print("Before pruning, we started with", original, "objects.")
@@ -346,71 +442,104 @@ class TargetSelector:
         soup = BeautifulSoup(offsetReq.content, 'html.parser')
         return tuple([desig, soup])
 
-    async def getFilteredUncertainties(self, graph=False, savePath=None):
+    async def getFilteredUncertainties(self, graph=False, savePath=None, executor=None):
+        """
+        Fetch the uncertainties of the targets in self.filtDf and add them as rmsRA and rmsDec columns. Each target's uncertainty is extracted as soon as its page arrives
+        :param executor: optional concurrent.futures executor to extract uncertainties on, keeping the parsing off the event loop thread. Ignored if graph is True, since plotting must stay on this thread
+        """
         desigs = list(self.filtDf.Temp_Desig)
-        offsetDict = await self.fetchUncertainties(desigs)
+        loop = asyncio.get_running_loop()
+        uncertainties = {}
+        async for desig, offsets in self.streamUncertainties(desigs):
+            offsetDict = {desig: [offsets]}
+            if executor is not None and not graph:
+                result = await loop.run_in_executor(executor, TargetSelector.extractUncertainty, desig, offsetDict,
+                                                    self.logger)
+            else:
+                result = TargetSelector.extractUncertainty(desig, offsetDict, self.logger, graph, savePath)
+            uncertainties[desig] = list(result)[0:2]
         self.filtDf = pd.concat((self.filtDf,
                                  self.filtDf.apply(lambda row: pd.Series(
-                                     list(TargetSelector.extractUncertainty(row['Temp_Desig'], offsetDict, self.logger,
-                                                                            graph, savePath))[0:2],
+                                     uncertainties.get(row['Temp_Desig'], [None, None]),
                                      index=["rmsRA", "rmsDec"],
                                      dtype=float), axis=1)), axis=1)
 
-    async def fetchUncertainties(self, designations: list):
-        """
-        Asynchronously get the uncertainties of the targets in the filtered dataframe
+    async def _fetchUncertainty(self, desig, postParams):
+        """
+        Internal: fetch the uncertainty page of one target - POST for its ephemeris page, pull the uncertainty link out of it, then GET the offsets
+        :return: tuple (desig, PreBlock of the offsets page) or (desig, None) if any stage failed
+        """
+        try:
+            _, ephemPre = await self.asyncHelper.makeRequest(desig, self.mpc.mpc_post_url, pre=True,
+                                                             postContent=postParams)
+            if ephemPre is None:
+                self.logger.warning("Couldn't retrieve the ephemeris for " + desig + ". Skipping uncertainty.")
+                return desig, None
+            ephem = ephemPre.contents
+            if len(ephem) == 1:
+                self.logger.warning('Target ' + desig + ' is not observable')
+                return desig, None
+            link = ephem[3] if len(ephem) > 3 else None
+            if not isinstance(link, asyncUtils.Anchor) or link.get('href') is None:
+                self.logger.warning("Couldn't find the uncertainty link on the ephemeris page for " + desig + ". Skipping uncertainty.")
+                return desig, None
+            return await self.asyncHelper.makeRequest(desig, link.get('href'), pre=True)
+        except Exception:
+            self.logger.exception("Failed to fetch uncertainty for " + desig)
+            return desig, None
+
+    def _startUncertaintyTasks(self, designations):
+        """
+        Internal: start one uncertainty-fetching task per designation
+        :return: list of asyncio tasks, each resolving to (desig, PreBlock of offsets page or None)
         """
         # this works like:
         # filtDf -> designations -> ephemeris pages -> uncertainty links -> uncertainty values -> inserted into filtDf
+        # each designation goes through both requests on its own, so one slow or failed target doesn't hold up the rest
+
+        # make sure we're not starting in the past
+        start_at = 0
+        now_dt = utc.localize(datetime.utcnow())
+        if now_dt < self.startTime:
+            start_at = round((self.startTime - now_dt).total_seconds() / 3600.) + 1
 
         post_params = {'mb': '-30', 'mf': '30', 'dl': '-90', 'du': '+90', 'nl': '0', 'nu': '100', 'sort': 'd',
                        'W': 'j',
                        'obj': 'P10POWX', 'Parallax': '1', 'obscode': "500", 'long': '',
-                       'lat': '', 'alt': '', 'int': self.mpc.int, 'start': None, 'raty': self.mpc.raty,
+                       'lat': '', 'alt': '', 'int': self.mpc.int, 'start': start_at, 'raty': self.mpc.raty,
                        'mot': self.mpc.mot,
                        'dmot': self.mpc.dmot, 'out': self.mpc.out, 'sun': self.mpc.supress_output,
                        'oalt': str(self.altitudeLimit)
                        }  # using 500 for obs code to ensure that we can always get an uncertainty, even if the target is below the horizon
-        imageDict = {}  # for image maps, desig:mapURL
-        offsetRequestTasks = []  # will store our async tasks for retrieving offsets
-
-        desigs = []
-        urls = []
         # TODO: image maps
+        tasks = []
         for desig in designations:
-            # make sure we're not starting in the past
-            start_at = 0
-            now_dt = utc.localize(datetime.utcnow())
-            if now_dt < self.startTime:
-                start_at = round((self.startTime - now_dt).total_seconds() / 3600.) + 1
-
-            post_params["start"] = start_at
-            post_params["obj"] = desig
-            try:
-                mpc_request = self.webClient.post(self.mpc.mpc_post_url, data=post_params)
-            except (httpx.ConnectError, httpx.HTTPError) as err:
-                self.logger.error('Failed to connect to/retrieve data from the MPC. Stopping')
-                self.logger.error(err)
-                exit()  # this will have to be handled by a wrapper if one is written
-            if mpc_request.status_code == 200:
-                # extract 'pre' tags from reply
-                soup = BeautifulSoup(mpc_request.text, 'html.parser')
-                ephem = soup.find_all('pre')[0].contents
-                num_recs = len(ephem)
-
-                if num_recs == 1:
-                    self.logger.warning('Target is not observable')
-
-                else:
-                    errUrl = ephem[3].get('href')
-                    urls.append(errUrl)
-                    desigs.append(desig)
-            else:
-                raise ConnectionError
+            params = post_params.copy()
+            params["obj"] = desig
+            tasks.append(asyncio.create_task(self._fetchUncertainty(desig, params)))
+        return tasks
+
+    async def streamUncertainties(self, designations: list):
+        """
+        Asynchronously fetch the uncertainty pages of the given targets, yielding each one as soon as it arrives
+        :return: yields tuples (desig, PreBlock of offsets page), in order of completion. The PreBlock is None if the uncertainty couldn't be retrieved
+        """
+        stream = asyncUtils.streamTasks(self._startUncertaintyTasks(designations))
+        try:
+            async for result in stream:
+                yield result
+        finally:  # close it now, rather than whenever it's collected, so the requests are cancelled right away
+            await stream.aclose()
 
-        # # now actually make all the requests
-        # thanks to our handy-dandy async helper !!!!!!!!!!
-        offsetDict = await self.asyncHelper.multiGet(urls, desigs, soup=True)
+    async def fetchUncertainties(self, designations: list):
+        """
+        Asynchronously get the uncertainties of the targets in the filtered dataframe
+        :return: dictionary of {desig: [PreBlock of offsets page]}. Targets whose uncertainty couldn't be retrieved are omitted
+        """
+        offsetDict = {}
+        async for desig, offsets in self.streamUncertainties(designations):
+            if offsets is not None:
+                offsetDict.setdefault(desig, []).append(offsets)
         return offsetDict
 
     def observationViable(self, dt: datetime, ra: Angle, dec: Angle):
@@ -418,15 +547,25 @@ class TargetSelector:
         Can a target with RA ra and Dec dec be observed at time dt? Checks hour angle limits.
         :return: bool
         """
-        hourAngleWindow = genUtils.getHourAngleLimits(dec)
-        raWindow = (self.dateToSidereal(dt) - hourAngleWindow[0],
-                    self.dateToSidereal(dt) - hourAngleWindow[1])
-        # print("Datetime:",dt)
-        # print("Hour angle window:",hourAngleWindow)
-        # print("RA window:", raWindow)
-        # print("RA, dec:",ra,dec)
-        # print("Is within bounds:",ra.is_within_bounds(raWindow[1], raWindow[0]))
-        return ra.is_within_bounds(raWindow[1], raWindow[0])
+        ra = ra.degree if isinstance(ra, Angle) else float(ra)
+        dec = dec.degree if isinstance(dec, Angle) else float(dec)
+        return bool(self._observableMask([dt], np.array([ra]), np.array([dec]), checkDec=False)[0])
+
+    def _observableMask(self, times, ras, decs, checkDec=True):
+        """
+        Internal: which of many (time, RA, Dec) positions are within the hour angle limits (and, if checkDec, this selector's dec limits), all in float degrees
+        :param times: list of datetimes
+        :param ras: float array of RAs, degrees
+        :param decs: float array of Decs, degrees
+        :return: bool array
+        """
+        lst = self.night.siderealTime(list(times))  # apparent sidereal time, degrees in [0, 360)
+        minHourAngle, maxHourAngle = genUtils.hourAngleLimits(decs)  # NaN (never viable) outside the horizon box
+        # the RA has to be between lst - maxHourAngle and lst - minHourAngle, compared without wrapping, as Angle.is_within_bounds does
+        viable = (lst - maxHourAngle <= ras) & (ras < lst - minHourAngle)
+        if checkDec:
+            viable &= (self.decMin < decs) & (decs < self.decMax)
+        return viable
 
     def isObservable(self, ephem):
         """
@@ -435,36 +574,77 @@ class TargetSelector:
         :return: bool
         """
         if self.decMin < ephem["dec"] < self.decMax:
-            RA, dec = genUtils.ensureAngle(ephem["RA"]), genUtils.ensureAngle(ephem["dec"])
-            return self.observationViable(ephem["obsTime"], RA, dec)
+            return self.observationViable(ephem["obsTime"], ephem["RA"], ephem["dec"])
         return False
 
-    async def calculateObservability(self, desigs: list):
+    def _scanObservability(self, ephems, start=None):
+        """
+        Internal: walk a list of raw ephemeris lines and find where the observability window opens and closes
+        :param ephems: list of ephemeris lines, as returned by mpcUtils.asyncMultiEphem
+        :param start: the datetime at which the window opened, if it was already open before these lines
+        :return: tuple (startDt, endDt, closed). startDt is None if the window never opened, closed is True if the window closed within these lines
+        """
+        if not ephems:
+            return start, None, False
+        times = [mpcUtils.timeFromEphem(ephem) for ephem in ephems]
+        ras, decs = np.array([mpcUtils.raDecFromEphem(ephem) for ephem in ephems], dtype=float).T
+        observable = self._observableMask(times, ras, decs)
+        first = 0
+        if start is None:
+            opened = np.flatnonzero(observable)
+            if not len(opened):
+                return None, times[-1], False
+            first = opened[0]
+            start = times[first]  # window begins
+        closed = np.flatnonzero(~observable[first:])
+        if len(closed):  # we've already started and we're no longer observable. window over
+            return start, times[first + closed[0]], True
+        return start, times[-1], False
+
+    def _windowMayContinue(self, start, end):
+        """
+        Internal: could the window of a target whose ephemeris ran out at `end` extend past the end of that ephemeris? Only if it's still open at the last line - targets whose window never opened get no follow-up
+        :param start: start of the window, as from _scanObservability, for a window that didn't close
+        :return: bool
+        """
+        return start is not None and end is not None
+
+    async def calculateObservability(self, desigs: list, extendOpenOnly=True, firstEphems=None):
         """
         Calculate the start and end times of the observability window for an object by querying its ephemeris and clipping at sunrise/sunset
         :param desigs: list of designations of objects to be queried - must be valid MPC temp identifiers
+        :param extendOpenOnly: if True, only request more ephemeris for targets whose window is still open at the end of the first response, firing those follow-ups while the rest of the first batch is parsed. If False, request a second full round for every target, starting at the last line of the last target
+        :param firstEphems: optional dict {desig: ephem lines or None} already retrieved from now at the geocenter with this selector's altitude limit (like the logger's). Used in place of the first round of requests for the targets it has lines for. Targets it maps to None are fetched as usual
         :returns: Dictionary {desig:(startDt,endDt)} or None
         """
         self.logger.info("Waiting on web requests...")
-        ephems = await mpcUtils.asyncMultiEphem(desigs, datetime.utcnow(), self.altitudeLimit, self.mpc,
-                                                self.asyncHelper, self.logger,
-                                                obsCode=500)  # request for geocenter to get more output
-
-
-        if ephems is None or len(ephems)==0:
+        ephems = {}
+        toFetch = list(desigs)
+        if firstEphems is not None:
+            # a None means the earlier lookup failed, not that there's nothing to see - ask again
+            toFetch = [d for d in desigs if firstEphems.get(d) is None]
+            ephems = {d: firstEphems[d] for d in desigs if firstEphems.get(d) is not None}
+        if toFetch:
+            ephems.update(await mpcUtils.asyncMultiEphem(toFetch, datetime.utcnow(), self.altitudeLimit, self.mpc,
+                                                         self.asyncHelper, self.logger,
+                                                         obsCode=500))  # request for geocenter to get more output
+
+        if ephems is None or len(ephems) == 0:
             self.logger.error("Couldn't get any ephems for any observability windows!")
             return None
-        endTime = mpcUtils.timeFromEphem(list(ephems.values())[-1][-1])
 
-        secondEphems = await mpcUtils.asyncMultiEphem(desigs, endTime, self.altitudeLimit, self.mpc,
-                                                self.asyncHelper, self.logger,
-                                                obsCode=500)
+        secondEphems = {}
+        if not extendOpenOnly:
+            lastLines = [e for e in ephems.values() if e]
+            if lastLines:
+                endTime = mpcUtils.timeFromEphem(lastLines[-1][-1])
+                secondEphems = await mpcUtils.asyncMultiEphem(desigs, endTime, self.altitudeLimit, self.mpc,
+                                                              self.asyncHelper, self.logger,
+                                                              obsCode=500)
 
         windows = {}  # {desig:(startDt,endDt)}
+        followUps = {}  # {desig:(startDt,endDt,task)} for targets whose window might continue past their first response
         for desig in desigs:
-            obsStart = False
-            start = None
-            end = None
             if desig not in ephems.keys():
                 self.logger.warning(
                     "Couldn't get ephems and so can't calculate observability window for " + desig + ". Skipping.")
@@ -472,44 +652,62 @@ class TargetSelector:
                 continue
             if ephems[desig] is None:
                 windows[desig] = None
-                break
-
-            if desig in secondEphems.keys() and secondEphems[desig] is not None:
-                # print("Have",len(ephems[desig]),"ephems. Concatenating...")
-                ephems[desig] = ephems[desig] + secondEphems[desig]  # if we got ephems for now and the window following, append them together before continuing
-                # print("New len",len(ephems[desig]))
-                # print(desig,"can read all the way to",mpcUtils.timeFromEphem(list(ephems.values())[-1][0]))
-            for ephem in ephems[desig]:
-                ephem = mpcUtils.dictFromEphemLine(ephem)
-                obsTime = ephem["obsTime"]
-                if self.isObservable(ephem):
-                    if not obsStart:  # window begins
-                        obsStart = True
-                        start = obsTime
-                elif obsStart:  # we've already started and we're no longer observable. window over
-                    end = obsTime
-                    windows[desig] = (start, end)
-                    break
-                end = obsTime
-                if start is None or end is None:  # we've run through all the ephemeris. End the window here, if one was started. otherwise, return None
-                    windows[desig] = None
-                else:
-                    windows[desig] = (start, end)
+                continue
+
+            lines = ephems[desig]
+            if secondEphems.get(desig):
+                lines = lines + secondEphems[desig]  # if we got ephems for now and the window following, append them together before continuing
+            start, end, closed = self._scanObservability(lines)
+
+            if extendOpenOnly and not closed and self._windowMayContinue(start, end):
+                task = asyncio.create_task(mpcUtils.asyncMultiEphem([desig], end, self.altitudeLimit, self.mpc,
+                                                                    self.asyncHelper, self.logger, obsCode=500))
+                followUps[desig] = (start, end, task)
+                await asyncio.sleep(0)  # let the follow-up get on the wire while we keep parsing the first batch
+                continue
+            windows[desig] = (start, end) if start is not None and end is not None else None
+
+        if followUps:
+            self.logger.debug("Extending ephemeris for " + str(len(followUps)) + " target(s) with open windows")
+        for desig, (start, end, task) in followUps.items():
+            try:
+                extra = await task
+            except Exception:
+                self.logger.exception("Failed to extend ephemeris for " + desig + ". Using the first response only.")
+                extra = None
+            if extra and extra.get(desig):
+                start, extendedEnd, _ = self._scanObservability(extra[desig], start)
+                end = extendedEnd or end
+            windows[desig] = (start, end) if start is not None and end is not None else None
 
         for desig in windows.keys():
             if windows[desig] is not None:
-                self.logger.debug("Target" + desig + "is visible between" +
-                                  windows[desig][0].strftime("%Y-%m-%d %H:%M") + "and" +
+                self.logger.debug("Target " + desig + " is visible between " +
+                                  windows[desig][0].strftime("%Y-%m-%d %H:%M") + " and " +
                                   windows[desig][1].strftime("%Y-%m-%d %H:%M"))
             else:
                 self.logger.debug("Nominal: No valid observability window for target " + desig + ".")
         return windows
 
+    async def aclose(self):
+        """
+        Close the internal clients from inside the running event loop. Shared ones (if this selector was given its resources) are left to their owner to close
+        """
+        if getattr(self, "ownResources", False):
+            await self.resources.aclose()
+
     def killClients(self):
         """
-        Mandatory: close the internal clients
+        Mandatory: close the internal clients. Shared ones (if this selector was given its resources) are left to their owner to close. From inside a running event loop, await aclose instead
         """
-        self.webClient.close()
+        if not getattr(self, "ownResources", False):
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.resources.close()
+        else:
+            loop.create_task(self.resources.aclose())  # can't wait for it here
 
     def pruneByError(self):
         """
@@ -1,7 +1,7 @@
 # Sage Santomenna 2023
+import asyncio
 import os.path
 import sys
-import time
 from datetime import datetime, timedelta
 
 import astropy
@@ -258,11 +258,67 @@ def pullEphems(mpcInst, designations: list, whenDt: datetime, minAltitudeLimit,
     return ephemsDict
 
 
+def _parseEphemPage(designation, page, mpcInst: mpc, logger, autoFormat=False):
+    """
+    Internal: parse the ephemeris out of one MPC ephemeris page
+    :param designation: the designation the page was retrieved for
+    :param page: PreBlock (or soup) of the page, or None if the request failed
+    :return: list of ephemeris tuples (or a {startDt: line} dict if autoFormat), None if the page couldn't be parsed, or an empty list if the target isn't observable
+    """
+    if page is None:
+        print("No ephem for", designation)
+        return None
+
+    if isinstance(page, asyncUtils.PreBlock):
+        ephem = page.contents
+    else:
+        ephem = page.find_all('pre')
+        if len(ephem) == 0:
+            print("No pre tags for ephem", designation)
+            return None
+        ephem = ephem[0].contents
+    numRecs = len(ephem)
+    # print("Num recs:",numRecs)
+    # get object coordinates
+    if numRecs == 1:
+        logger.warning('Target ' + designation + ' is not observable')
+        return []
+    obsList = []
+    ephem_entry_num = -1
+    for i in range(0, numRecs - 3, 4):
+        # get datetime, ra, dec, vmag and motion
+        if i == 0:
+            obsRec = ephem[i].split('\n')[-1].replace('\n', '')
+
+        else:
+            obsRec = ephem[i].replace('\n', '').replace('!', '').replace('*', '')
+
+        if "... <suppressed> ..." in obsRec:
+            logger.debug("Suppressed ephemeris line for " + designation + ": " + obsRec)
+            obsRec = obsRec.replace("... <suppressed> ...", '')
+        # keep a running count of ephem entries
+        ephem_entry_num += 1
+
+        # parse obs_rec
+        # sys.stdout.write("Parsing "+repr(obsRec))
+        # sys.stdout.flush()
+        obsDatetime, coords, vMag, vRa, vDec = mpcInst._MPCNeoConfirm__parse_ephemeris(obsRec)
+        # sys.stdout.write("Parsed "+repr(obsRec))
+        # sys.stdout.flush()
+        deltaErr = None
+
+        obsList.append((obsDatetime, coords, vMag, vRa, vDec, deltaErr))
+    if autoFormat:
+        obsList = _formatEphem(obsList, designation)
+    return obsList
+
+
 async def asyncMultiEphem(designations, when, minAltitudeLimit, mpcInst: mpc, asyncHelper: asyncUtils.AsyncHelper,
                           logger, autoFormat=False,
-                          mpcPostURL='https://cgi.minorplanetcenter.net/cgi-bin/confirmeph2.cgi', obsCode=654):
+                          mpcPostURL='https://cgi.minorplanetcenter.net/cgi-bin/confirmeph2.cgi', obsCode=654,
+                          executor=None):
     """tls -
-    Asynchronously retrieves and parses multiple ephemeris data for given designations.
+    Asynchronously retrieves and parses multiple ephemeris data for given designations. Each page is parsed as soon as it arrives, while the rest of the requests are still in flight.
 
    :param designations: A list of object designations.
    :type designations: List[str]
@@ -281,82 +337,36 @@ async def asyncMultiEphem(designations, when, minAltitudeLimit, mpcInst: mpc, as
    :type mpcPostURL: str
    :param obsCode: (Optional) The observatory code. Defaults to 654.
    :type obsCode: int
+   :param executor: (Optional) A concurrent.futures executor to parse pages on, keeping parsing off the event loop thread. If None, pages are parsed on the event loop as they arrive.
 
    :return: A dictionary containing the parsed ephemeris data for each designation.
    :rtype: Dict[str, List[Tuple[datetime.datetime, str, float, str, str, Any]]]
     """
-    ephemResults, ephemDict = await asyncMultiEphemRequest(designations, when, minAltitudeLimit, mpcInst, asyncHelper,
-                                                           logger, mpcPostURL, obsCode)
-    designations = ephemResults.keys()
-
-    for designation in designations:
-        # parse valid ephems
-        ephem = ephemResults[designation][0]
-        if ephem is None:
-            print("No ephem for", designation)
-            ephemDict[designation] = None
-            continue
-
-        ephem = ephem.find_all('pre')
-        if len(ephem) == 0:
-            print("No pre tags for ephem", designation)
-            ephemDict[designation] = None
-            continue
+    postContents = _ephemPostContents(designations, when, minAltitudeLimit, mpcInst, obsCode)
+    designations = list(postContents.keys())
+    loop = asyncio.get_running_loop()
 
-        ephem = ephem[0].contents
-        numRecs = len(ephem)
-        # print("Num recs:",numRecs)
-        # get object coordinates
-        if numRecs == 1:
-            logger.warning('Target ' + designation + ' is not observable')
+    ephemDict = {}
+    async for designation, page in asyncHelper.streamGet([mpcPostURL] * len(designations), designations, pre=True,
+                                                         postContent=list(postContents.values())):
+        if page is None:
+            logger.debug("Request for ephemeris for candidate " + designation + " failed. Eliminating and moving on.")
+        if executor is not None:
+            parsed = await loop.run_in_executor(executor, _parseEphemPage, designation, page, mpcInst, logger,
+                                                autoFormat)
         else:
-            obsList = []
-            ephem_entry_num = -1
-            for i in range(0, numRecs - 3, 4):
-                # get datetime, ra, dec, vmag and motion
-                if i == 0:
-                    obsRec = ephem[i].split('\n')[-1].replace('\n', '')
-
-                else:
-                    obsRec = ephem[i].replace('\n', '').replace('!', '').replace('*', '')
-
-                if "... <suppressed> ..." in obsRec:
-                    print("Suppressed:", obsRec)
-                    sys.stdout.flush()
-                    time.sleep(0.5)
-                    obsRec = obsRec.replace("... <suppressed> ...", '')
-                # keep a running count of ephem entries
-                ephem_entry_num += 1
-
-                # parse obs_rec
-                # sys.stdout.write("Parsing "+repr(obsRec))
-                # sys.stdout.flush()
-                obsDatetime, coords, vMag, vRa, vDec = mpcInst._MPCNeoConfirm__parse_ephemeris(obsRec)
-                # sys.stdout.write("Parsed "+repr(obsRec))
-                # sys.stdout.flush()
-                deltaErr = None
-
-                obsList.append((obsDatetime, coords, vMag, vRa, vDec, deltaErr))
-            if autoFormat:
-                obsList = _formatEphem(obsList, designation)
-            ephemDict[designation] = obsList
+            parsed = _parseEphemPage(designation, page, mpcInst, logger, autoFormat)
+        if parsed != []:  # targets that aren't observable are left out entirely
+            ephemDict[designation] = parsed
     return ephemDict
 
 
-async def asyncMultiEphemRequest(designations, when, minAltitudeLimit, mpcInst: mpc,
-                                 asyncHelper: asyncUtils.AsyncHelper, logger,
-                                 mpcPostURL='https://cgi.minorplanetcenter.net/cgi-bin/confirmeph2.cgi', obsCode=654):
+def _ephemPostContents(designations, when, minAltitudeLimit, mpcInst: mpc, obsCode=654):
     """
-    Asynchronously retrieve ephemerides for multiple objects. Requires internet connection.
-    :param designations: A list of designations (strings) of the targets to objects
-    :param when: 'now', a datetime object representing the time for which the ephemeris should be generated, or a string in the format 'YYYY-MM-DDTHH:MM:SS'
-    :param minAltitudeLimit: The lower altitude limit, below which ephemeris lines will not be generated
-    :param mpcInst: An instance of the MPCNeoConfirm class from the (privileged) photometrics.mpc_neo_confirm module
-    :param asyncHelper: An instance of the asyncHelper class
-    :return: Result of query in _____ form
+    Internal: build the confirmeph2 POST parameters for each designation
+    :return: dictionary of {designation: postParams}, one entry per unique designation
     """
     designations = list(set(designations))  # filter for only unique desigs
-    urls = [mpcPostURL] * len(designations)
     postContents = {}
     defaultPostParams = {'mb': '-30', 'mf': '30', 'dl': '-90', 'du': '+90', 'nl': '0', 'nu': '100', 'sort': 'd',
                          'W': 'j',
@@ -383,29 +393,34 @@ async def asyncMultiEphemRequest(designations, when, minAltitudeLimit, mpcInst:
         newPostContent["start"] = start_at
         newPostContent["obj"] = objectName
         postContents[objectName] = newPostContent
+    return postContents
+
+
+async def asyncMultiEphemRequest(designations, when, minAltitudeLimit, mpcInst: mpc,
+                                 asyncHelper: asyncUtils.AsyncHelper, logger,
+                                 mpcPostURL='https://cgi.minorplanetcenter.net/cgi-bin/confirmeph2.cgi', obsCode=654):
+    """
+    Asynchronously retrieve ephemerides for multiple objects. Requires internet connection.
+    :param designations: A list of designations (strings) of the targets to objects
+    :param when: 'now', a datetime object representing the time for which the ephemeris should be generated, or a string in the format 'YYYY-MM-DDTHH:MM:SS'
+    :param minAltitudeLimit: The lower altitude limit, below which ephemeris lines will not be generated
+    :param mpcInst: An instance of the MPCNeoConfirm class from the (privileged) photometrics.mpc_neo_confirm module
+    :param asyncHelper: An instance of the asyncHelper class
+    :return: tuple ({designation: [soup]}, {designation: None} for each failed designation)
+    """
+    postContents = _ephemPostContents(designations, when, minAltitudeLimit, mpcInst, obsCode)
+    designations = list(postContents.keys())
+    urls = [mpcPostURL] * len(designations)
 
     ephemResults = await asyncHelper.multiGet(urls, designations, soup=True, postContent=list(postContents.values()))
 
     ephemDict = {}
-    failedList = []
 
+    # the helper has already retried each failed request with backoff, so anything still missing is gone for this round
     for designation in designations:
-        if designation not in ephemResults.keys() or ephemResults[designation] is None:
-            logger.debug("Request for ephemeris for candidate " + designation + " failed. Will retry.")
-            failedList.append(designation)
-
-    if len(failedList):
-        logger.debug("Retrying...")
-        retryPost = [postContents[a] for a in failedList]
-        retryEphems = await asyncHelper.multiGet([mpcPostURL] * len(failedList), failedList, soup=True,
-                                                 postContent=retryPost)
-
-        for retryDesignation in failedList:
-            if retryDesignation not in retryEphems.keys() or retryEphems[retryDesignation] is None:
-                logger.debug("Request for", retryDesignation, "failed on retry. Eliminating and moving on.")
-                ephemDict[retryDesignation] = None
-            else:
-                ephemResults[retryDesignation] = retryEphems[retryDesignation]
+        if designation not in ephemResults.keys() or ephemResults[designation][0] is None:
+            logger.debug("Request for ephemeris for candidate " + designation + " failed. Eliminating and moving on.")
+            ephemDict[designation] = None
 
     return ephemResults, ephemDict
 
@@ -429,21 +444,13 @@ def updatedStringToDatetime(updated):
     return datetime(year, month, int(integerDay)) + timedelta(days=fractionalDay)
 
 
-def candidatesForTimeRange(obsStart, obsEnd, duration, dbConnection):
-    candidates = dbConnection.table_query("Candidates", "*",
-                                          "RemovedReason IS NULL AND RejectedReason IS NULL AND CandidateType IS \"MPC NEO\" AND DateLastEdited > ?",
-                                          [datetime.utcnow() - timedelta(hours=36)], returnAsCandidates=True)
-
-    if candidates is None:
-        return []
-    res = [candidate for candidate in candidates if candidate.isObservableBetween(obsStart, obsEnd, duration)]
-    candidateDict = {}
-    for c in res:
-        if c.CandidateName not in candidateDict.keys():
-            candidateDict[c.CandidateName] = c
-        else:
-            duplicate = candidateDict[c.CandidateName]
-            if genUtils.stringToTime(duplicate.Updated) < genUtils.stringToTime(c.Updated):
-                candidateDict[c.CandidateName] = c
-    res = list(candidateDict.values())
-    return res
+def candidatesForTimeRange(obsStart, obsEnd, duration, dbConnection, asFrame=False):
+    """
+    Find the MPC NEO candidates observable for at least `duration` hours between obsStart and obsEnd, keeping only the most recently updated one of each name
+    :param asFrame: return a DataFrame (from CandidateDatabase.query_frame) instead of a list of Candidates
+    :return: list of Candidates, or DataFrame
+    """
+    return dbConnection.queryObservable(obsStart, obsEnd, duration,
+                                        condition="RemovedReason IS NULL AND RejectedReason IS NULL AND CandidateType IS \"MPC NEO\"",
+                                        timeColumn="DateLastEdited", after=datetime.utcnow() - timedelta(hours=36),
+                                        asFrame=asFrame)
@@ -12,12 +12,12 @@ try:
     sys.path.append(
         grandparentDir)
     from schedulerConfigs.MPC_NEO import mpcUtils
-    from scheduleLib.candidateDatabase import CandidateDatabase
+    from scheduleLib.candidateDatabase import connectionPool
     from scheduleLib.genUtils import stringToTime, TypeConfiguration
     sys.path.remove(grandparentDir)
 except:
     from schedulerConfigs.MPC_NEO import mpcUtils
-    from scheduleLib.candidateDatabase import CandidateDatabase
+    from scheduleLib.candidateDatabase import connectionPool
     from scheduleLib.genUtils import stringToTime, TypeConfiguration
 
 
@@ -38,8 +38,8 @@ class MpcConfig(TypeConfiguration):
         self.designations = None
 
     def selectCandidates(self, startTimeUTC: datetime, endTimeUTC: datetime, dbPath):
-        dbConnection = CandidateDatabase(dbPath, "Night Obs Tool")
-        candidates = [c for c in mpcUtils.candidatesForTimeRange(startTimeUTC, endTimeUTC, 1, dbConnection)]
+        with connectionPool.connection(dbPath, "Night Obs Tool", readOnly=True) as dbConnection:
+            candidates = [c for c in mpcUtils.candidatesForTimeRange(startTimeUTC, endTimeUTC, 1, dbConnection)]
         print("Candidates:",candidates)
         self.designations = [c.CandidateName for c in candidates]
         self.candidateDict = zip(candidates, self.designations)
@@ -93,18 +93,17 @@ class MPCScorer(astroplan.Scorer):
                                               times=times)
                     scoreArray[i] *= appliedScore  # scoreArray[i] is an array of len(times) items
 
-                window = (stringToTime(candidate.EndObservability) - stringToTime(
-                    candidate.StartObservability)).total_seconds()
+                window = (candidate.typed("EndObservability") - candidate.typed("StartObservability")).total_seconds()
 
-                startIdx = int((Time(stringToTime(candidate.StartObservability)) - start) / time_resolution)
-                endIdx = int((Time(stringToTime(candidate.EndObservability)) - start) / time_resolution)
+                startIdx = int((Time(candidate.typed("StartObservability")) - start) / time_resolution)
+                endIdx = int((Time(candidate.typed("EndObservability")) - start) / time_resolution)
                 scoreArray[i] *= linearDecrease(len(times), startIdx, endIdx)
 
                 # scoreArray[i] *= (round(block.duration.to_value(u.second) / window,
                 #                         4))  # favor targets with short windows so that they get observed
                 # scoreArray[i] *= (round(1 / block.duration.to_value(u.second),
                 #                         4))  # favor targets with long windows so it's more likely they get 2 obs in
-                # scoreArray[i] *= 1/(float(candidate.Magnitude))
+                # scoreArray[i] *= 1/(float(candidate.typed("Magnitude")))
         for constraint in self.global_constraints:  # constraints applied to all targets
             scoreArray *= constraint(self.observer, self.targets, times, grid_times_targets=True)
         return scoreArray
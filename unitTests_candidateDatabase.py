@@ -0,0 +1,409 @@
+# Sage Santomenna 2023
+import asyncio
+import os
+import pickle
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import pandas as pd
+from unittest import mock
+
+from scheduleLib import dbMigrations, genUtils
+from scheduleLib.candidateDatabase import Candidate, CandidateDatabase, AsyncCandidateDatabase, ConnectionPool, \
+    applyChanges, epochColumns, generateID, toEpoch, _withEpochs
+
+schemaPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scheduleLib",
+                          "candidate database schema 6-27-2023")
+
+
+def makeDatabaseFile(path):
+    """
+    Create an empty, unmigrated (version 0) candidate database at path, from the schema file
+    """
+    with open(schemaPath, "r") as f:
+        schema = f.read()
+    connection = sqlite3.connect(path)
+    connection.execute(schema)
+    connection.commit()
+    connection.close()
+    return path
+
+
+class Test(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.dbPath = makeDatabaseFile(os.path.join(self.tempDir.name, "candidates.db"))
+        self.db = CandidateDatabase(self.dbPath, "Tester")
+
+    def tearDown(self):
+        self.db.close()
+        self.tempDir.cleanup()
+
+    def rows(self, condition="", values=()):
+        # every row, straight from sqlite, as {name: dict}
+        cursor = self.db.db_connection.execute(
+            "SELECT * FROM Candidates" + (" WHERE " + condition if condition else ""), values)
+        return {row["CandidateName"]: dict(row) for row in cursor.fetchall()}
+
+    def seed(self, name, added, **fields):
+        # write a row directly, as though it had been added at `added`
+        row = {"Author": "Tester", "DateAdded": added, "CandidateName": name, "CandidateType": "Test",
+               "ID": generateID(name, "Test", "Tester")}
+        row.update(fields)
+        _withEpochs(row)
+        self.db.db_connection.execute("INSERT INTO Candidates (" + ", ".join('"' + c + '"' for c in row) + ") VALUES (" + ", ".join(
+            "?" * len(row)) + ")", list(row.values()))
+        self.db.db_connection.commit()
+        return row["ID"]
+
+    def test_candidateFields(self):
+        candidate = Candidate("A", "Test", RA=14.5, Updated="2023-06-27 04:12:00", Notes="hi")
+        self.assertEqual(candidate.asDict(), {"CandidateName": "A", "CandidateType": "Test", "Updated": "2023-06-27 04:12:00",
+                                              "RA": "14.5", "Notes": "hi"})
+        self.assertEqual(candidate.typed("RA"), 14.5)
+        self.assertEqual(candidate.typed("Updated"), datetime(2023, 6, 27, 4, 12))
+        self.assertEqual(candidate.RA, "14.5")  # reading the typed value doesn't change the stored one
+        self.assertIsNone(candidate.typed("Dec"))
+        candidate.Dec = "-12.25"  # goes in between the fields already there
+        candidate.ID = 7
+        self.assertEqual(candidate.typed("Dec"), -12.25)
+        self.assertEqual(candidate.ID, 7)
+        candidate.RA = "15"
+        self.assertEqual((candidate.RA, candidate.typed("RA")), ("15", 15.0))
+        del candidate.Notes
+        self.assertFalse(candidate.hasField("Notes"))
+        with self.assertRaises(AttributeError):
+            candidate.Notes
+        with self.assertRaises(AttributeError):
+            candidate.NotAField = 1
+        self.assertEqual(list(candidate.asDict().keys()), ["CandidateName", "CandidateType", "ID", "Updated", "RA", "Dec"])
+        self.assertEqual(pickle.loads(pickle.dumps(candidate)).asDict(), candidate.asDict())
+
+    def test_bulkInsertRetriesBadRows(self):
+        # the duplicate ID sinks the executemany, so the rows are retried one at a time
+        candidates = [Candidate("A", "Test", Notes="first"), Candidate("B", "Test"), Candidate("A", "Test", Notes="again"),
+                      Candidate("C", "Test")]
+        ids, failures = self.db.insertCandidates(candidates)
+        self.assertEqual(list(failures.keys()), [2])
+        self.assertIsNone(ids[2])
+        self.assertTrue(all(ID is not None for i, ID in enumerate(ids) if i != 2))
+        rows = self.rows()
+        self.assertEqual(sorted(rows.keys()), ["A", "B", "C"])
+        self.assertEqual(rows["A"]["Notes"], "first")
+        self.assertEqual(rows["B"]["ID"], ids[1])
+
+    def test_migrateFromVersion0(self):
+        path = makeDatabaseFile(os.path.join(self.tempDir.name, "old.db"))
+        connection = sqlite3.connect(path)
+        connection.execute('INSERT INTO Candidates ("Author", "DateAdded", "CandidateName", "CandidateType", "ID") VALUES (?, ?, ?, ?, ?)',
+                           ["Tester", "2023-06-28 03:15:00", "A", "Test", 1])
+        connection.commit()
+        self.assertEqual(dbMigrations.schemaVersion(connection), 0)
+        self.assertEqual(len(dbMigrations.pendingMigrations(connection)), len(dbMigrations.MIGRATIONS))
+
+        self.assertEqual(dbMigrations.migrate(connection), dbMigrations.LATEST_VERSION)
+        self.assertEqual(dbMigrations.schemaVersion(connection), dbMigrations.LATEST_VERSION)
+        self.assertEqual(dbMigrations.pendingMigrations(connection), [])
+        indexes = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+        self.assertIn("idxCandidatesChangedEpoch", indexes)
+        self.assertNotIn("idxCandidatesAdded", indexes)  # dropped again by version 2
+        self.assertEqual(connection.execute("SELECT COUNT(*) FROM Candidates").fetchone()[0], 1)
+
+        # the second time there's nothing to do, and nothing is written
+        logger = mock.Mock()
+        changes = connection.total_changes
+        self.assertEqual(dbMigrations.migrate(connection, logger=logger), dbMigrations.LATEST_VERSION)
+        logger.info.assert_not_called()
+        self.assertEqual(connection.total_changes, changes)
+        self.assertFalse(connection.in_transaction)
+        connection.close()
+        # opening a database migrates it too
+        self.assertEqual(dbMigrations.schemaVersion(self.db.db_connection), dbMigrations.LATEST_VERSION)
+
+    def test_migrateToTarget(self):
+        path = makeDatabaseFile(os.path.join(self.tempDir.name, "old.db"))
+        connection = sqlite3.connect(path)
+        self.assertEqual(dbMigrations.migrate(connection, targetVersion=1), 1)
+        self.assertEqual([m[0] for m in dbMigrations.pendingMigrations(connection)],
+                         [m[0] for m in dbMigrations.MIGRATIONS[1:]])
+        self.assertEqual(dbMigrations.migrate(connection), dbMigrations.LATEST_VERSION)
+        connection.close()
+
+    def test_epochBackfill(self):
+        # the migration computes the epochs in sql. they have to match what toEpoch writes from then on
+        path = makeDatabaseFile(os.path.join(self.tempDir.name, "old.db"))
+        connection = sqlite3.connect(path)
+        times = ["2023-06-28 03:15:00", "2023-06-28T03:15:07", "2023-12-31 23:59:59.750", "1999-01-01 00:00:00",
+                 "2023-06-28 03:15:00+00:00", None]
+        for i, t in enumerate(times):
+            row = {c: t for c in epochColumns}
+            row.update({"Author": "Tester", "DateAdded": t or "2023-06-28 03:15:00", "CandidateName": str(i),
+                        "CandidateType": "Test", "ID": i + 1})
+            connection.execute("INSERT INTO Candidates (" + ", ".join('"' + c + '"' for c in row) + ") VALUES (" + ", ".join(
+                "?" * len(row)) + ")", list(row.values()))
+        connection.commit()
+        dbMigrations.migrate(connection)
+        connection.row_factory = sqlite3.Row
+        for row in connection.execute("SELECT * FROM Candidates"):
+            for column in epochColumns:
+                self.assertEqual(row[column + "Epoch"], toEpoch(row[column]), column + " " + str(row[column]))
+        first = connection.execute('SELECT * FROM Candidates WHERE "CandidateName" = ?', ["0"]).fetchone()
+        self.assertEqual(first["UpdatedEpoch"], 1687922100)
+        connection.close()
+
+    def test_readOnlyConnection(self):
+        self.db.insertCandidates([Candidate("A", "Test")])
+        reader = CandidateDatabase(self.dbPath, "Tester", readOnly=True)
+        try:
+            self.assertEqual([c.CandidateName for c in reader.getCandidateByID(self.rows()["A"]["ID"])], ["A"])
+            with self.assertRaises(sqlite3.OperationalError):
+                reader.insertCandidates([Candidate("B", "Test")])
+            with self.assertRaises(sqlite3.OperationalError):  # sqlite refuses it too, not just transaction
+                reader.db_cursor.execute('UPDATE Candidates SET "Notes" = ?', ["nope"])
+        finally:
+            reader.close()
+        self.assertEqual(list(self.rows().keys()), ["A"])
+        self.assertIsNone(self.rows()["A"]["Notes"])
+
+    def test_nestedTransactionRollsBackTogether(self):
+        with self.assertRaises(RuntimeError):
+            with self.db.transaction():
+                self.db.insertCandidates([Candidate("A", "Test")])  # its own transaction joins ours
+                with self.db.transaction():
+                    self.db.insertCandidates([Candidate("B", "Test")])
+                    raise RuntimeError("abandon everything")
+        self.assertEqual(self.rows(), {})
+        self.assertFalse(self.db.db_connection.in_transaction)
+        # and the connection is usable afterwards
+        with self.db.transaction():
+            self.db.insertCandidates([Candidate("C", "Test")])
+        self.assertEqual(list(self.rows().keys()), ["C"])
+
+    def test_connectionPool(self):
+        pool = ConnectionPool(maxIdle=1)
+        db = pool.acquire(self.dbPath, "Tester")
+        db.db_cursor.execute('INSERT INTO Candidates ("Author", "DateAdded", "CandidateName", "CandidateType") VALUES (?, ?, ?, ?)',
+                             ["Tester", "2023-06-28 03:15:00", "A", "Test"])
+        self.assertTrue(db.db_connection.in_transaction)
+        pool.release(db)  # commits what it left behind
+        self.assertFalse(db.db_connection.in_transaction)
+        self.assertEqual(list(self.rows().keys()), ["A"])
+
+        self.assertIs(pool.acquire(self.dbPath, "Tester"), db)
+        other = pool.acquire(self.dbPath, "Tester")  # the idle one is taken, so this is new
+        self.assertIsNot(other, db)
+        reader = pool.acquire(self.dbPath, "Tester", readOnly=True)
+        self.assertTrue(reader.readOnly)
+        pool.release(db)
+        pool.release(other)  # over maxIdle, so it gets closed
+        with self.assertRaises(sqlite3.ProgrammingError):
+            other.db_connection.execute("SELECT 1")
+        with pool.connection(self.dbPath, "Tester") as borrowed:
+            self.assertIs(borrowed, db)
+        pool.release(reader)
+        pool.closeAll()
+        with self.assertRaises(sqlite3.ProgrammingError):
+            db.db_connection.execute("SELECT 1")
+
+    def test_asyncDatabase(self):
+        asyncDb, made = AsyncCandidateDatabase.wrap(self.db)
+        self.assertTrue(made)
+        self.assertEqual(AsyncCandidateDatabase.wrap(asyncDb), (asyncDb, False))
+        self.assertEqual(asyncDb.dbPath, self.dbPath)  # attributes are read straight through
+        ID = generateID("A", "Test", "Tester")
+
+        async def deferInOrder():
+            asyncDb.defer("insertCandidates", [Candidate("A", "Test")])
+            asyncDb.defer("updateCandidates", {ID: {"Notes": "edited"}})
+            asyncDb.defer("getCandidateByID", ID)
+            results = await asyncDb.flush()
+            self.assertEqual(await asyncDb.flush(), [])  # nothing left deferred
+            return results
+
+        inserted, updated, fetched = asyncio.run(deferInOrder())
+        self.assertEqual(inserted, ([ID], {}))
+        self.assertEqual(updated, ([ID], {}))
+        self.assertEqual(fetched[0].Notes, "edited")
+
+        async def deferFailures():
+            asyncDb.defer("nullFields", {ID: ["NotAField"]})
+            asyncDb.defer("queryObservable", "not a time", "2023-06-28 12:00:00", 1)
+            asyncDb.defer("updateCandidates", {ID: {"Notes": "after the failures"}})
+            with self.assertRaisesRegex(ValueError, "NotAField"):  # the first of the two
+                await asyncDb.flush()
+            return await asyncDb.getCandidateByID(ID)
+
+        self.assertEqual(asyncio.run(deferFailures())[0].Notes, "after the failures")
+        asyncDb.close()
+
+    def test_candidatesChangedSince(self):
+        untouched = self.seed("Untouched", "2023-06-01 00:00:00", Magnitude=20.5)
+        edited = self.seed("Edited", "2023-06-20 00:00:00", Magnitude=19.0)
+        removed = self.seed("Removed", "2023-06-20 00:00:00", Magnitude=21.0)
+        watermark = self.db.changeWatermark()
+        self.assertEqual(watermark, toEpoch("2023-06-20 00:00:00"))
+        # like app.py's setCandidateFrame, which drops the columns that are null for every candidate
+        loaded = self.db.query_frame().dropna(axis=1, how="all")
+        self.assertNotIn("Notes", loaded.columns)
+        self.assertNotIn("RemovedReason", loaded.columns)
+
+        self.db.updateCandidates({edited: {"Magnitude": 18.5, "Notes": "brighter"}})
+        new = self.db.insertCandidates([Candidate("New", "Test", Magnitude=17)])[0][0]
+        self.db.removeCandidatesNotIn(["Untouched", "Edited", "New"], "gone", 'CandidateType IS "Test"')
+
+        changes, newWatermark = self.db.candidatesChangedSince(watermark, asFrame=True)
+        self.assertGreater(newWatermark, watermark)
+        self.assertEqual(sorted(changes["ID"]), sorted([edited, new, removed]))
+        asCandidates, _ = self.db.candidatesChangedSince(watermark)
+        self.assertEqual(sorted(c.CandidateName for c in asCandidates), ["Edited", "New", "Removed"])
+        self.assertEqual(len(self.db.candidatesChangedSince(None)[0]), 4)
+
+        once = applyChanges(loaded, changes)
+        self.assertEqual(sorted(loaded["ID"]), sorted([untouched, edited, removed]))
+        self.assertEqual(list(once["ID"]), list(loaded["ID"]) + [new])  # in place, then new rows at the end
+        pd.testing.assert_frame_equal(applyChanges(once, changes), once)
+        # the same as loading everything again, up to the order of the rows and how the nulls are spelled
+        def normalized(df):
+            df = df.dropna(axis=1, how="all").sort_values("ID").reset_index(drop=True).astype(object)
+            return df.where(df.notna(), None)
+
+        fresh = self.db.query_frame()
+        self.assertLessEqual(set(fresh.dropna(axis=1, how="all").columns), set(once.columns))
+        pd.testing.assert_frame_equal(normalized(once), normalized(fresh[once.columns]))
+        self.assertTrue(once.set_index("ID").loc[removed, "RemovedReason"].endswith("gone"))
+        self.assertEqual(once.set_index("ID").loc[edited, "Notes"], "brighter")
+
+    def test_queryObservableMatchesCandidateFilter(self):
+        rng = random.Random(6272023)
+        base = datetime(2023, 6, 28)
+        at = lambda minutes: genUtils.timeToString(base + timedelta(minutes=minutes))
+        for ID in range(1, 301):
+            start = rng.randrange(0, 24 * 60, 10)
+            fields = {"StartObservability": at(start), "EndObservability": at(start + rng.randrange(0, 8 * 60, 10)),
+                      "Updated": at(rng.choice([0, 60, 120]))}  # few Updated values, so duplicates often tie
+            if rng.random() < 0.05:
+                fields.pop(rng.choice(["StartObservability", "EndObservability"]))
+            self.seed("C" + str(rng.randrange(60)), at(0), ID=ID, **fields)
+
+        def oldFilter(start, end, duration):
+            # what candidatesForTimeRange did before the filter and dedup moved into sql
+            candidates = self.db.table_query("Candidates", "*", "", [], returnAsCandidates=True)
+            res = [candidate for candidate in candidates if candidate.isObservableBetween(start, end, duration)]
+            candidateDict = {}
+            for c in res:
+                if c.CandidateName not in candidateDict.keys():
+                    candidateDict[c.CandidateName] = c
+                else:
+                    duplicate = candidateDict[c.CandidateName]
+                    if genUtils.stringToTime(duplicate.typed("Updated")) < genUtils.stringToTime(c.typed("Updated")):
+                        candidateDict[c.CandidateName] = c
+            return sorted(int(c.ID) for c in res), sorted(int(c.ID) for c in candidateDict.values())
+
+        with mock.patch("builtins.print") as announce:  # isObservableBetween announces every spanning window
+            for i in range(100):
+                start = rng.randrange(0, 26 * 60, 10)
+                end = at(start + rng.choice([10, 30, 60, 120, 240, 600]))
+                start, duration = at(start), rng.choice([0, 0.5, 2])
+                everyRow, latest = oldFilter(start, end, duration)
+                self.assertEqual(sorted(int(c.ID) for c in self.db.queryObservable(start, end, duration)), latest)
+                self.assertEqual(sorted(self.db.queryObservable(start, end, duration, asFrame=True)["ID"]), latest)
+                self.assertEqual(sorted(int(c.ID) for c in self.db.queryObservable(start, end, duration, latestPerName=False)),
+                                 everyRow)
+        self.assertGreater(announce.call_count, 0)  # the spanning case came up
+
+    def test_generateIDIsStable(self):
+        # IDs are stored, so they can't change between processes (or releases)
+        self.assertEqual(generateID("2023 AB1", "MPC NEO", "MPC"), 7637371075426251190)
+        script = "from scheduleLib.candidateDatabase import generateID; print(generateID('2023 AB1', 'MPC NEO', 'MPC'))"
+        for seed in ("1", "2"):
+            output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                                    cwd=os.path.dirname(os.path.abspath(__file__)),
+                                    env=dict(os.environ, PYTHONHASHSEED=seed)).stdout
+            self.assertEqual(int(output.split()[-1]), 7637371075426251190)
+
+    def test_upsertCandidates(self):
+        old = genUtils.timeToString(datetime.utcnow() - timedelta(days=20))
+        recent = genUtils.timeToString(datetime.utcnow() - timedelta(hours=1))
+        lastNight = {"RemovedReason": "Tester: gone", "RemovedDt": old, "RejectedReason": "Too faint",
+                     "StartObservability": "2023-06-28 03:00:00", "EndObservability": "2023-06-28 05:00:00",
+                     "Notes": "keep me", "Magnitude": 20}
+        self.seed("Old", old, **lastNight)
+        self.seed("Recent", recent, **lastNight)
+        self.seed("Carries", old, **lastNight)
+        candidates = [Candidate("Old", "Test", Magnitude=19), Candidate("Recent", "Test", Magnitude=18),
+                      Candidate("Carries", "Test", StartObservability="2023-07-18 04:00:00"), Candidate("New", "Test")]
+        ids, failures = self.db.upsertCandidates(candidates, readdBefore=datetime.utcnow() - timedelta(hours=36))
+        self.assertEqual(failures, {})
+        self.assertEqual(ids, [generateID(c.CandidateName, "Test", "Tester") for c in candidates])
+        rows = self.rows()
+        now = rows["New"]["DateAdded"]
+
+        # added before the cutoff: added again, and what it had from last time is cleared
+        self.assertEqual(rows["Old"]["DateAdded"], now)
+        self.assertEqual(rows["Old"]["DateAddedEpoch"], toEpoch(now))
+        for column in ["RemovedReason", "RemovedDt", "RejectedReason", "StartObservability", "StartObservabilityEpoch",
+                       "EndObservability", "EndObservabilityEpoch"]:
+            self.assertIsNone(rows["Old"][column], column)
+        self.assertEqual(rows["Old"]["Magnitude"], 19)
+        self.assertEqual(rows["Old"]["Notes"], "keep me")  # fields the candidate doesn't have are left alone
+        self.assertEqual(rows["Old"]["DateLastEdited"], now)
+
+        # added after the cutoff: updated, but otherwise left as it was
+        self.assertEqual(rows["Recent"]["DateAdded"], recent)
+        self.assertEqual(rows["Recent"]["DateAddedEpoch"], toEpoch(recent))
+        for column, value in lastNight.items():
+            if column != "Magnitude":
+                self.assertEqual(rows["Recent"][column], value, column)
+        self.assertEqual(rows["Recent"]["Magnitude"], 18)
+        self.assertEqual(rows["Recent"]["StartObservabilityEpoch"], toEpoch("2023-06-28 03:00:00"))
+
+        # what the candidate brings wins over the reset
+        self.assertEqual(rows["Carries"]["StartObservability"], "2023-07-18 04:00:00")
+        self.assertEqual(rows["Carries"]["StartObservabilityEpoch"], toEpoch("2023-07-18 04:00:00"))
+        self.assertIsNone(rows["Carries"]["EndObservability"])
+        self.assertEqual(rows["Carries"]["Magnitude"], 20)
+
+        # without readdBefore nothing is added again
+        self.db.db_connection.execute('UPDATE Candidates SET "DateAdded" = ?, "DateAddedEpoch" = ? WHERE "CandidateName" = ?',
+                                      [old, toEpoch(old), "Old"])
+        self.db.db_connection.commit()
+        self.db.upsertCandidates([Candidate("Old", "Test", Notes="edited")])
+        self.assertEqual(self.rows()["Old"]["DateAdded"], old)
+        self.assertEqual(self.rows()["Old"]["Notes"], "edited")
+        self.assertEqual(len(self.rows()), 4)
+
+    def test_removeCandidatesNotIn(self):
+        self.seed("Kept", "2023-06-20 00:00:00")
+        self.seed("Gone", "2023-06-20 00:00:00")
+        self.seed("AlreadyGone", "2023-06-20 00:00:00", RemovedReason="Someone: earlier", RemovedDt="2023-06-21 00:00:00")
+        self.seed("TooOld", "2023-06-01 00:00:00")
+        other = {"Author": "Tester", "DateAdded": "2023-06-20 00:00:00", "CandidateName": "OtherType", "CandidateType": "Other",
+                 "ID": 1}
+        self.db.db_connection.execute("INSERT INTO Candidates (" + ", ".join('"' + c + '"' for c in other) + ") VALUES (?, ?, ?, ?, ?)",
+                                      list(other.values()))
+        self.db.db_connection.commit()
+
+        removed = self.db.removeCandidatesNotIn(["Kept"], "Target removed from MPC list", 'CandidateType IS "Test"',
+                                                timeColumn="DateAdded", after="2023-06-10 00:00:00")
+        self.assertEqual(removed, ["Gone"])
+        rows = self.rows()
+        self.assertEqual(rows["Gone"]["RemovedReason"], "Tester: Target removed from MPC list")
+        self.assertEqual(rows["Gone"]["RemovedDt"], rows["Gone"]["DateLastEdited"])
+        self.assertEqual(rows["Gone"]["DateLastEditedEpoch"], toEpoch(rows["Gone"]["DateLastEdited"]))
+        self.assertEqual((rows["AlreadyGone"]["RemovedReason"], rows["AlreadyGone"]["RemovedDt"]),
+                         ("Someone: earlier", "2023-06-21 00:00:00"))
+        self.assertIsNone(rows["AlreadyGone"]["DateLastEdited"])
+        for name in ["Kept", "TooOld", "OtherType"]:
+            self.assertIsNone(rows[name]["RemovedReason"], name)
+        self.assertEqual(self.db.removeCandidatesNotIn(["Kept"], "again", 'CandidateType IS "Test"',
+                                                       timeColumn="DateAdded", after="2023-06-10 00:00:00"), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
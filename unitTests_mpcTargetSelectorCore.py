@@ -1,16 +1,24 @@
 # Sage Santomenna 2023
+import asyncio
+import logging
+import os
 import random
 import unittest
+from unittest import mock
 from datetime import datetime, timedelta
 
+import numpy as np
+import httpx
 import pytz
 from astropy import units as u
 from astropy.coordinates import Angle, SkyCoord
 from astropy.time import Time
 
-from scheduleLib import genUtils, sCoreCondensed
+from bs4 import BeautifulSoup
+
+from scheduleLib import angleUtils, genUtils, sCoreCondensed, asyncUtils, timeUtils
 from schedulerConfigs.MPC_NEO import mpcUtils
-from schedulerConfigs.MPC_NEO.mpcTargetSelectorCore import TargetSelector
+from schedulerConfigs.MPC_NEO.mpcTargetSelectorCore import TargetSelector, SelectorResources
 
 
 class Test(unittest.TestCase):
@@ -47,11 +55,77 @@ class Test(unittest.TestCase):
 
         self.assertEquals(genUtils.ensureFloat("-45"), -45)
 
+    def test_angleFastPaths(self):
+        # the numeric paths have to agree with going through astropy
+        for i in range(500):
+            h, m, sec = random.randint(0, 23), random.randint(0, 59), round(random.uniform(0, 59.999), random.randint(0, 4))
+            sign = random.choice(["", "-", "+"])
+            for angleString in (str(h) + "h" + str(m) + "m" + str(sec) + "s", sign + str(h) + "d" + str(m) + "m" + str(sec) + "s",
+                                str(round(random.uniform(0, 24), 5)) + "h", sign + str(h) + "d" + str(m) + "m"):
+                reference = Angle(angleString)
+                self.assertEqual(genUtils.ensureAngle(angleString), reference)
+                self.assertEqual(genUtils.ensureAngle(angleString).unit, reference.unit)
+                self.assertAlmostEqual(angleUtils.toDegrees(angleString), reference.degree, places=9)
+                # astropy's hour to degree factor is a hair under 15, which can tip the sixth decimal place
+                self.assertAlmostEqual(genUtils.ensureFloat(angleString), round(float(reference.degree), 6), places=5)
+            decimal = random.uniform(-90, 90)
+            self.assertEqual(angleUtils.sexagesimalString(decimal, sep=" "),
+                             Angle(decimal, unit=u.deg).to_string(unit=u.deg, sep=" "))
+            self.assertEqual(genUtils.toDecimal(decimal), genUtils.toDecimal(Angle(decimal, unit=u.deg)))
+        self.assertEqual(angleUtils.sexagesimalString(-0.5), "-0:30:00")
+        self.assertEqual(angleUtils.sexagesimalString(23.999999999999), "24:00:00")
+        self.assertEqual(list(angleUtils.toDegrees(["12h30m", 7.5, "15"], unit=angleUtils.HOURS)), [187.5, 112.5, 225])
+        self.assertEqual(genUtils.ensureFloat("12h"), 180.0)
+        with self.assertRaises(ValueError):
+            angleUtils.parseAngle("12 30 00", None)  # no unit, like astropy
+        with self.assertRaises(Exception):
+            genUtils.ensureAngle("284")
+
     def test_getHourAngleLimits(self):
         print(genUtils.getHourAngleLimits(23)[0].hms, genUtils.getHourAngleLimits(23)[1].hms)
         print(type(genUtils.getHourAngleLimits(23)))
         self.assertEqual(genUtils.getHourAngleLimits(23), (Angle(-52.5, unit=u.deg), Angle(60, unit=u.deg)))
 
+    def test_hourAngleLimits(self):
+        decs = [-40, -35, -34.5, -34, -22, 0, 0.5, 46, 50, 65, 70]
+        minHourAngles, maxHourAngles = genUtils.hourAngleLimits(decs)
+        for dec, minHourAngle, maxHourAngle in zip(decs, minHourAngles, maxHourAngles):
+            limits = genUtils.getHourAngleLimits(dec)
+            if limits is None:
+                self.assertTrue(dec <= -35 or dec > 65)
+                self.assertTrue(np.isnan(minHourAngle) and np.isnan(maxHourAngle))
+            else:
+                self.assertEqual((minHourAngle, maxHourAngle), (limits[0].deg, limits[1].deg))
+        self.assertEqual(genUtils.getHourAngleLimits(-34), (Angle(-35, unit=u.deg), Angle(42.6104, unit=u.deg)))
+
+    def test_observableMask(self):
+        # the float mask has to agree with the astropy path: Angle.is_within_bounds around the apparent sidereal time
+        selector = TargetSelector(resources=SelectorResources())
+        rng = random.Random(46)
+        night = selector.night
+        steps = int((night.sunrise - night.sunset).total_seconds() // 60)
+        times, ras, decs = [], [], []
+        for i in range(1500):
+            times.append(night.sunset + timedelta(minutes=rng.randrange(steps)))
+            ras.append(rng.choice([rng.uniform(0, 360), rng.uniform(0, 3), rng.uniform(357, 360)]))  # plenty near 0/360
+            decs.append(rng.uniform(-34, 64))
+        mask = selector._observableMask(times, np.array(ras), np.array(decs), checkDec=False)
+        lsts = Time(times, scale="utc").sidereal_time("apparent", longitude=selector.observatory.longitude * u.deg).degree
+        compared = 0
+        for t, ra, dec, lst, viable in zip(times, ras, decs, lsts, mask):
+            minHourAngle, maxHourAngle = genUtils.getHourAngleLimits(dec)
+            lower, upper = lst - maxHourAngle.degree, lst - minHourAngle.degree
+            if min(abs(ra - lower), abs(ra - upper)) < 1e-3:  # too close to call, given the interpolated sidereal time
+                continue
+            expected = Angle(ra, unit=u.deg).is_within_bounds(Angle(lower, unit=u.deg), Angle(upper, unit=u.deg))
+            self.assertEqual(bool(viable), bool(expected), str((t, ra, dec)))
+            compared += 1
+        self.assertGreater(compared, 1400)
+        self.assertGreater(mask.sum(), 100)
+        # a target on the meridian is always viable, including just after the sidereal time wraps past 360
+        for t in night.timeGrid():
+            self.assertTrue(selector.observationViable(t, night.siderealTime(t), 20.0), str(t))
+
     def test_ObservabilityWindow(self):
         selector = TargetSelector()
         print(selector.observationViable(datetime.utcnow().replace(tzinfo=pytz.UTC), selector.siderealStart, 0.0))
@@ -60,11 +134,220 @@ class Test(unittest.TestCase):
         # print(window1)
         # objRA, objDec, dRA, dDec
 
+    def test_sharedResources(self):
+        resources = SelectorResources()
+        first, second = TargetSelector(resources=resources), TargetSelector(resources=resources)
+        self.assertIs(first.asyncHelper, second.asyncHelper)
+        self.assertIs(first.night, second.night)
+        first.killClients()  # doesn't own them, so doesn't close them
+        self.assertIs(second.asyncHelper, resources.asyncHelper)
+        self.assertFalse(resources.webClient.is_closed)
+        resources.close()
+        self.assertEqual(len(TargetSelector(resources=resources).objDf.index), 0)
+
+    def test_closeClients(self):
+        transport = httpx.MockTransport(lambda request: httpx.Response(200))
+
+        async def useAndClose(closer, resources):
+            await resources.asyncHelper.client.get("https://example.com")
+            clients = resources.asyncHelper.client, resources.webClient
+            await closer.aclose()
+            return clients
+
+        resources = SelectorResources(transport=transport)
+        asyncClient, webClient = asyncio.run(useAndClose(resources, resources))
+        self.assertTrue(asyncClient.is_closed and webClient.is_closed)
+
+        selector = TargetSelector(transport=transport)  # owns its resources
+        asyncClient, webClient = asyncio.run(useAndClose(selector, selector.resources))
+        self.assertTrue(asyncClient.is_closed and webClient.is_closed)
+
+        shared = SelectorResources(transport=transport)
+        asyncClient, webClient = asyncio.run(useAndClose(TargetSelector(resources=shared), shared))
+        self.assertFalse(asyncClient.is_closed or webClient.is_closed)  # left to the owner
+        shared.close()  # outside the loop
+        self.assertTrue(asyncClient.is_closed and webClient.is_closed)
+
+    def test_reusedEphemsRefetchFailures(self):
+        selector = TargetSelector(resources=SelectorResources())
+        fetch = mock.AsyncMock(return_value={})
+        with mock.patch.object(mpcUtils, "asyncMultiEphem", fetch):
+            asyncio.run(selector.calculateObservability(["X"], firstEphems={"X": None}))
+        fetch.assert_awaited_once()
+        self.assertEqual(fetch.await_args.args[0], ["X"])  # a failed lookup in the logger isn't a missing window
+
+    def test_onlyOpenWindowsExtended(self):
+        selector = TargetSelector(resources=SelectorResources())
+        t = [datetime(2023, 6, 27, h, tzinfo=pytz.UTC) for h in (4, 6, 8, 10)]
+        scans = {"open": (t[0], t[1], False), "never": (None, t[1], False), "closed": (t[0], t[1], True),
+                 "more": (t[0], t[3], True)}  # (start, end, closed) for each target's lines
+        first = {"Open": ["open"], "Never": ["never"], "Closed": ["closed"]}
+        fetch = mock.AsyncMock(side_effect=[first, {"Open": ["more"]}])
+        with mock.patch.object(mpcUtils, "asyncMultiEphem", fetch), \
+                mock.patch.object(selector, "_scanObservability", lambda lines, start=None: scans[lines[0]]):
+            windows = asyncio.run(selector.calculateObservability(list(first.keys())))
+        self.assertEqual(fetch.await_count, 2)
+        self.assertEqual(fetch.await_args_list[1].args[:2], (["Open"], t[1]))  # the window that never opened gets no follow-up
+        self.assertEqual(windows, {"Open": (t[0], t[3]), "Never": None, "Closed": (t[0], t[1])})
+
+    def test_velocityFailuresNotReused(self):
+        from schedulerConfigs.MPC_NEO.mpcCandidateLogger import getVelocitiesBatch
+        from schedulerConfigs.MPC_NEO.mpcCycle import CycleResults
+        results = CycleResults()
+        selector = TargetSelector(resources=SelectorResources())
+        lines = [(datetime(2023, 6, 27, 4), None, 20.0, "1.0", "-2.0", None)]
+        with mock.patch.object(mpcUtils, "asyncMultiEphem", mock.AsyncMock(return_value={"A": lines, "B": None})):
+            velocities = asyncio.run(getVelocitiesBatch(["A", "B", "C"], None, logging.getLogger(), selector, results))
+        self.assertEqual(velocities, {"A": (60.0, -120.0), "B": (None, None), "C": (None, None)})
+        self.assertEqual(results.ephems, {"A": lines})
+        with mock.patch.object(mpcUtils, "asyncMultiEphem", mock.AsyncMock(side_effect=ConnectionError)):
+            asyncio.run(getVelocitiesBatch(["D"], None, logging.getLogger(), selector, results))
+        self.assertNotIn("D", results.ephems)
+
+    def test_cycleStageAuthors(self):
+        import sqlite3
+        import tempfile
+        from schedulerConfigs.MPC_NEO import mpcCycle
+        authors, databases = {}, []
+
+        async def stage(name, *args, dbConnection=None, **kwargs):
+            authors[name] = dbConnection.db._CandidateDatabase__author
+            databases.append(dbConnection.db)
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            dbPath = os.path.join(tempDir, "candidates.db")
+            with open(os.path.join("scheduleLib", "candidate database schema 6-27-2023"), "r") as f:
+                connection = sqlite3.connect(dbPath)
+                connection.execute(f.read())
+                connection.close()
+            with mock.patch.object(mpcCycle, "runLogging", lambda *a, **k: stage("logging", *a, **k)), \
+                    mock.patch.object(mpcCycle, "selectTargets", lambda *a, **k: stage("selection", *a, **k)):
+                asyncio.run(mpcCycle.runCycle(logging.getLogger(), 24, dbPath, targetSelector=mock.Mock(), mpc=mock.Mock()))
+        self.assertEqual(authors, {"logging": "MPCLogger", "selection": "MPC Selector"})  # as when the stages ran on their own
+        for db in databases:  # and both connections are closed by the end
+            with self.assertRaises(sqlite3.ProgrammingError):
+                db.db_connection.execute("SELECT 1")
+
+    def test_unchangedCandidates(self):
+        from scheduleLib.candidateDatabase import Candidate, _queryToDict
+        from schedulerConfigs.MPC_NEO.mpcCandidateLogger import isUnchanged, fingerprint
+        fresh = Candidate("C9C2MX2", "MPC NEO", Updated="2023-06-27 04:12:00", RA=14.5, Dec=-12.25, Magnitude=19.0)
+        dbRow = {"CandidateName": "C9C2MX2", "CandidateType": "MPC NEO", "Updated": "2023-06-27 04:12:00",
+                 "RA": "14.50000", "Dec": "-12.25", "Magnitude": "19.0", "dRA": "1.2", "dDec": "-0.4",
+                 "RMSE_RA": "3.0", "RMSE_Dec": "2.0"}
+        # values read back from the database are strings, and compare equal to fresh floats
+        self.assertEqual(fingerprint(Candidate.fromDatabaseEntry(dict(dbRow))), fingerprint(fresh))
+        self.assertTrue(isUnchanged(fresh, Candidate.fromDatabaseEntry(dict(dbRow))))
+        self.assertFalse(isUnchanged(fresh, Candidate.fromDatabaseEntry(dict(dbRow, Magnitude="19.1"))))
+
+        # the MPC updated the orbit
+        moved = Candidate("C9C2MX2", "MPC NEO", Updated="2023-06-27 05:40:00", RA=14.5, Dec=-12.25, Magnitude=19.0)
+        self.assertFalse(isUnchanged(moved, Candidate.fromDatabaseEntry(dict(dbRow))))
+
+        # we never got its velocity or uncertainty, so it has to be queried again. NULL columns come back missing
+        for field in ("dRA", "RMSE_Dec"):
+            row = _queryToDict([dict(dbRow, **{field: None})])[0]
+            self.assertNotIn(field, row)
+            self.assertFalse(isUnchanged(fresh, Candidate.fromDatabaseEntry(row)))
+
     # def test_ObsWindow2(self):
     #     selector = TargetSelector()
     #     window1 = asyncio.run(selector.calculateObservability(["P21Gsxa"]))
     #     print(window1)
 
+    def test_streamTasks(self):
+        async def job(name, delay):
+            await asyncio.sleep(delay)
+            return name
+
+        async def takeTwo():
+            tasks = [asyncio.create_task(job(name, delay)) for name, delay in (("slow", 5), ("a", 0.01), ("b", 0.02))]
+            stream = asyncUtils.streamTasks(tasks)
+            results = []
+            async for name in stream:
+                results.append(name)
+                if len(results) == 2:
+                    break
+            await stream.aclose()
+            await asyncio.sleep(0)
+            return results, tasks[0].cancelled()
+
+        results, slowCancelled = asyncio.run(takeTwo())
+        self.assertEqual(results, ["a", "b"])  # in order of completion
+        self.assertTrue(slowCancelled)  # stopping early doesn't leave requests running
+
+    def test_extractPre(self):
+        page = b"<html><body><h1>Ephemerides</h1><pre>Date       UT   R.A. (J2000) Decl.\n" \
+               b"2023 06 27 0400   17 04 33.1 +09 32 46 <a href=\"https://cgi.minorplanetcenter.net/cgi-bin/uncertaintymap.cgi?Obj=C9C2MX2&amp;JD=2460122.66667\">Map</a>/" \
+               b"<a href=\"https://cgi.minorplanetcenter.net/cgi-bin/uncertaintymap.cgi?Obj=C9C2MX2&amp;JD=2460122.66667&amp;Form=Y\">Offsets</a>\n" \
+               b"2023 06 27 0500   17 04 35.0 +09 32 10 &lt;suppressed&gt; !!\n</pre></body></html>"
+        block = asyncUtils.extractPre(page)
+        soupPre = BeautifulSoup(page, 'html.parser').find_all('pre')[0]
+        self.assertEqual(len(block.contents), len(soupPre.contents))
+        for fast, slow in zip(block.contents, soupPre.contents):
+            if isinstance(fast, str):
+                self.assertEqual(fast, str(slow))
+            else:
+                self.assertEqual(fast.get('href'), slow.get('href'))
+                self.assertEqual(fast.get_text(), slow.get_text())
+        self.assertEqual(block.get_text(), soupPre.get_text())
+        for a in soupPre.findAll('a', href=True):
+            a.extract()
+        self.assertEqual(block.textWithoutLinks(), soupPre.get_text())
+
+        self.assertIsNone(asyncUtils.extractPre(b"<html><body>No ephemeris</body></html>"))
+        nested = b"<pre>line <b>bold</b> <a href='x'>link</a>\n</pre>"  # other markup falls back to soup
+        self.assertEqual(asyncUtils.extractPre(nested).get_text(),
+                         BeautifulSoup(nested, 'html.parser').find_all('pre')[0].get_text())
+        inLink = b"<pre>line <a href='x'><b>Map</b></a>\n</pre>"  # markup inside a link counts too
+        block = asyncUtils.extractPre(inLink)
+        self.assertEqual(block.get_text(), BeautifulSoup(inLink, 'html.parser').find_all('pre')[0].get_text())
+        self.assertEqual([c.get_text() for c in block.contents if isinstance(c, asyncUtils.Anchor)], ["Map"])
+
+    def test_uncertaintyLinkMissing(self):
+        selector = TargetSelector(resources=SelectorResources())
+        noLink = asyncUtils.PreBlock(["header\n", "line 1\n", "line 2\n", "line 3\n"])
+        with mock.patch.object(selector.asyncHelper, "makeRequest", mock.AsyncMock(return_value=("X", noLink))) as request, \
+                mock.patch.object(selector.logger, "exception") as logException:
+            self.assertEqual(asyncio.run(selector._fetchUncertainty("X", {})), ("X", None))
+        request.assert_awaited_once()  # never asked for the offsets
+        logException.assert_not_called()
+
+    def test_parseTime(self):
+        def strptimeOrError(timeString):
+            try:
+                return datetime.strptime(timeString, "%Y-%m-%d %H:%M:%S")
+            except ValueError:
+                try:
+                    return datetime.strptime(timeString, "%Y-%m-%d %H:%M:%S.%f")
+                except ValueError:
+                    return "error"
+
+        def parseOrError(timeString):
+            try:
+                return timeUtils.parseTime(timeString)
+            except ValueError:
+                return "error"
+
+        for i in range(1000):
+            t = datetime(2023, 1, 1) + timedelta(seconds=random.randint(0, 10 ** 8), microseconds=random.randint(0, 999999))
+            for timeString in (t.strftime("%Y-%m-%d %H:%M:%S"), t.strftime("%Y-%m-%d %H:%M:%S.%f"),
+                               t.strftime("%Y-%m-%d %H:%M:%S.%f")[:-random.randint(1, 5)]):
+                self.assertEqual(parseOrError(timeString), strptimeOrError(timeString))
+        for timeString in ("2023-6-7 1:02:03", "2023-13-01 00:00:00", "2023-06-27 05:00:00.", "2023-06-27T05:00:00",
+                           "2023-06-27 05:00:00.1234567", "2023-06-27 05:00:0a", "2023-06-27 +5:00:00", ""):
+            self.assertEqual(parseOrError(timeString), strptimeOrError(timeString))
+
+        self.assertEqual(sCoreCondensed.stringToTime("2022-12-26T05:25:00.000"),
+                         datetime(2022, 12, 26, 5, 25, tzinfo=pytz.UTC))
+        with mock.patch("builtins.print") as printed, self.assertLogs("stringToTime", level="ERROR") as logs:
+            self.assertIsNone(genUtils.stringToTime("not a time", logger=logging.getLogger("stringToTime")))
+        printed.assert_not_called()
+        self.assertEqual(logs.records[0].getMessage(), "Unable to coerce time from not a time")
+        column = timeUtils.parseTimeColumn(["2023-06-27 05:00:00", "2023-06-27 05:00:00.250000", None, "bad"])
+        self.assertEqual(list(column[:2]), [datetime(2023, 6, 27, 5), datetime(2023, 6, 27, 5, 0, 0, 250000)])
+        self.assertTrue(column[2:].isna().all())
+
     def test_VelocityExtraction(self):
         # (obsDatetime, coords, vMag, vRa, vDec, deltaErr)
         dRA, dDec = round(random.uniform(-100, 100), 3), round(random.uniform(-100, 100), 3)
@@ -85,3 +368,37 @@ class Test(unittest.TestCase):
         transitTime = genUtils.findTransitTime(Angle(lst), TMO)
         # ^ this will return a datetime object rounded to the nearest (?) ten minutes
         print(transitTime)
+
+    def test_transitTimes(self):
+        from astral import LocationInfo
+        TMO = LocationInfo(name="TMO", region="CA, USA", timezone="UTC", latitude=34.36, longitude=-117.63)
+        currentTime = datetime(2023, 6, 27, 4, 23, 41)
+        lst = Time(currentTime.replace(second=0)).sidereal_time('mean', longitude=TMO.longitude)
+        ras = [random.uniform(0, 24) for i in range(50)]
+        transitTimes = genUtils.findTransitTimes(ras, TMO, unit=angleUtils.HOURS, currentTime=currentTime)
+        self.assertEqual(len(transitTimes), len(ras))
+        for ra, transitTime in zip(ras, transitTimes):
+            # the old per-target arithmetic, with astropy
+            haHours, haMinutes, haSeconds = (Angle(str(ra) + "h") - lst).to(u.hourangle).hms
+            expected = genUtils.roundToTenMinutes(currentTime.replace(second=0) + timedelta(hours=haHours, minutes=haMinutes))
+            self.assertEqual(transitTime, expected)
+            self.assertEqual(transitTime.minute % 10, 0)
+        # a target at the meridian transits now
+        self.assertEqual(genUtils.findTransitTimes([lst.degree], TMO, currentTime=currentTime)[0], datetime(2023, 6, 27, 4, 20))
+
+    def test_nightContext(self):
+        import tempfile
+        from scheduleLib import nightContext
+        with tempfile.TemporaryDirectory() as cacheDir:
+            when = datetime(2023, 6, 27, 20, tzinfo=pytz.UTC)  # afternoon in california: tonight ends with tomorrow's sunrise
+            night = nightContext.NightContext.get(when=when, cacheDir=cacheDir, refresh=True)
+            self.assertEqual(night.sunrise.date(), datetime(2023, 6, 28).date())
+            self.assertTrue(when < night.sunset < night.dusk < night.dawn < night.sunrise)
+            self.assertLess(night.sunrise - night.sunset, timedelta(hours=12))
+            for t in night.timeGrid()[::7] + [night.sunrise, night.sunset - timedelta(hours=3)]:
+                expected = Time(t, scale="utc").sidereal_time("apparent", longitude=nightContext.TMO.longitude).degree
+                self.assertAlmostEqual(night.siderealTime(t), expected, places=5)
+            # another process would read it back from the file
+            path = os.path.join(cacheDir, nightContext.siteKey(nightContext.TMO) + "_" + night.night.isoformat() + ".json")
+            loaded = nightContext.NightContext.load(path, nightContext.TMO)
+            self.assertEqual(loaded.toDict(), night.toDict())